@@ -3,7 +3,7 @@ import loggers
 import plist_editor
 
 __version__ = '1.9.1'
-__all__     = ['app_info', 'fs_analysis', 'loggers', 'plist_editor', 'slack']
+__all__     = ['app_discovery', 'app_index', 'app_info', 'app_inventory', 'bplist', 'caches', 'concurrency', 'fingerprint', 'fs_analysis', 'fs_history', 'loggers', 'macho', 'plist_diff', 'plist_editor', 'plist_watcher', 'slack']
 
 # This provides the ability to get the version from the command line.
 # Do something like:
@@ -0,0 +1,304 @@
+####
+#
+# This module finds application bundles on disk. Discovery is done by a
+# backend, which can be swapped out: SpotlightBackend asks Spotlight (mdfind),
+# which is fast when its index is up to date but slow while it is rebuilding
+# and unavailable off OS X, and FilesystemBackend crawls the application
+# directories itself, which takes a predictable amount of time anywhere.
+#
+# The crawler never descends into a bundle (an application, or something
+# like a '.framework' or '.bundle'), only looks a limited number of
+# directories deep, and crawls each of its root directories in parallel.
+#
+####
+
+## Imports
+import os
+import stat
+import subprocess
+import sys
+import threading
+
+from concurrency import run_pool
+from plist_editor import shared_cache
+
+# os.scandir() (Python 3.5+) or the 'scandir' backport avoid a stat() for each
+# entry on most file systems. Without either, entries are lstat()ed.
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+# The directories searched for applications by default.
+APPLICATION_DIRECTORIES = [
+    '/Applications',
+    '/System/Applications',
+    '/System/Library/CoreServices',
+    '~/Applications',
+]
+
+# How many directories deep to look below each of the application directories.
+MAX_DEPTH = 3
+
+# The extensions of bundles (and other packages) which never hold applications
+# worth finding, so are not searched. A directory with any other extension,
+# such as 'Python 3.11', is searched unless it turns out to be a bundle.
+BUNDLE_EXTENSIONS = set([
+    '.appex', '.bundle', '.component', '.docset', '.dsym', '.framework', '.kext', '.lproj',
+    '.mdimporter', '.mpkg', '.pkg', '.plugin', '.prefpane', '.qlgenerator', '.saver',
+    '.wdgt', '.xcarchive', '.xcodeproj', '.xpc',
+])
+
+
+def _entries(directory):
+    """
+    :return: a list of (name, path, is_directory) tuples for the directory's
+             entries, where symbolic links never count as directories
+    """
+    if _scandir is not None:
+        iterator = _scandir(directory)
+        try:
+            return [(e.name, e.path, e.is_dir(follow_symlinks=False)) for e in iterator]
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            is_directory = stat.S_ISDIR(os.lstat(path).st_mode)
+        except OSError:
+            continue
+        entries.append((name, path, is_directory))
+    return entries
+
+
+def list_directory(directory):
+    """
+    List the application bundles and the directories worth searching for more
+    of them directly within a directory.
+
+    :param directory: the directory to list
+    :return: a tuple of (bundle paths, subdirectory paths), each sorted
+    """
+    bundles = []
+    subdirectories = []
+    try:
+        entries = _entries(directory)
+    except OSError:
+        return bundles, subdirectories
+    for name, path, is_directory in entries:
+        if not is_directory:
+            continue
+        extension = os.path.splitext(name)[1].lower()
+        if extension == '.app':
+            bundles.append(path)
+        elif not extension:
+            subdirectories.append(path)
+        elif extension not in BUNDLE_EXTENSIONS and not os.path.exists(os.path.join(path, 'Contents', 'Info.plist')):
+            # Not a bundle, just a name with a dot in it.
+            subdirectories.append(path)
+    return sorted(bundles), sorted(subdirectories)
+
+
+def crawl(root, max_depth=MAX_DEPTH):
+    """
+    Find the application bundles below a directory.
+
+    :param root: the directory to search
+    :param max_depth: how many directories deep to look below it
+    :return: a list of bundle paths, in the order they were found
+    """
+    found = []
+    stack = [(root, 0)]
+    while stack:
+        directory, depth = stack.pop()
+        bundles, subdirectories = list_directory(directory)
+        found.extend(bundles)
+        if depth < max_depth:
+            stack.extend((d, depth + 1) for d in reversed(subdirectories))
+    return found
+
+
+def _crawl_task(task):
+    root, max_depth = task
+    return root, crawl(root, max_depth)
+
+
+def _bundle_id(path):
+    """
+    :return: the bundle identifier of an application, or None
+    """
+    try:
+        info = shared_cache.get(os.path.join(path, 'Contents', 'Info.plist'))
+    except Exception:
+        return None
+    if isinstance(info, dict):
+        return info.get('CFBundleIdentifier')
+    return None
+
+
+class DiscoveryBackend(object):
+    """
+    The interface for discovery backends. A backend looks for applications
+    below a list of root directories.
+    """
+    def __init__(self, roots=None):
+        """
+        :param roots: the directories to search (APPLICATION_DIRECTORIES if
+                      omitted)
+        """
+        if roots is None:
+            roots = APPLICATION_DIRECTORIES
+        self.roots = [os.path.abspath(os.path.expanduser(r)) for r in roots]
+
+    def applications(self):
+        """
+        :return: a list of the paths of all the application bundles found
+        """
+        raise NotImplementedError
+
+    def find_by_bid(self, bid):
+        """
+        :param bid: a bundle identifier, e.g. 'com.apple.Safari'
+        :return: a list of the paths of the bundles with that identifier
+        """
+        raise NotImplementedError
+
+
+class FilesystemBackend(DiscoveryBackend):
+    """
+    Finds applications by crawling the root directories, all of them at once.
+    """
+    def __init__(self, roots=None, max_depth=MAX_DEPTH, workers=None):
+        """
+        :param roots: the directories to search (APPLICATION_DIRECTORIES if
+                      omitted)
+        :param max_depth: how many directories deep to look below each root
+        :param workers: how many threads to use (one per root if omitted)
+        """
+        DiscoveryBackend.__init__(self, roots)
+        self.max_depth = max_depth
+        self.workers   = workers
+
+    def applications(self):
+        roots = [r for r in self.roots if os.path.isdir(r)]
+        if not roots:
+            return []
+        if len(roots) == 1:
+            return crawl(roots[0], self.max_depth)
+        tasks = [(root, self.max_depth) for root in roots]
+        found = dict(run_pool(_crawl_task, tasks, self.workers or len(roots)))
+        # Keep the order of the roots, whichever finished first, and list
+        # bundles below more than one (overlapping) root only once.
+        seen = set()
+        applications = []
+        for root in roots:
+            for path in found[root]:
+                if path not in seen:
+                    seen.add(path)
+                    applications.append(path)
+        return applications
+
+    def find_by_bid(self, bid):
+        return [path for path in self.applications() if _bundle_id(path) == bid]
+
+
+class SpotlightBackend(DiscoveryBackend):
+    """
+    Finds applications with Spotlight, through the 'mdfind' command.
+    """
+    @staticmethod
+    def __mdfind(arguments):
+        output = subprocess.check_output(['mdfind'] + arguments)
+        return [line for line in output.split('\n') if line.strip()]
+
+    def applications(self):
+        found = []
+        for root in self.roots:
+            if os.path.isdir(root):
+                found.extend(self.__mdfind(['-onlyin', root, 'kMDItemKind==Application']))
+        return found
+
+    def find_by_bid(self, bid):
+        return self.__mdfind(['kMDItemCFBundleIdentifier', '=', bid])
+
+
+class CachedBackend(DiscoveryBackend):
+    """
+    Wraps another backend and remembers its answers, so that resolving many
+    applications in one process asks the other backend (e.g. Spotlight) for
+    the list of applications only once, and about each bundle identifier only
+    once.
+    """
+    def __init__(self, backend):
+        """
+        :param backend: the DiscoveryBackend to ask
+        """
+        self.backend = backend
+        self.roots   = backend.roots
+        self.__lock  = threading.RLock()
+        self.__applications = None
+        self.__bids  = {}
+
+    def applications(self):
+        with self.__lock:
+            if self.__applications is None:
+                self.__applications = self.backend.applications()
+            return list(self.__applications)
+
+    def find_by_bid(self, bid):
+        with self.__lock:
+            if bid not in self.__bids:
+                if isinstance(self.backend, FilesystemBackend):
+                    # Search the crawl already made rather than crawling again.
+                    found = [path for path in self.applications() if _bundle_id(path) == bid]
+                else:
+                    found = self.backend.find_by_bid(bid)
+                self.__bids[bid] = found
+            return list(self.__bids[bid])
+
+
+def spotlight_available():
+    """
+    :return: whether Spotlight can be used on this system
+    """
+    if sys.platform != 'darwin':
+        return False
+    return any(
+        os.access(os.path.join(d, 'mdfind'), os.X_OK)
+        for d in os.environ.get('PATH', '/usr/bin').split(os.pathsep)
+    )
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend():
+    """
+    Get the backend used by the rest of the package (e.g. by AppInfo when the
+    application index does not know an application). Unless one has been set
+    with set_backend(), this is a SpotlightBackend where Spotlight is available
+    and a FilesystemBackend elsewhere.
+
+    :return: the current DiscoveryBackend
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = SpotlightBackend() if spotlight_available() else FilesystemBackend()
+        return _backend
+
+
+def set_backend(backend):
+    """
+    Set the backend used by the rest of the package.
+
+    :param backend: a DiscoveryBackend, or None to go back to the default
+    """
+    global _backend
+    with _backend_lock:
+        _backend = backend
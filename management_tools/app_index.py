@@ -0,0 +1,442 @@
+####
+#
+# This module keeps an on-disk index of the applications installed on the
+# system, so that finding an application by bundle identifier or by name is a
+# database lookup instead of a Spotlight query.
+#
+# The index is built by crawling the application directories, and refreshed
+# incrementally: a directory whose modification time has not changed since the
+# last crawl is not listed again, and an application whose Info.plist has not
+# changed is not read again.
+#
+####
+
+## Imports
+import bisect
+import os
+import threading
+import time
+
+from app_discovery import APPLICATION_DIRECTORIES, MAX_DEPTH, list_directory
+from caches import default_cache_dir, open_cache_db
+from plist_editor import read_plist
+
+# The index is kept in the cache directory (see caches.default_cache_dir()).
+INDEX_NAME = 'app_index.sqlite'
+
+# Bumped whenever the tables change (or what is crawled does); an index with a
+# different version is rebuilt from scratch.
+SCHEMA_VERSION = 2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    path        TEXT PRIMARY KEY,
+    parent      TEXT,
+    mtime       REAL
+);
+CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent);
+CREATE TABLE IF NOT EXISTS apps (
+    path        TEXT PRIMARY KEY,
+    directory   TEXT,
+    filename    TEXT,
+    bid         TEXT,
+    name        TEXT,
+    version     TEXT,
+    executable  TEXT,
+    plist_mtime REAL
+);
+CREATE INDEX IF NOT EXISTS apps_directory ON apps (directory);
+CREATE INDEX IF NOT EXISTS apps_bid ON apps (bid);
+CREATE INDEX IF NOT EXISTS apps_name ON apps (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS apps_filename ON apps (filename COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS unreadable (
+    path        TEXT PRIMARY KEY,
+    directory   TEXT
+);
+CREATE INDEX IF NOT EXISTS unreadable_directory ON unreadable (directory);
+"""
+
+_COLUMNS = ['path', 'bid', 'name', 'version', 'executable']
+
+
+def default_index_path():
+    """
+    :return: the location of the index for the current user
+    """
+    return os.path.join(default_cache_dir(), INDEX_NAME)
+
+
+def read_bundle(path):
+    """
+    Read the information the index keeps about an application bundle.
+
+    :param path: the path to the '.app' bundle
+    :return: a dictionary with the keys in _COLUMNS plus 'plist_mtime', or
+             None if the bundle has no readable Info.plist
+    """
+    plist = os.path.join(path, 'Contents', 'Info.plist')
+    try:
+        mtime = os.stat(plist).st_mtime
+        info = read_plist(plist)
+    except Exception:
+        return None
+    if not isinstance(info, dict):
+        return None
+    bid = info.get('CFBundleIdentifier')
+    name = info.get('CFBundleName')
+    if not name and bid:
+        name = bid.split('.')[-1].title()
+    executable = info.get('CFBundleExecutable')
+    if executable:
+        executable = os.path.join(path, 'Contents', 'MacOS', executable)
+    return {
+        'path':        path,
+        'bid':         bid,
+        'name':        name,
+        'version':     info.get('CFBundleShortVersionString') or info.get('CFBundleVersion'),
+        'executable':  executable,
+        'plist_mtime': mtime,
+    }
+
+
+class AppIndex(object):
+    """
+    An index of application bundles, kept in an SQLite database. Lookups only
+    consult the database; call refresh() to bring it up to date with the
+    file system (which is cheap when little has changed).
+    """
+    def __init__(self, path=None, roots=None, max_depth=MAX_DEPTH):
+        """
+        :param path: the database file (default_index_path() if omitted); if
+                     it cannot be created, the index is kept in memory
+        :param roots: the directories to crawl (APPLICATION_DIRECTORIES if
+                      omitted)
+        :param max_depth: how many directories deep to look below each root
+        """
+        if path is None:
+            path = default_index_path()
+        if roots is None:
+            roots = APPLICATION_DIRECTORIES
+        self.roots     = [os.path.abspath(os.path.expanduser(r)) for r in roots]
+        self.max_depth = max_depth
+        self.__lock    = threading.RLock()
+        self.__db, self.path = open_cache_db(path, _SCHEMA, SCHEMA_VERSION)
+
+    def close(self):
+        """
+        Close the database.
+        """
+        with self.__lock:
+            self.__db.close()
+
+    def refresh(self):
+        """
+        Bring the index up to date with the file system. Directories are only
+        listed again if their modification time has changed, and bundles are
+        only read again if their Info.plist has changed (or could not be read
+        last time).
+
+        :return: the number of bundles that were (re-)read
+        """
+        with self.__lock:
+            db = self.__db
+            seen = set()
+            updated = 0
+            stack = [(root, None, 0) for root in reversed(self.roots)]
+            while stack:
+                directory, parent, depth = stack.pop()
+                try:
+                    mtime = os.stat(directory).st_mtime
+                except OSError:
+                    continue
+                if directory in seen:
+                    continue
+                seen.add(directory)
+
+                row = db.execute('SELECT mtime FROM directories WHERE path = ?', (directory,)).fetchone()
+                if row is not None and row[0] == mtime:
+                    # Nothing was added or removed here, so the stored listing
+                    # is still good.
+                    stored = dict(db.execute(
+                        'SELECT path, plist_mtime FROM apps WHERE directory = ?', (directory,)).fetchall())
+                    bundles = list(stored.keys()) + [r[0] for r in db.execute(
+                        'SELECT path FROM unreadable WHERE directory = ?', (directory,))]
+                    subdirectories = [r[0] for r in db.execute(
+                        'SELECT path FROM directories WHERE parent = ?', (directory,))]
+                else:
+                    bundles, subdirectories = list_directory(directory)
+                    stored = dict(db.execute(
+                        'SELECT path, plist_mtime FROM apps WHERE directory = ?', (directory,)).fetchall())
+                    for path in set(stored).difference(bundles):
+                        db.execute('DELETE FROM apps WHERE path = ?', (path,))
+                    for (path,) in db.execute(
+                            'SELECT path FROM unreadable WHERE directory = ?', (directory,)).fetchall():
+                        if path not in bundles:
+                            db.execute('DELETE FROM unreadable WHERE path = ?', (path,))
+
+                # Only read bundles which are new, whose Info.plist changed, or
+                # which could not be read before (and so are not in 'stored').
+                for path in bundles:
+                    try:
+                        plist_mtime = os.stat(os.path.join(path, 'Contents', 'Info.plist')).st_mtime
+                    except OSError:
+                        plist_mtime = None
+                    if path not in stored or stored[path] != plist_mtime:
+                        updated += self.__store(path, directory)
+
+                if row is None or row[0] != mtime:
+                    db.execute('INSERT OR REPLACE INTO directories (path, parent, mtime) VALUES (?, ?, ?)',
+                               (directory, parent, mtime))
+
+                if depth < self.max_depth:
+                    stack.extend((d, directory, depth + 1) for d in reversed(subdirectories))
+
+            # Forget directories (and their bundles) which no longer exist or
+            # are no longer below one of the roots.
+            for (directory,) in db.execute('SELECT path FROM directories').fetchall():
+                if directory not in seen:
+                    db.execute('DELETE FROM directories WHERE path = ?', (directory,))
+                    db.execute('DELETE FROM apps WHERE directory = ?', (directory,))
+                    db.execute('DELETE FROM unreadable WHERE directory = ?', (directory,))
+            db.commit()
+            return updated
+
+    def __store(self, path, directory):
+        """
+        Read a bundle and store its entry, or record that it could not be
+        read so that the next refresh tries again.
+
+        :return: 1, for counting bundles read
+        """
+        record = read_bundle(path)
+        if record is None:
+            self.__db.execute('DELETE FROM apps WHERE path = ?', (path,))
+            self.__db.execute('INSERT OR REPLACE INTO unreadable (path, directory) VALUES (?, ?)', (path, directory))
+        else:
+            self.__db.execute('DELETE FROM unreadable WHERE path = ?', (path,))
+            self.__db.execute(
+                'INSERT OR REPLACE INTO apps (path, directory, filename, bid, name, version, executable, plist_mtime) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (path, directory, os.path.basename(path)[:-4], record['bid'], record['name'],
+                 record['version'], record['executable'], record['plist_mtime'])
+            )
+        return 1
+
+    def __select(self, where, arguments):
+        with self.__lock:
+            rows = self.__db.execute(
+                'SELECT {} FROM apps WHERE {} ORDER BY length(path), path'.format(', '.join(_COLUMNS), where),
+                arguments
+            ).fetchall()
+        return [dict(zip(_COLUMNS, row)) for row in rows]
+
+    def find_by_bid(self, bid):
+        """
+        :param bid: a bundle identifier, e.g. 'com.apple.Safari'
+        :return: a list of records (dictionaries with the keys 'path', 'bid',
+                 'name', 'version' and 'executable') for matching bundles
+        """
+        return self.__select('bid = ?', (bid,))
+
+    def find_by_name(self, name):
+        """
+        :param name: an application's name (CFBundleName) or the name of its
+                     bundle without '.app', compared without regard to case
+        :return: a list of records for matching bundles
+        """
+        if name.endswith('.app'):
+            name = name[:-4]
+        return self.__select('name = ? COLLATE NOCASE OR filename = ? COLLATE NOCASE', (name, name))
+
+    def find_by_path(self, path):
+        """
+        :param path: the path to an application bundle
+        :return: the bundle's record, or None if it is not in the index
+        """
+        records = self.__select('path = ?', (os.path.abspath(path).rstrip('/'),))
+        return records[0] if records else None
+
+    def records(self):
+        """
+        :return: a list of records for every bundle in the index
+        """
+        return self.__select('1', ())
+
+
+# How names match a query, best first.
+EXACT     = 0
+PREFIX    = 1
+SUBSTRING = 2
+FUZZY     = 3
+
+# The lowest trigram similarity (from 0 to 1) counted as a fuzzy match.
+FUZZY_THRESHOLD = 0.5
+
+
+def _normalize(name):
+    """
+    :return: the form of a name used for matching: lower case, without a
+             trailing '.app', and with runs of whitespace collapsed
+    """
+    name = name.strip().lower()
+    if name.endswith('.app'):
+        name = name[:-4]
+    return ' '.join(name.split())
+
+
+def _trigrams(name):
+    """
+    :return: the set of three-character substrings of the name, padded so
+             that the beginning and end of the name count too
+    """
+    padded = '  ' + name + ' '
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class NameIndex(object):
+    """
+    An in-memory index of application names for resolving short names. Each
+    application can be found by its name (CFBundleName) or its bundle's file
+    name, and matches are ranked: exact matches first, then names with a word
+    starting with the query, then names containing it, and finally names which
+    merely look similar (by the trigrams they share). Within a rank, matches of
+    whole words come first and then shorter names, so 'Word' prefers
+    'Microsoft Word' to 'Word Counter Pro' and both to 'WordService'.
+    """
+    def __init__(self, records):
+        """
+        :param records: the application records to index, as returned by
+                        AppIndex.records()
+        """
+        self.records  = list(records)
+        self.__names  = []
+        self.__sorted = []
+        self.__grams  = {}
+        self.__sizes  = []
+        for record in self.records:
+            for name in set([record.get('name') or '', os.path.basename(record['path'])]):
+                name = _normalize(name)
+                if not name:
+                    continue
+                entry = len(self.__names)
+                self.__names.append((name, record))
+                # Every word of the name is the start of a sorted entry, so
+                # that a prefix search also finds matches in later words.
+                for start in range(len(name)):
+                    if start == 0 or name[start - 1] == ' ':
+                        self.__sorted.append((name[start:], entry, start))
+                grams = _trigrams(name)
+                self.__sizes.append(len(grams))
+                for gram in grams:
+                    self.__grams.setdefault(gram, set()).add(entry)
+        self.__sorted.sort()
+
+    def search(self, query, limit=None):
+        """
+        Find the applications whose names best match the query.
+
+        :param query: the name (or part of a name) to look for
+        :param limit: the most records to return (all matches if omitted)
+        :return: a list of (rank, record) tuples, best first, where rank is
+                 one of EXACT, PREFIX, SUBSTRING or FUZZY
+        """
+        query = _normalize(query)
+        if not query:
+            return []
+        best = {}
+
+        def consider(entry, rank, score):
+            name, record = self.__names[entry]
+            key = (rank, -score, len(name), len(record['path']), record['path'])
+            if record['path'] not in best or key < best[record['path']][0]:
+                best[record['path']] = (key, rank, record)
+
+        # Exact and prefix matches are a range of the sorted names.
+        start = bisect.bisect_left(self.__sorted, (query,))
+        for name, entry, offset in self.__sorted[start:]:
+            if not name.startswith(query):
+                break
+            if name == query and offset == 0:
+                consider(entry, EXACT, 1.0)
+            else:
+                whole = len(name) == len(query) or name[len(query)] == ' '
+                consider(entry, PREFIX, 1.0 if whole else 0.5)
+
+        # Every name containing the query contains all of its trigrams (apart
+        # from the ones padded at the ends), and similar names share many.
+        grams = _trigrams(query)
+        inner = set(g for g in grams if not g.startswith(' ') and not g.endswith(' '))
+        if len(query) < 3:
+            candidates = range(len(self.__names))
+        elif inner:
+            candidates = set.intersection(*[self.__grams.get(g, set()) for g in inner])
+        else:
+            candidates = ()
+        for entry in candidates:
+            if query in self.__names[entry][0]:
+                consider(entry, SUBSTRING, 1.0)
+        if limit is not None and len(best) >= limit:
+            # Fuzzy matches would all come after the ones already found.
+            return [(rank, record) for key, rank, record in sorted(best.values())][:limit]
+        counts = {}
+        for gram in grams:
+            for entry in self.__grams.get(gram, ()):
+                counts[entry] = counts.get(entry, 0) + 1
+        for entry, shared in counts.items():
+            score = 2.0 * shared / (len(grams) + self.__sizes[entry])
+            if score >= FUZZY_THRESHOLD:
+                consider(entry, FUZZY, score)
+
+        results = [(rank, record) for key, rank, record in sorted(best.values())]
+        return results[:limit] if limit is not None else results
+
+
+# How many seconds get_index() waits after failing to build the shared index
+# before it tries again.
+RETRY_DELAY = 60
+
+_shared_index = None
+_shared_error = None
+_shared_error_time = None
+_shared_names = None
+_shared_lock = threading.Lock()
+
+def get_index():
+    """
+    Get the index shared by the whole process, refreshing it the first time it
+    is asked for. If that fails, the same error is raised for RETRY_DELAY
+    seconds after, rather than crawling again on every call, and then the
+    index is tried again.
+
+    :return: the shared AppIndex
+    """
+    global _shared_index, _shared_error, _shared_error_time
+    with _shared_lock:
+        if _shared_error is not None:
+            if time.time() - _shared_error_time < RETRY_DELAY:
+                raise _shared_error
+            _shared_error = _shared_error_time = None
+        if _shared_index is None:
+            try:
+                index = AppIndex()
+                index.refresh()
+            except Exception as e:
+                _shared_error, _shared_error_time = e, time.time()
+                raise
+            _shared_index = index
+        return _shared_index
+
+
+def get_name_index():
+    """
+    Get the name index shared by the whole process. It is built from the
+    shared AppIndex the first time it is asked for.
+
+    :return: the shared NameIndex
+    """
+    global _shared_names
+    index = get_index()
+    with _shared_lock:
+        if _shared_names is None:
+            _shared_names = NameIndex(index.records())
+        return _shared_names
@@ -1,10 +1,59 @@
 import os
 import re
-import subprocess
+import sqlite3
 
+from app_discovery import get_backend
+from app_index import FUZZY, get_index, get_name_index
+from macho import MachOError, architectures
+from concurrency import run_pool
 from plist_editor import PlistEditor
 
-class AppInfo:
+def _indexed_path(method, item):
+    '''Looks an application up in the shared application index.  Returns the
+    path of the first match that still exists, or None (also if the index
+    cannot be used for any reason).
+
+    method -- the AppIndex method to use ('find_by_bid' or 'find_by_name')
+    item   -- the bundle identifier or name to look up
+    '''
+    try:
+        records = getattr(get_index(), method)(item)
+    except (OSError, sqlite3.Error):
+        return None
+    for record in records:
+        if os.path.isdir(record['path']):
+            return record['path']
+    return None
+
+def _named_path(name):
+    '''Resolves a short name through the shared name index, which ranks exact
+    matches above prefix and substring ones.  Returns the path of the best
+    match that still exists, or None.  Fuzzy matches are only suggestions
+    (see NameIndex.search()), so they are never used: 'Pages' must not turn
+    into Pager.app.
+
+    name -- the short name of the application
+    '''
+    try:
+        matches = get_name_index().search(name, 10)
+    except (OSError, sqlite3.Error):
+        return None
+    for rank, record in matches:
+        if rank < FUZZY and os.path.isdir(record['path']):
+            return record['path']
+    return None
+
+def _utf8(value):
+    '''Returns unicode values as UTF-8 byte strings, the way
+    PlistEditor.read() does, and anything else as it is.
+
+    value -- the value to convert
+    '''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+class AppInfo(object):
     '''A class to help you find your applications and their info.  Can take in either:
         1. A path to an application bundle ('.app')
         2. A bundle identifier ('com.apple.Safari')
@@ -12,6 +61,17 @@ class AppInfo:
 
     After this, the name, path, bid, and plist are easily accessible.
 
+    Bundle identifiers and short names are first looked up in the on-disk
+    application index (see app_index), and only searched for with the
+    discovery backend (see app_discovery) if the index does not know them.
+    Short names are ranked, so that an exact name wins over one that merely
+    contains it.
+
+    The bid, name, and executable are read from the Info.plist the first time
+    one of them is asked for (all three at once, from a single parse of the
+    plist), and are None if it cannot be parsed.  Use AppInfo.many() to
+    resolve a lot of applications at a time.
+
     Accessible parts are:
         path  - the path to the .app bundle
         plist - the plist at [path]/Contents/Info.plist
@@ -19,15 +79,17 @@ class AppInfo:
                 given by CFBundleIdentifier
         name  - the name of the application in the plist given by
                 CFBundleName
+        architectures - the architectures of the application's executable
     '''
 
+    __slots__ = ('path', '__plist', '__bid', '__name', '__executable', '__loaded', '__architectures')
+
     def __init__ (self, app):
 
         self.path = None
-        self.plist = None
-        self.bid = None
-        self.name = None
-        self.executable = None
+        self.__plist = None
+        self.__loaded = False
+        self.__architectures = None
 
         # First, find the path of the app.
         if os.path.isdir(app):
@@ -38,42 +100,133 @@ class AppInfo:
                 self.path = app
         elif '.' in app and app.find('.app', len(app) - 4) < 0:
             # Let's try and use it as a Bundle ID.
-            self.path = subprocess.check_output(['mdfind', 'kMDItemCFBundleIdentifier', '=', app]).strip()
+            self.path = _indexed_path('find_by_bid', app)
+            if not self.path:
+                found = get_backend().find_by_bid(app)
+                self.path = found[0] if found else None
             if not self.path:
                 raise ValueError("Invalid bundle identifier.  No path found.")
         else:
             # They probably tried to supply just a simple name for the application.  Silly user!
             # We shall try to accommodate...
             app = app.replace('.app', '')
-            p = re.compile('.*' + app + '.*', re.IGNORECASE)
-            # We use 'mdfind' (aka Spotlight) to find all applications and search through their names.
-            apps = subprocess.check_output(['mdfind', '-onlyin', '/Applications', 'kMDItemKind==Application']).split('\n')
-            for item in apps:
-                result = p.search(item)
-                if result:
-                    self.path = result.group().strip('\n')
-                    if os.path.isdir(self.path):
-                        break
+            self.path = _named_path(app)
+            if not self.path:
+                p = re.compile('.*' + app + '.*', re.IGNORECASE)
+                # We ask the discovery backend (Spotlight, or a crawl of the application
+                # directories) for all applications and search through their names.
+                apps = get_backend().applications()
+                for item in apps:
+                    result = p.search(item)
+                    if result:
+                        self.path = result.group().strip('\n')
+                        if os.path.isdir(self.path):
+                            break
 
         # If the path hasn't been found by now, something didn't go very well.
         if not self.path:
             raise ValueError("Invalid application: no path found.")
 
-        # Since we now have the path, get the rest of the info!
-        if os.path.exists(self.path + '/Contents/Info.plist'):
-            self.plist = PlistEditor(self.path + '/Contents/Info.plist')
-            self.bid = self.plist.read('CFBundleIdentifier')
-            self.name = self.plist.read('CFBundleName')
-            self.executable = self.path + '/Contents/MacOS/' + self.plist.read('CFBundleExecutable')
-            if not self.name:
-                self.name = self.bid.split('.')[-1].title()
-        else:
+        # Since we now have the path, make sure the rest of the info is there.
+        if not os.path.exists(self.path + '/Contents/Info.plist'):
             raise ValueError("Invalid application: no valid Info.plist found.")
 
+    @classmethod
+    def many (cls, items, workers=None):
+        '''Resolves a lot of applications at once, several at a time, and reads
+        their Info.plists right away.  Returns a list with an AppInfo for each
+        item, in the same order, or None where an item could not be resolved
+        or its Info.plist could not be parsed.
+
+        items   -- paths, bundle identifiers, and/or short names
+        workers -- how many threads to use (the number of CPUs if omitted)
+        '''
+        items = list(items)
+        results = [None] * len(items)
+        tasks = ((cls, index, item) for index, item in enumerate(items))
+        for index, info in run_pool(_resolve, tasks, workers):
+            results[index] = info
+        return results
+
+    def load (self):
+        '''Reads the bid, name, and executable from the Info.plist now rather
+        than when one of them is first asked for.  Unlike asking for them, this
+        raises whatever error parsing the Info.plist raised.
+        '''
+        if self.__loaded:
+            return
+        bid = _utf8(self.plist.get('CFBundleIdentifier'))
+        name = _utf8(self.plist.get('CFBundleName'))
+        executable = _utf8(self.plist.get('CFBundleExecutable'))
+        if not name and bid:
+            name = bid.split('.')[-1].title()
+        if executable:
+            executable = os.path.join(_utf8(self.path), 'Contents', 'MacOS', executable)
+        self.__bid, self.__name, self.__executable = bid, name, executable
+        self.__loaded = True
+
+    def __load (self):
+        try:
+            self.load()
+        except Exception:
+            # An Info.plist which cannot be parsed has none of the fields, as
+            # when PlistEditor.read() was used.
+            self.__bid = self.__name = self.__executable = None
+            self.__loaded = True
+
+    @property
+    def plist (self):
+        if self.__plist is None:
+            self.__plist = PlistEditor(self.path + '/Contents/Info.plist')
+        return self.__plist
+
+    @property
+    def bid (self):
+        self.__load()
+        return self.__bid
+
+    @property
+    def name (self):
+        self.__load()
+        return self.__name
+
+    @property
+    def executable (self):
+        self.__load()
+        return self.__executable
+
+    @property
+    def architectures (self):
+        '''The architectures the executable was built for, e.g. ['x86_64',
+        'arm64'], read from its Mach-O headers.  None if the application has
+        no executable or it cannot be read.
+        '''
+        if self.__architectures is None and self.executable:
+            try:
+                self.__architectures = architectures(self.executable)
+            except (MachOError, IOError, OSError):
+                pass
+        return self.__architectures
+
     def __repr__ (self):
-        result = str(self.name)
-        result += "\n\tBID:        " + str(self.bid)
-        result += "\n\tPath:       " + str(self.path)
+        result = str(_utf8(self.name))
+        result += "\n\tBID:        " + str(_utf8(self.bid))
+        result += "\n\tPath:       " + str(_utf8(self.path))
         result += "\n\tInfo.plist: " + str(self.plist)
-        result += "\n\tExecutable: " + str(self.executable)
+        result += "\n\tExecutable: " + str(_utf8(self.executable))
         return result
+
+def _resolve(task):
+    '''Builds one AppInfo for AppInfo.many(), reading its plist in the worker
+    thread.
+
+    task -- a tuple of (class, index, item)
+    '''
+    cls, index, item = task
+    try:
+        info = cls(item)
+        info.load()
+    except Exception:
+        # One bad application must not stop the rest from being resolved.
+        return index, None
+    return index, info
@@ -0,0 +1,408 @@
+####
+#
+# This module takes an inventory of the applications on a system and streams
+# it out as JSON lines, CSV, or rows in an SQLite database. Every stage is a
+# generator: bundles are found by a discovery backend, read a few at a time,
+# and written out as soon as they have been read, so memory use does not
+# depend on how many applications there are.
+#
+# For example, to write an inventory of /Applications as JSON lines:
+#
+#   with open('inventory.jsonl', 'w') as f:
+#       write_jsonl(inventory(roots=['/Applications']), f)
+#
+####
+
+## Imports
+import collections
+import csv
+import json
+import os
+import sqlite3
+
+from app_discovery import FilesystemBackend, get_backend
+from app_index import read_bundle
+from caches import default_cache_dir, open_cache_db
+from concurrency import run_pool
+
+# The fields of each record, in the order they are written out.
+FIELDS = ['bid', 'name', 'version', 'path', 'executable', 'size', 'mtime']
+
+# The fields of each record of a delta (see delta_records()).
+DELTA_FIELDS = ['change'] + FIELDS
+
+# The SQLite column types of the fields which are not text.
+_COLUMN_TYPES = {'size': 'INTEGER', 'mtime': 'REAL'}
+
+FORMAT_JSONL  = 'jsonl'
+FORMAT_CSV    = 'csv'
+FORMAT_SQLITE = 'sqlite'
+FORMATS       = [FORMAT_JSONL, FORMAT_CSV, FORMAT_SQLITE]
+
+# How many records are inserted into an SQLite database per transaction.
+BATCH_SIZE = 500
+
+ADDED   = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+
+# The snapshot kept by InventorySnapshot, in the cache directory.
+SNAPSHOT_NAME = 'app_inventory.sqlite'
+
+# Bumped whenever the snapshot table changes; a snapshot with a different
+# version is discarded, so that the next update reports everything as added.
+SNAPSHOT_VERSION = 1
+
+_SNAPSHOT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshot (
+    path        TEXT PRIMARY KEY,
+    plist_mtime REAL,
+    plist_size  INTEGER,
+    record      TEXT
+);
+"""
+
+
+def bundle_size(path):
+    """
+    :param path: the path to a bundle (or any directory)
+    :return: the total size in bytes of the files within it, not following
+             symbolic links
+    """
+    total = 0
+    for directory, subdirectories, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(directory, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def read_record(path, sizes=True):
+    """
+    Read the inventory record of a single application bundle.
+
+    :param path: the path to the '.app' bundle
+    :param sizes: whether to add up the size of the bundle (which means
+                  visiting every file in it)
+    :return: a dictionary with the keys in FIELDS, or None if the bundle has
+             no readable Info.plist
+    """
+    bundle = read_bundle(path)
+    if bundle is None:
+        return None
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    record = dict((field, bundle.get(field)) for field in FIELDS)
+    record['size'] = bundle_size(path) if sizes else None
+    record['mtime'] = mtime
+    return record
+
+
+def _read_task(task):
+    path, sizes = task
+    return read_record(path, sizes)
+
+
+def discover(roots=None, backend=None):
+    """
+    Find the applications to take an inventory of.
+
+    :param roots: the directories to crawl; if given, a FilesystemBackend is
+                  used for them
+    :param backend: the discovery backend to use (app_discovery.get_backend()
+                    if neither this nor 'roots' is given)
+    :return: an iterable of bundle paths
+    """
+    if backend is None:
+        backend = FilesystemBackend(roots) if roots is not None else get_backend()
+    return backend.applications()
+
+
+def records(paths, workers=None, sizes=True):
+    """
+    Read inventory records for bundles, several at a time. Records are yielded
+    as they are read, which is not necessarily the order of 'paths'; bundles
+    which cannot be read are skipped.
+
+    :param paths: an iterable of bundle paths
+    :param workers: how many bundles to read at a time (the number of CPUs if
+                    omitted)
+    :param sizes: whether to add up the size of each bundle
+    """
+    for record in run_pool(_read_task, ((path, sizes) for path in paths), workers):
+        if record is not None:
+            yield record
+
+
+def inventory(roots=None, backend=None, workers=None, sizes=True):
+    """
+    Take an inventory of the applications on the system.
+
+    :param roots: the directories to crawl (see discover())
+    :param backend: the discovery backend to use (see discover())
+    :param workers: how many bundles to read at a time
+    :param sizes: whether to add up the size of each bundle
+    :return: a generator of records, each a dictionary with the keys in FIELDS
+    """
+    return records(discover(roots, backend), workers, sizes)
+
+
+def _text(value):
+    """
+    :return: the value as a byte string for the csv module, or the value
+             itself if it is not a string
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def write_jsonl(records, fileobj, fields=None):
+    """
+    Write records out as JSON, one object per line.
+
+    :param records: an iterable of records
+    :param fileobj: the file to write to
+    :param fields: unused; accepted so that every writer can be called alike
+    :return: the number of records written
+    """
+    count = 0
+    for record in records:
+        fileobj.write(json.dumps(record, sort_keys=True) + '\n')
+        count += 1
+    return count
+
+
+def write_csv(records, fileobj, fields=FIELDS, header=True):
+    """
+    Write records out as CSV, with a column for each field.
+
+    :param records: an iterable of records
+    :param fileobj: the file to write to
+    :param fields: the fields to write, in order
+    :param header: whether to write a line with the column names first
+    :return: the number of records written
+    """
+    writer = csv.writer(fileobj)
+    if header:
+        writer.writerow(fields)
+    count = 0
+    for record in records:
+        writer.writerow([_text(record.get(field)) for field in fields])
+        count += 1
+    return count
+
+
+def write_sqlite(records, path, fields=FIELDS, table='inventory', batch_size=BATCH_SIZE):
+    """
+    Insert records into a table of an SQLite database, creating the table if
+    it does not exist. Records are inserted 'batch_size' at a time, one
+    transaction per batch; a record for a path already in the table replaces
+    it.
+
+    :param records: an iterable of records
+    :param path: the database file
+    :param fields: the fields to write, which become the table's columns
+    :param table: the name of the table
+    :param batch_size: how many records to insert per transaction
+    :return: the number of records written
+    """
+    db = sqlite3.connect(path)
+    db.text_factory = str
+    try:
+        columns = ', '.join(
+            '{} {}{}'.format(field, _COLUMN_TYPES.get(field, 'TEXT'), ' PRIMARY KEY' if field == 'path' else '')
+            for field in fields
+        )
+        db.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(table, columns))
+        statement = 'INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+            table, ', '.join(fields), ', '.join('?' * len(fields)))
+        count = 0
+        batch = []
+        for record in records:
+            batch.append([record.get(field) for field in fields])
+            if len(batch) >= batch_size:
+                with db:
+                    db.executemany(statement, batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            with db:
+                db.executemany(statement, batch)
+            count += len(batch)
+        return count
+    finally:
+        db.close()
+
+
+def export(records, destination, format=FORMAT_JSONL, fields=FIELDS):
+    """
+    Write records out in one of FORMATS.
+
+    :param records: an iterable of records
+    :param destination: a file object for FORMAT_JSONL and FORMAT_CSV, or the
+                        path to a database for FORMAT_SQLITE
+    :param format: one of FORMATS
+    :param fields: the fields to write (FIELDS, or DELTA_FIELDS for the
+                   records of a delta, which go into a 'changes' table rather
+                   than 'inventory' with FORMAT_SQLITE)
+    :return: the number of records written
+    """
+    if format == FORMAT_JSONL:
+        return write_jsonl(records, destination, fields)
+    elif format == FORMAT_CSV:
+        return write_csv(records, destination, fields)
+    elif format == FORMAT_SQLITE:
+        table = 'changes' if 'change' in fields else 'inventory'
+        return write_sqlite(records, destination, fields, table)
+    raise ValueError("Format not valid.  Must be one of " + str(FORMATS))
+
+
+# One difference between the snapshot and the system. 'change' is ADDED,
+# REMOVED or CHANGED; 'record' is the bundle's current record (None if it was
+# removed) and 'previous' its record in the snapshot (None if it was added).
+Change = collections.namedtuple('Change', ['change', 'path', 'record', 'previous'])
+
+
+def _signature(path):
+    """
+    :return: the (mtime, size) of a bundle's Info.plist, or None if it has none
+    """
+    try:
+        info = os.stat(os.path.join(path, 'Contents', 'Info.plist'))
+    except OSError:
+        return None
+    return (info.st_mtime, info.st_size)
+
+
+def _changed(previous, record, sizes=True):
+    """
+    :param previous: a record from the snapshot, as decoded from JSON (so its
+                     strings are unicode)
+    :param record: the record just read (whose strings are byte strings)
+    :param sizes: whether the record's size was added up; if not, or if the
+                  snapshot has no size either, sizes are not compared
+    :return: whether any field differs between the two
+    """
+    fields = FIELDS
+    if not sizes or previous.get('size') is None:
+        fields = [field for field in FIELDS if field != 'size']
+    return any(_text(previous.get(field)) != _text(record.get(field)) for field in fields)
+
+
+def _snapshot_task(task):
+    """
+    :return: a tuple of (path, signature, record), with the signature taken
+             just before the record is read so that it is never newer than
+             the record; the record is None if the bundle has no Info.plist
+    """
+    path, sizes = task
+    signature = _signature(path)
+    if signature is None:
+        return path, None, None
+    return path, signature, read_record(path, sizes)
+
+
+def default_snapshot_path():
+    """
+    :return: the location of the inventory snapshot for the current user
+    """
+    return os.path.join(default_cache_dir(), SNAPSHOT_NAME)
+
+
+class InventorySnapshot(object):
+    """
+    The inventory as of the last run, kept in an SQLite database, so that a
+    run only needs to report what has changed since. A bundle is only read
+    again if the modification time or size of its Info.plist has changed;
+    bundles whose Info.plist is untouched are taken to be unchanged.
+    """
+    def __init__(self, path=None):
+        """
+        :param path: the database file (default_snapshot_path() if omitted);
+                     if it cannot be created, the snapshot is kept in memory
+                     (so every bundle is reported as added)
+        """
+        if path is None:
+            path = default_snapshot_path()
+        self.__db, self.path = open_cache_db(path, _SNAPSHOT_SCHEMA, SNAPSHOT_VERSION)
+
+    def close(self):
+        """
+        Close the database.
+        """
+        self.__db.close()
+
+    def records(self):
+        """
+        Yields the record of every bundle in the snapshot.
+        """
+        for (record,) in self.__db.execute('SELECT record FROM snapshot ORDER BY path'):
+            yield json.loads(record)
+
+    def update(self, paths, workers=None, sizes=True):
+        """
+        Compare the snapshot with the bundles on the system and bring it up to
+        date, yielding a Change for each bundle that was added, removed or
+        changed. The snapshot is only saved once every change has been
+        yielded, so a run which is interrupted reports the same changes
+        again the next time.
+
+        :param paths: the bundles on the system now, e.g. from discover()
+        :param workers: how many bundles to read at a time
+        :param sizes: whether to add up the size of each bundle
+        """
+        db = self.__db
+        seen = set()
+        stale = []
+        for path in paths:
+            if path in seen:
+                continue
+            seen.add(path)
+            signature = _signature(path)
+            row = db.execute('SELECT plist_mtime, plist_size FROM snapshot WHERE path = ?', (path,)).fetchone()
+            if row is None or signature is None or tuple(row) != signature:
+                stale.append((path, sizes))
+
+        try:
+            for path, signature, record in run_pool(_snapshot_task, stale, workers):
+                row = db.execute('SELECT record FROM snapshot WHERE path = ?', (path,)).fetchone()
+                previous = json.loads(row[0]) if row is not None else None
+                if record is None:
+                    # No longer a readable bundle, which counts as removed.
+                    seen.discard(path)
+                    continue
+                db.execute('INSERT OR REPLACE INTO snapshot (path, plist_mtime, plist_size, record) VALUES (?, ?, ?, ?)',
+                           (path, signature[0], signature[1], json.dumps(record, sort_keys=True)))
+                if previous is None:
+                    yield Change(ADDED, path, record, None)
+                elif _changed(previous, record, sizes):
+                    yield Change(CHANGED, path, record, previous)
+
+            for path, record in db.execute('SELECT path, record FROM snapshot').fetchall():
+                if path not in seen:
+                    db.execute('DELETE FROM snapshot WHERE path = ?', (path,))
+                    yield Change(REMOVED, path, None, json.loads(record))
+            db.commit()
+        finally:
+            # Only reached without a commit if the caller stopped early (or
+            # something went wrong); forget the partial update.
+            db.rollback()
+
+
+def delta_records(changes):
+    """
+    Turn Changes into records which can be written out like any other, with
+    an extra 'change' field (see DELTA_FIELDS). A removed bundle is reported
+    with its record from the snapshot.
+
+    :param changes: an iterable of Changes, e.g. from InventorySnapshot.update()
+    """
+    for change in changes:
+        record = dict(change.record if change.record is not None else change.previous)
+        record['change'] = change.change
+        yield record
@@ -0,0 +1,623 @@
+####
+#
+# This module reads and writes binary property lists ("bplist00") without
+# calling out to `defaults` or `plutil`. The standard library's `plistlib` only
+# understands XML plists on Python 2.7, so the binary format is handled here.
+#
+# Values are returned in the same form that `plistlib` uses for XML plists:
+# dictionaries, lists, strings, integers, floats, booleans, naive UTC datetimes,
+# and `plistlib.Data` objects for raw data. That way a plist can be read in one
+# format and written back out in the other.
+#
+####
+
+## Imports
+import binascii
+import datetime
+import mmap
+import numbers
+import plistlib
+import struct
+
+HEADER = b'bplist00'
+TRAILER_SIZE = 32
+
+# Dates in binary plists are stored as seconds relative to this point.
+EPOCH = datetime.datetime(2001, 1, 1)
+
+
+class InvalidPlistError(ValueError):
+    """
+    Raised when a file does not contain a well-formed binary plist.
+    """
+    pass
+
+
+class UID(object):
+    """
+    A keyed-archiver object reference. These only appear in binary plists made
+    by NSKeyedArchiver and have no XML equivalent.
+    """
+    def __init__(self, data):
+        self.data = data
+
+    def __eq__(self, other):
+        return isinstance(other, UID) and self.data == other.data
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.data)
+
+    def __repr__(self):
+        return "UID({})".format(self.data)
+
+
+def is_binary(data):
+    """
+    :param data: the leading bytes of a file
+    :return: whether the bytes look like the start of a binary plist
+    """
+    return data[:len(HEADER)] == HEADER
+
+
+def read(data):
+    """
+    Decode a complete binary plist.
+
+    :param data: a string (or other buffer) containing the whole file
+    :return: the root object of the plist
+    """
+    return BinaryPlistReader(data).root()
+
+
+def dumps(root):
+    """
+    Encode an object as a binary plist.
+
+    :param root: the object to encode
+    :return: the encoded plist as a string
+    """
+    return _BinaryPlistWriter(root).encode()
+
+
+def write(root, fileobj):
+    """
+    Encode an object as a binary plist and write it to an open file.
+
+    :param root: the object to encode
+    :param fileobj: a file-like object opened for binary writing
+    """
+    fileobj.write(dumps(root))
+
+
+def _unpack_uint(data):
+    """
+    :param data: a big-endian unsigned integer of any width
+    :return: the integer's value
+    """
+    size = len(data)
+    if size == 1:
+        return struct.unpack('>B', data)[0]
+    elif size == 2:
+        return struct.unpack('>H', data)[0]
+    elif size == 4:
+        return struct.unpack('>L', data)[0]
+    elif size == 8:
+        return struct.unpack('>Q', data)[0]
+    return int(binascii.hexlify(data), 16)
+
+
+def _key_encodings(key):
+    """
+    :param key: a dictionary key
+    :return: the encoded string objects (marker, length, and contents) the key
+             could be stored as: ASCII if possible, and UTF-16
+    """
+    if isinstance(key, str):
+        try:
+            key.decode('ascii')
+        except UnicodeError:
+            key = key.decode('utf-8')
+    encodings = []
+    try:
+        ascii = key.encode('ascii')
+        encodings.append(_BinaryPlistWriter._count(0x5, len(ascii)) + ascii)
+    except UnicodeError:
+        pass
+    utf16 = key.encode('utf-16-be')
+    encodings.append(_BinaryPlistWriter._count(0x6, len(utf16) // 2) + utf16)
+    return encodings
+
+
+class BinaryPlistReader(object):
+    """
+    Decodes objects out of a binary plist. The trailer and offset table are
+    parsed up front; objects themselves are decoded on request by their index
+    in the offset table.
+    """
+    def __init__(self, data):
+        """
+        :param data: a string (or other buffer) containing the whole file
+        """
+        if len(data) < len(HEADER) + TRAILER_SIZE or not is_binary(data):
+            raise InvalidPlistError("Not a binary plist.")
+        self.data = data
+        (
+            self.offset_size,
+            self.ref_size,
+            self.num_objects,
+            self.top_object,
+            self.offset_table_offset
+        ) = struct.unpack('>6xBBQQQ', data[-TRAILER_SIZE:])
+        if (self.offset_size not in (1, 2, 4, 8) or
+                self.ref_size not in (1, 2, 4, 8) or
+                self.top_object >= self.num_objects or
+                self.offset_table_offset < len(HEADER) or
+                self.offset_table_offset + self.num_objects * self.offset_size > len(data) - TRAILER_SIZE):
+            raise InvalidPlistError("Corrupt binary plist trailer.")
+        # Objects and the offset table lie between the header and the trailer.
+        self.end = len(data) - TRAILER_SIZE
+
+    @classmethod
+    def from_path(cls, path):
+        """
+        Create a reader over a read-only memory map of the file at 'path'. Only
+        the pages holding the trailer, the offset table entries, and the objects
+        actually decoded are brought into memory, so reading a few keys from a
+        very large plist costs about as much as reading them from a small one.
+
+        The reader should be closed when it is no longer needed (or used in a
+        'with' statement).
+
+        :param path: the location of the binary plist
+        :return: a BinaryPlistReader
+        """
+        with open(path, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return cls(mapping)
+        except:
+            mapping.close()
+            raise
+
+    def close(self):
+        """
+        Release the underlying memory map, if there is one.
+        """
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def root(self):
+        """
+        :return: the fully-decoded root object
+        """
+        return self.object(self.top_object)
+
+    def _slice(self, start, length):
+        """
+        :return: the 'length' bytes of the file beginning at 'start'
+        :raises InvalidPlistError: if they do not all lie between the header
+                                   and the trailer
+        """
+        if start < len(HEADER) or length < 0 or start + length > self.end:
+            raise InvalidPlistError("Object data at offset {} out of range.".format(start))
+        return self.data[start:start + length]
+
+    def offset(self, ref):
+        """
+        :param ref: an object reference
+        :return: the position in the file where that object begins
+        """
+        if not 0 <= ref < self.num_objects:
+            raise InvalidPlistError("Object reference {} out of range.".format(ref))
+        start = self.offset_table_offset + ref * self.offset_size
+        position = _unpack_uint(self.data[start:start + self.offset_size])
+        if not len(HEADER) <= position < self.end:
+            raise InvalidPlistError("Object offset {} out of range.".format(position))
+        return position
+
+    def marker(self, ref):
+        """
+        :param ref: an object reference
+        :return: a tuple of (object type nibble, object info nibble, position
+                 immediately following the marker byte)
+        """
+        position = self.offset(ref)
+        marker = ord(self.data[position:position + 1])
+        return marker >> 4, marker & 0x0F, position + 1
+
+    def _count(self, info, position):
+        """
+        Containers, strings, and data store their length in the marker's low
+        nibble, or in a trailing integer object if the length is 15 or more.
+
+        :return: a tuple of (count, position of the object's contents)
+        """
+        if info != 0x0F:
+            return info, position
+        marker = ord(self._slice(position, 1))
+        if marker >> 4 != 0x1:
+            raise InvalidPlistError("Malformed object length.")
+        size = 1 << (marker & 0x0F)
+        start = position + 1
+        return _unpack_uint(self._slice(start, size)), start + size
+
+    def _refs(self, start, count):
+        """
+        :return: a list of 'count' object references beginning at 'start'
+        :raises InvalidPlistError: if any of them is out of range
+        """
+        size = self.ref_size
+        data = self._slice(start, size * count)
+        refs = [_unpack_uint(data[i:i + size]) for i in range(0, size * count, size)]
+        for ref in refs:
+            if ref >= self.num_objects:
+                raise InvalidPlistError("Object reference {} out of range.".format(ref))
+        return refs
+
+    def container(self, ref):
+        """
+        Decode only the structure of a container: its child references, but
+        none of the children themselves.
+
+        :param ref: an object reference
+        :return: a tuple of ('array', [value refs]) or ('dict', [key refs],
+                 [value refs]), or None if the object is not a container
+        """
+        kind, info, position = self.marker(ref)
+        if kind == 0xA:
+            count, start = self._count(info, position)
+            return ('array', self._refs(start, count))
+        if kind == 0xD:
+            count, start = self._count(info, position)
+            refs = self._refs(start, 2 * count)
+            return ('dict', refs[:count], refs[count:])
+        return None
+
+    def find(self, components):
+        """
+        Follow a path of dictionary keys and array indexes from the root object
+        without decoding anything that is not on that path. Dictionary keys are
+        compared in their encoded form, so not even the keys are decoded.
+
+        :param components: a sequence of dictionary keys and array indexes
+                           (indexes may be given as strings of digits)
+        :return: the reference of the object at the end of the path
+        :raises KeyError: if the path does not exist
+        """
+        ref = self.top_object
+        for component in components:
+            container = self.container(ref)
+            if container is None:
+                raise KeyError(component)
+            if container[0] == 'array':
+                try:
+                    ref = container[1][int(component)]
+                except (ValueError, IndexError):
+                    raise KeyError(component)
+            else:
+                ref = self._find_key(component, container[1], container[2])
+        return ref
+
+    def _find_key(self, key, key_refs, value_refs):
+        """
+        Find a key among a dictionary's keys by comparing the raw bytes of each
+        key object with the key's encoded form. This relies on lengths being
+        stored with the smallest integer that holds them, which is how both
+        CoreFoundation and this module write them.
+
+        :return: the reference of the value stored under 'key'
+        :raises KeyError: if the dictionary does not contain 'key'
+        """
+        data = self.data
+        base = self.offset_table_offset
+        size = self.offset_size
+        end = self.end
+        fmt = {1: '>B', 2: '>H', 4: '>L', 8: '>Q'}[size]
+        unpack = struct.unpack
+        for encoded in _key_encodings(key):
+            length = len(encoded)
+            for key_ref, value_ref in zip(key_refs, value_refs):
+                # The references came from _refs(), so only the offsets need
+                # checking.
+                start = base + key_ref * size
+                position = unpack(fmt, data[start:start + size])[0]
+                if not len(HEADER) <= position < end:
+                    raise InvalidPlistError("Object offset {} out of range.".format(position))
+                if data[position:min(position + length, end)] == encoded:
+                    return value_ref
+        raise KeyError(key)
+
+    def keys(self, components=()):
+        """
+        :param components: the path to a dictionary (the root by default)
+        :return: the dictionary's keys, without decoding any of its values
+        :raises KeyError: if the path does not lead to a dictionary
+        """
+        container = self.container(self.find(components))
+        if container is None or container[0] != 'dict':
+            raise KeyError(components[-1] if components else None)
+        return [self.object(k) for k in container[1]]
+
+    def iter_items(self, components=()):
+        """
+        Walk the object at the end of the path one value at a time, without
+        building the containers it holds.
+
+        :param components: the path to start from (the root by default)
+        :return: a generator of (key path, value) tuples, one for each value
+                 that is not a container and one for each empty container; key
+                 paths are tuples of keys and integer indexes relative to the
+                 starting point
+        """
+        # Each entry carries the containers above it, so that a container
+        # which (directly or not) holds itself is caught instead of walked
+        # forever.
+        stack = [((), self.find(components), frozenset())]
+        while stack:
+            path, ref, ancestors = stack.pop()
+            container = self.container(ref)
+            if container is None:
+                yield path, self.object(ref)
+                continue
+            if ref in ancestors:
+                raise InvalidPlistError("Object {} contains itself.".format(ref))
+            ancestors = ancestors | frozenset([ref])
+            if container[0] == 'array':
+                if not container[1]:
+                    yield path, []
+                children = [(path + (i,), r, ancestors) for i, r in enumerate(container[1])]
+                stack.extend(reversed(children))
+            else:
+                if not container[1]:
+                    yield path, {}
+                children = [(path + (self.object(k),), v, ancestors) for k, v in zip(container[1], container[2])]
+                stack.extend(reversed(children))
+
+    def lookup(self, components):
+        """
+        :param components: a sequence of dictionary keys and array indexes
+        :return: the decoded object at the end of the path
+        :raises KeyError: if the path does not exist
+        """
+        return self.object(self.find(components))
+
+    def object(self, ref):
+        """
+        Decode the object with the given reference, along with everything it
+        contains.
+
+        :param ref: an object reference
+        :return: the decoded value
+        :raises InvalidPlistError: if the object is malformed or contains
+                                   itself
+        """
+        try:
+            return self._object(ref, set())
+        except RuntimeError:
+            # Nesting deeper than the interpreter's recursion limit; a
+            # well-formed plist never gets anywhere near it.
+            raise InvalidPlistError("Objects nested too deeply.")
+
+    def _object(self, ref, ancestors):
+        """
+        :param ref: an object reference
+        :param ancestors: the references of the containers currently being
+                          decoded; 'ref' appearing among them means the plist
+                          refers back to itself
+        :return: the decoded value
+        """
+        kind, info, position = self.marker(ref)
+        data = self._slice
+
+        if kind == 0x0:
+            if info == 0x8:
+                return False
+            elif info == 0x9:
+                return True
+            elif info in (0x0, 0xF):
+                return None
+        elif kind == 0x1:
+            size = 1 << info
+            value = _unpack_uint(data(position, size))
+            # 8-byte integers are signed; 16-byte integers hold values which
+            # do not fit into a signed 64-bit integer.
+            if size == 8 and value >= 1 << 63:
+                value -= 1 << 64
+            return value
+        elif kind == 0x2:
+            if info == 0x2:
+                return struct.unpack('>f', data(position, 4))[0]
+            elif info == 0x3:
+                return struct.unpack('>d', data(position, 8))[0]
+        elif kind == 0x3 and info == 0x3:
+            seconds = struct.unpack('>d', data(position, 8))[0]
+            return EPOCH + datetime.timedelta(seconds=seconds)
+        elif kind == 0x4:
+            count, start = self._count(info, position)
+            return plistlib.Data(data(start, count))
+        elif kind == 0x5:
+            count, start = self._count(info, position)
+            return data(start, count)
+        elif kind == 0x6:
+            count, start = self._count(info, position)
+            value = data(start, 2 * count).decode('utf-16-be')
+            # Match plistlib, which hands back plain strings when possible.
+            try:
+                return value.encode('ascii')
+            except UnicodeError:
+                return value
+        elif kind == 0x8:
+            return UID(_unpack_uint(data(position, info + 1)))
+        elif kind in (0xA, 0xD):
+            if ref in ancestors:
+                raise InvalidPlistError("Object {} contains itself.".format(ref))
+            count, start = self._count(info, position)
+            ancestors.add(ref)
+            try:
+                if kind == 0xA:
+                    return [self._object(r, ancestors) for r in self._refs(start, count)]
+                refs = self._refs(start, 2 * count)
+                return dict(
+                    (self._object(k, ancestors), self._object(v, ancestors))
+                    for k, v in zip(refs[:count], refs[count:])
+                )
+            finally:
+                ancestors.discard(ref)
+
+        raise InvalidPlistError("Unknown object marker 0x{:x}{:x}.".format(kind, info))
+
+
+class _BinaryPlistWriter(object):
+    """
+    Flattens an object graph into the binary plist object table. Identical
+    scalar values are stored once and shared by reference.
+    """
+    def __init__(self, root):
+        self.objects = []
+        self.refs = {}
+        self.flatten(root)
+
+    @staticmethod
+    def _identity(value):
+        """
+        :return: a key identifying equal scalar values for de-duplication, or
+                 None if the value must be stored separately
+        """
+        if isinstance(value, plistlib.Data):
+            return ('data', value.data)
+        if isinstance(value, (dict, list, tuple)):
+            return None
+        # Types are included so that 1, 1.0 and True stay distinct.
+        return (type(value), value)
+
+    def flatten(self, value):
+        """
+        Append the value (and everything in it) to the object table.
+
+        :return: the value's object reference
+        """
+        identity = self._identity(value)
+        if identity is not None and identity in self.refs:
+            return self.refs[identity]
+
+        ref = len(self.objects)
+        self.objects.append(None)
+        if identity is not None:
+            self.refs[identity] = ref
+
+        if isinstance(value, dict):
+            keys = sorted(value.keys())
+            for key in keys:
+                if not isinstance(key, basestring):
+                    raise TypeError("Dictionary keys must be strings.")
+            key_refs = [self.flatten(k) for k in keys]
+            value_refs = [self.flatten(value[k]) for k in keys]
+            self.objects[ref] = ('dict', key_refs, value_refs)
+        elif isinstance(value, (list, tuple)):
+            self.objects[ref] = ('array', [self.flatten(v) for v in value])
+        else:
+            self.objects[ref] = value
+        return ref
+
+    def encode(self):
+        """
+        :return: the complete binary plist as a string
+        """
+        count = len(self.objects)
+        ref_size = 1 if count < 1 << 8 else 2 if count < 1 << 16 else 4
+        ref_format = {1: '>B', 2: '>H', 4: '>L'}[ref_size]
+
+        chunks = [HEADER]
+        position = len(HEADER)
+        offsets = []
+        for value in self.objects:
+            offsets.append(position)
+            if isinstance(value, tuple) and value and value[0] == 'dict':
+                refs = value[1] + value[2]
+                chunk = self._count(0xD, len(value[1]))
+                chunk += b''.join(struct.pack(ref_format, r) for r in refs)
+            elif isinstance(value, tuple) and value and value[0] == 'array':
+                chunk = self._count(0xA, len(value[1]))
+                chunk += b''.join(struct.pack(ref_format, r) for r in value[1])
+            else:
+                chunk = self._scalar(value)
+            chunks.append(chunk)
+            position += len(chunk)
+
+        table_offset = position
+        offset_size = 1 if position < 1 << 8 else 2 if position < 1 << 16 else 4 if position < 1 << 32 else 8
+        offset_format = {1: '>B', 2: '>H', 4: '>L', 8: '>Q'}[offset_size]
+        chunks.extend(struct.pack(offset_format, o) for o in offsets)
+        chunks.append(struct.pack('>6xBBQQQ', offset_size, ref_size, count, 0, table_offset))
+        return b''.join(chunks)
+
+    @classmethod
+    def _count(cls, kind, count):
+        """
+        :return: a marker byte of the given kind carrying 'count'
+        """
+        if count < 0x0F:
+            return struct.pack('>B', kind << 4 | count)
+        return struct.pack('>B', kind << 4 | 0x0F) + cls._int(count)
+
+    @staticmethod
+    def _int(value):
+        if value < 0:
+            return struct.pack('>Bq', 0x13, value)
+        elif value < 1 << 8:
+            return struct.pack('>BB', 0x10, value)
+        elif value < 1 << 16:
+            return struct.pack('>BH', 0x11, value)
+        elif value < 1 << 32:
+            return struct.pack('>BL', 0x12, value)
+        elif value < 1 << 63:
+            return struct.pack('>Bq', 0x13, value)
+        elif value < 1 << 64:
+            return struct.pack('>BQQ', 0x14, 0, value)
+        raise OverflowError("Integer {} is too large for a plist.".format(value))
+
+    def _scalar(self, value):
+        if value is None:
+            raise TypeError("Plists cannot store None.")
+        elif value is False:
+            return b'\x08'
+        elif value is True:
+            return b'\x09'
+        elif isinstance(value, numbers.Integral):
+            return self._int(value)
+        elif isinstance(value, float):
+            return struct.pack('>Bd', 0x23, value)
+        elif isinstance(value, datetime.datetime):
+            delta = value - EPOCH
+            seconds = delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+            return struct.pack('>Bd', 0x33, seconds)
+        elif isinstance(value, plistlib.Data):
+            return self._count(0x4, len(value.data)) + value.data
+        elif isinstance(value, UID):
+            size = 1 if value.data < 1 << 8 else 2 if value.data < 1 << 16 else 4 if value.data < 1 << 32 else 8
+            return struct.pack('>B', 0x80 | (size - 1)) + struct.pack(
+                {1: '>B', 2: '>H', 4: '>L', 8: '>Q'}[size], value.data
+            )
+        elif isinstance(value, basestring):
+            if isinstance(value, str):
+                try:
+                    value.decode('ascii')
+                    return self._count(0x5, len(value)) + value
+                except UnicodeError:
+                    value = value.decode('utf-8')
+            try:
+                encoded = value.encode('ascii')
+                return self._count(0x5, len(encoded)) + encoded
+            except UnicodeError:
+                encoded = value.encode('utf-16-be')
+                return self._count(0x6, len(encoded) // 2) + encoded
+        raise TypeError("Unsupported plist type: {}".format(type(value).__name__))
@@ -0,0 +1,80 @@
+####
+#
+# This module decides where the package keeps its caches (the application
+# index, file hashes, directory sizes, capacity history...), opens the SQLite
+# databases they are kept in, and helps query those by directory, so that
+# modules which only need a place to write do not have to import one another.
+#
+####
+
+## Imports
+import os
+import sqlite3
+
+# Where caches are kept. If the current user cannot write to ELEVATED_PATH,
+# LOCAL_PATH is used instead.
+ELEVATED_PATH = '/Library/Caches/Management/'
+LOCAL_PATH    = '~/Library/Caches/Management/'
+
+
+def default_cache_dir():
+    """
+    :return: the directory where caches are kept for the current user (which
+             may not exist yet)
+    """
+    if os.access(os.path.dirname(ELEVATED_PATH[:-1]), os.W_OK):
+        return ELEVATED_PATH
+    return os.path.expanduser(LOCAL_PATH)
+
+
+def prefix_range(directory):
+    """
+    :return: a tuple of (low, high) such that the paths under the directory are
+             exactly those with low <= path < high, so that a query can use
+             the index on 'path' rather than scanning every row ('0' is the
+             character after '/')
+    """
+    directory = directory.rstrip('/')
+    return directory + '/', directory + '0'
+
+
+def open_cache_db(path, schema, version=None):
+    """
+    Open a cache database, creating it (and the directory it is in) if need
+    be. A cache can always be rebuilt, so if the file cannot be opened the
+    cache is kept in memory instead.
+
+    :param path: the database file, or ':memory:'
+    :param schema: the SQL script creating the cache's tables and indexes
+                   (with IF NOT EXISTS)
+    :param version: the version of the schema; if the database was created
+                    with a different one, its tables are dropped first
+    :return: a tuple of (the connection, the path actually used)
+    """
+    directory = os.path.dirname(path)
+    try:
+        if path != ':memory:' and directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        return _open(path, schema, version), path
+    except (OSError, sqlite3.Error):
+        return _open(':memory:', schema, version), ':memory:'
+
+
+def _open(path, schema, version):
+    db = sqlite3.connect(path, check_same_thread=False)
+    try:
+        db.text_factory = str
+        if version is not None and db.execute('PRAGMA user_version').fetchone()[0] != version:
+            # SQLite's own tables (such as sqlite_sequence) cannot be dropped.
+            tables = db.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite\\_%' ESCAPE '\\'"
+            ).fetchall()
+            for (table,) in tables:
+                db.execute('DROP TABLE IF EXISTS "{}"'.format(table))
+            db.execute('PRAGMA user_version = {}'.format(version))
+        db.executescript(schema)
+        db.commit()
+    except:
+        db.close()
+        raise
+    return db
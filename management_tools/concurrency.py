@@ -0,0 +1,38 @@
+####
+#
+# This module runs work over a pool of threads or processes, for the modules
+# which read many plists, bundles, binaries or directories at a time. It has
+# no dependencies of its own, so that using a pool does not mean importing
+# the plist modules.
+#
+####
+
+## Imports
+import multiprocessing
+import multiprocessing.pool
+
+
+def run_pool(function, tasks, workers=None, processes=False):
+    """
+    Run a function over tasks on a pool of threads (or processes) and yield
+    the results as they complete. The pool is shut down when the results run
+    out or the caller stops iterating.
+
+    :param function: a module-level function taking a single task
+    :param tasks: an iterable of tasks
+    :param workers: the size of the pool (the number of CPUs if omitted)
+    :param processes: whether to use processes rather than threads
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if processes:
+        pool = multiprocessing.Pool(workers)
+    else:
+        pool = multiprocessing.pool.ThreadPool(workers)
+    try:
+        for result in pool.imap_unordered(function, tasks, 16 if processes else 1):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,289 @@
+####
+#
+# This module computes a fingerprint for an application bundle: a single hash
+# covering the name, type and contents of every file within it, which changes
+# if anything in the bundle is modified, added, removed or renamed.
+#
+# Files are hashed in parallel with large reads, and each file's hash is kept
+# in a cache keyed by its inode, size and modification time. A file whose
+# inode, size and modification time have not changed since it was last hashed
+# is not read again, so fingerprinting a bundle that has not changed only
+# costs a stat() per file.
+#
+####
+
+## Imports
+import collections
+import hashlib
+import os
+import stat
+import threading
+
+from caches import default_cache_dir, open_cache_db, prefix_range
+from concurrency import run_pool
+
+# The cache kept in the cache directory by default.
+CACHE_NAME = 'fingerprints.sqlite'
+
+# How much of a file is read (and hashed) at a time.
+CHUNK_SIZE = 1024 * 1024
+
+DEFAULT_ALGORITHM = 'sha256'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    path      TEXT,
+    algorithm TEXT,
+    inode     INTEGER,
+    size      INTEGER,
+    mtime     REAL,
+    digest    TEXT,
+    PRIMARY KEY (path, algorithm)
+);
+"""
+
+# The result of fingerprinting a bundle. 'files' is the number of files in the
+# bundle, 'hashed' how many of them had to be read, 'bytes' how many bytes
+# were read, and 'failed' how many files (or symbolic links) could not be read.
+Fingerprint = collections.namedtuple('Fingerprint', ['path', 'digest', 'files', 'hashed', 'bytes', 'failed'])
+
+
+def hash_file(path, algorithm=DEFAULT_ALGORITHM):
+    """
+    Hash a file's contents, reading CHUNK_SIZE bytes at a time.
+
+    :param path: the file to hash
+    :param algorithm: the name of a hashlib algorithm
+    :return: the hex digest
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def default_cache_path():
+    """
+    :return: the location of the hash cache for the current user
+    """
+    return os.path.join(default_cache_dir(), CACHE_NAME)
+
+
+class HashCache(object):
+    """
+    A cache of file hashes, kept in an SQLite database. An entry is only used
+    while the file's inode, size and modification time are the same as when
+    it was hashed.
+    """
+    def __init__(self, path=None):
+        """
+        :param path: the database file (default_cache_path() if omitted); if
+                     it cannot be created, the cache is kept in memory
+        """
+        if path is None:
+            path = default_cache_path()
+        self.__db, self.path = open_cache_db(path, _SCHEMA)
+        self.__lock = threading.Lock()
+
+    def close(self):
+        """
+        Close the database.
+        """
+        with self.__lock:
+            self.__db.close()
+
+    def get(self, path, info, algorithm=DEFAULT_ALGORITHM):
+        """
+        :param path: the file
+        :param info: the file's current os.stat() result
+        :param algorithm: the hash algorithm
+        :return: the cached digest, or None if there is none or the file has
+                 changed since
+        """
+        with self.__lock:
+            row = self.__db.execute(
+                'SELECT inode, size, mtime, digest FROM hashes WHERE path = ? AND algorithm = ?',
+                (path, algorithm)
+            ).fetchone()
+        if row is None or tuple(row[:3]) != (info.st_ino, info.st_size, info.st_mtime):
+            return None
+        return row[3]
+
+    def entries(self, directory, algorithm=DEFAULT_ALGORITHM):
+        """
+        Get every entry for the files under a directory in one query.
+
+        :param directory: the directory
+        :param algorithm: the hash algorithm
+        :return: a dictionary mapping each path to (inode, size, mtime, digest)
+        """
+        low, high = prefix_range(directory)
+        with self.__lock:
+            rows = self.__db.execute(
+                'SELECT path, inode, size, mtime, digest FROM hashes WHERE path >= ? AND path < ? AND algorithm = ?',
+                (low, high, algorithm)
+            ).fetchall()
+        return dict((row[0], tuple(row[1:])) for row in rows)
+
+    def put_many(self, entries, algorithm=DEFAULT_ALGORITHM):
+        """
+        Store many digests in a single transaction.
+
+        :param entries: an iterable of (path, os.stat() result, digest)
+        :param algorithm: the hash algorithm
+        """
+        with self.__lock:
+            with self.__db:
+                self.__db.executemany(
+                    'INSERT OR REPLACE INTO hashes (path, algorithm, inode, size, mtime, digest) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    ((path, algorithm, info.st_ino, info.st_size, info.st_mtime, digest)
+                     for path, info, digest in entries)
+                )
+
+    def prune(self, directory, keep):
+        """
+        Forget the files under a directory which are not in 'keep'.
+
+        :param directory: the directory whose entries to prune
+        :param keep: a set of file paths to remember
+        """
+        low, high = prefix_range(directory)
+        with self.__lock:
+            rows = self.__db.execute(
+                'SELECT DISTINCT path FROM hashes WHERE path >= ? AND path < ?', (low, high)
+            ).fetchall()
+            stale = [(path,) for (path,) in rows if path not in keep]
+            if stale:
+                with self.__db:
+                    self.__db.executemany('DELETE FROM hashes WHERE path = ?', stale)
+
+
+def _walk(bundle):
+    """
+    Yields (relative path, type, absolute path, os.lstat() result) for
+    everything under the bundle, in sorted order. Symbolic links are not
+    followed.
+    """
+    for directory, subdirectories, files in os.walk(bundle):
+        subdirectories.sort()
+        relative = os.path.relpath(directory, bundle)
+        for name in sorted(subdirectories + files):
+            path = os.path.join(directory, name)
+            try:
+                info = os.lstat(path)
+            except OSError:
+                continue
+            if stat.S_ISLNK(info.st_mode):
+                kind = 'l'
+            elif stat.S_ISDIR(info.st_mode):
+                kind = 'd'
+            elif stat.S_ISREG(info.st_mode):
+                kind = 'f'
+            else:
+                continue
+            yield os.path.normpath(os.path.join(relative, name)), kind, path, info
+
+
+def _error_digest(error):
+    """
+    :return: what goes in the manifest in place of the hash of a file that
+             could not be read
+    """
+    return '!{}'.format(error.errno)
+
+
+def _hash_task(task):
+    """
+    :return: a tuple of (path, os.lstat() result, digest, whether the file
+             could be read)
+    """
+    path, info, algorithm = task
+    try:
+        return path, info, hash_file(path, algorithm), True
+    except EnvironmentError as e:
+        # The file is unreadable, or was removed or replaced since the walk.
+        return path, info, _error_digest(e), False
+
+
+def fingerprint(bundle, algorithm=DEFAULT_ALGORITHM, workers=None, cache=None):
+    """
+    Compute the fingerprint of a bundle (or any directory). Files are hashed
+    several at a time, and files that have not changed since they were last
+    hashed are taken from the cache.
+
+    The fingerprint is a hash over a manifest with a line for every item in
+    the bundle: its path relative to the bundle, its type, and the hash of its
+    contents (or the target of a symbolic link). A file that cannot be read
+    is listed with the error instead of a hash, so the fingerprint still
+    changes, but it is not cached and is counted in the result's 'failed'.
+
+    :param bundle: the bundle to fingerprint
+    :param algorithm: the name of a hashlib algorithm
+    :param workers: how many files to hash at a time (the number of CPUs if
+                    omitted)
+    :param cache: the HashCache to use; pass False to hash every file
+    :return: a Fingerprint
+    """
+    bundle = os.path.abspath(bundle)
+    if cache is None:
+        cache = shared_cache()
+
+    cached = cache.entries(bundle, algorithm) if cache else {}
+    entries = []
+    digests = {}
+    stale = []
+    failed = 0
+    for relative, kind, path, info in _walk(bundle):
+        entries.append((relative, kind, path))
+        if kind == 'l':
+            try:
+                digests[path] = os.readlink(path)
+            except EnvironmentError as e:
+                digests[path] = _error_digest(e)
+                failed += 1
+        elif kind == 'f':
+            entry = cached.get(path)
+            if entry is not None and entry[:3] == (info.st_ino, info.st_size, info.st_mtime):
+                digests[path] = entry[3]
+            else:
+                stale.append((path, info, algorithm))
+
+    hashed = []
+    read = 0
+    for path, info, digest, ok in (run_pool(_hash_task, stale, workers) if stale else ()):
+        digests[path] = digest
+        if not ok:
+            failed += 1
+            continue
+        hashed.append((path, info, digest))
+        read += info.st_size
+    if cache:
+        cache.put_many(hashed, algorithm)
+        cache.prune(bundle, set(path for relative, kind, path in entries if kind == 'f'))
+
+    manifest = hashlib.new(algorithm)
+    for relative, kind, path in entries:
+        if isinstance(relative, unicode):
+            relative = relative.encode('utf-8')
+        manifest.update('{}\0{}\0{}\n'.format(relative, kind, digests.get(path, '')))
+    files = sum(1 for entry in entries if entry[1] == 'f')
+    return Fingerprint(bundle, manifest.hexdigest(), files, len(hashed), read, failed)
+
+
+_shared_cache = None
+_shared_lock = threading.Lock()
+
+def shared_cache():
+    """
+    :return: the HashCache shared by the whole process, at default_cache_path()
+    """
+    global _shared_cache
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = HashCache()
+        return _shared_cache
@@ -1,26 +1,414 @@
+import collections
+import ctypes
+import ctypes.util
+import heapq
+import multiprocessing
 import os
+import stat
 import subprocess
+import sys
+import threading
+import time
 
+from caches import default_cache_dir, open_cache_db, prefix_range
+from concurrency import run_pool
 
-def get_filesystems():
+# os.scandir() (Python 3.5+) or the 'scandir' backport list a directory faster
+# than os.listdir(). Without either, entries are listed and then lstat()ed.
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+# How the system is polled. The 'native' backend reads the mount table from
+# /proc/self/mountinfo (Linux) or getmntinfo() (OS X) and usage from statfs(),
+# without starting any processes; the 'commands' backend runs `mount` and
+# `df`. The native backend falls back to the commands where it is not
+# available.
+BACKEND_NATIVE   = 'native'
+BACKEND_COMMANDS = 'commands'
+BACKENDS         = [BACKEND_NATIVE, BACKEND_COMMANDS]
+DEFAULT_BACKEND  = BACKEND_NATIVE
+
+MOUNTINFO = '/proc/self/mountinfo'
+
+# One mounted filesystem. 'type' is None if the filesystem type could not be
+# told apart from the other properties. 'device' is the device number that
+# os.stat() reports (st_dev) for everything on the filesystem, or None where
+# the mount table does not say (`mount` output).
+MountEntry = collections.namedtuple('MountEntry', ['name', 'mount_point', 'type', 'properties', 'device'])
+
+# The usage of one filesystem, as `df -P -k` reports it. The numbers are
+# integers (None where they are not known, e.g. inode counts from `df`).
+UsageEntry = collections.namedtuple('UsageEntry', [
+    'name', 'kblocks', 'kblocks_used', 'kblocks_free', 'capacity', 'mount_point',
+    'inodes', 'inodes_used', 'inodes_free',
+])
+
+
+def get_filesystems(backend=None):
     """
-    Get all of the currently-mounted filesystems, both local and remote.
+    Get all of the currently-mounted filesystems, both local and remote. The
+    mount table and usage are gathered once, and every Filesystem is built
+    from that same snapshot.
     
+    :param backend: one of BACKENDS (DEFAULT_BACKEND if omitted)
     :return: a list of Filesystem objects
     """
-    fs_info = get_raw_fs_info().split('\n')
-    fs_info = [x for x in fs_info if x]
-    filesystem_names = [x.split(' on')[0] for x in fs_info]
+    snapshot = FilesystemSnapshot.take(backend)
     
     filesystems = []
     
-    for name in filesystem_names:
-        filesystem = Filesystem(name)
+    for entry in snapshot.mounts:
+        filesystem = Filesystem(entry.name, snapshot=snapshot, mount_point=entry.mount_point)
         filesystems.append(filesystem)
     
     return filesystems
 
 
+def _parse_mount(output):
+    """
+    Parse the output of `mount`. Both the OS X form:
+        /dev/disk1s1 on /Volumes/External (hfs, local, journaled)
+    and the Linux form:
+        /dev/sda1 on /mnt/external type ext4 (rw,relatime)
+    are understood.
+    
+    :param output: the output of `mount`
+    :return: a list of MountEntry tuples, in the order they were listed
+    """
+    entries = []
+    for line in output.split('\n'):
+        if ' on ' not in line:
+            continue
+        name, rest = line.split(' on ', 1)
+        properties = []
+        if rest.endswith(')') and ' (' in rest:
+            rest, properties = rest[:-1].rsplit(' (', 1)
+            properties = [x.strip() for x in properties.replace(', ', ',').split(',') if x.strip()]
+        fs_type = None
+        if ' type ' in rest:
+            rest, fs_type = rest.rsplit(' type ', 1)
+        elif properties and properties[0].endswith('fs'):
+            fs_type = properties[0]
+        entries.append(MountEntry(name, rest, fs_type, properties, None))
+    return entries
+
+
+def _parse_df(output):
+    """
+    Parse the output of `df -P -k`. Names and mount points may contain spaces,
+    so each line is split around the four numeric columns in the middle.
+    
+    :param output: the output of `df -P -k`
+    :return: a list of UsageEntry tuples, in the order they were listed
+    """
+    def number(value):
+        try:
+            return int(value.rstrip('%'))
+        except ValueError:
+            return None
+    
+    entries = []
+    for line in output.split('\n')[1:]:
+        info = line.split()
+        for index in range(1, len(info) - 4):
+            # The four numeric columns end with the capacity, e.g. '70%'.
+            if (all(number(x) is not None or x == '-' for x in info[index:index + 3])
+                    and (info[index + 3].endswith('%') or info[index + 3] == '-')):
+                entries.append(UsageEntry(
+                    ' '.join(info[:index]),
+                    number(info[index]), number(info[index + 1]), number(info[index + 2]),
+                    number(info[index + 3]),
+                    ' '.join(info[index + 4:]),
+                    None, None, None,
+                ))
+                break
+    return entries
+
+
+def _unescape(field):
+    """
+    :return: a field of /proc/self/mountinfo with its octal escapes (such as
+             '\\040' for a space) decoded
+    """
+    parts = field.split('\\')
+    result = [parts[0]]
+    for part in parts[1:]:
+        if len(part) >= 3 and part[:3].isdigit():
+            result.append(chr(int(part[:3], 8)) + part[3:])
+        else:
+            result.append('\\' + part)
+    return ''.join(result)
+
+
+def _read_mountinfo(path=MOUNTINFO):
+    """
+    Read the mount table from /proc/self/mountinfo, whose lines look like:
+        36 25 8:1 / /mnt/external rw,relatime shared:1 - ext4 /dev/sda1 rw
+        ----- ids ----   mount point  options  optional - type  name  options
+    where the third field is the device number (major:minor).
+    
+    :param path: the mountinfo file
+    :return: a list of MountEntry tuples, in the order they were mounted
+    """
+    entries = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if '-' not in fields:
+                continue
+            separator = fields.index('-')
+            if separator < 6 or len(fields) < separator + 3:
+                continue
+            properties = fields[5].split(',')
+            for option in fields[separator + 3].split(',') if len(fields) > separator + 3 else []:
+                if option not in properties and option not in ('rw', 'ro'):
+                    properties.append(option)
+            try:
+                major, minor = fields[2].split(':')
+                device = os.makedev(int(major), int(minor))
+            except ValueError:
+                device = None
+            entries.append(MountEntry(
+                _unescape(fields[separator + 2]), _unescape(fields[4]), fields[separator + 1], properties, device
+            ))
+    return entries
+
+
+# The mount flags of OS X, in the order `mount` lists them.
+_DARWIN_FLAGS = [
+    (0x00000001, 'read-only'),
+    (0x00000002, 'synchronous'),
+    (0x00000004, 'noexec'),
+    (0x00000008, 'nosuid'),
+    (0x00000010, 'nodev'),
+    (0x00000020, 'union'),
+    (0x00000040, 'asynchronous'),
+    (0x00000080, 'protect'),
+    (0x00000100, 'NFS exported'),
+    (0x00000400, 'quarantine'),
+    (0x00001000, 'local'),
+    (0x00002000, 'with quotas'),
+    (0x00004000, 'root file system'),
+    (0x00100000, 'nobrowse'),
+    (0x00200000, 'noowners'),
+    (0x00400000, 'automounted'),
+    (0x00800000, 'journaled'),
+    (0x01000000, 'nouserxattr'),
+    (0x02000000, 'defwrite'),
+    (0x04000000, 'multilabel'),
+    (0x10000000, 'noatime'),
+]
+
+_MNT_NOWAIT = 2
+
+
+class _Statfs(ctypes.Structure):
+    """
+    The 64-bit 'struct statfs' of OS X.
+    """
+    _fields_ = [
+        ('f_bsize',       ctypes.c_uint32),
+        ('f_iosize',      ctypes.c_int32),
+        ('f_blocks',      ctypes.c_uint64),
+        ('f_bfree',       ctypes.c_uint64),
+        ('f_bavail',      ctypes.c_uint64),
+        ('f_files',       ctypes.c_uint64),
+        ('f_ffree',       ctypes.c_uint64),
+        ('f_fsid',        ctypes.c_int32 * 2),
+        ('f_owner',       ctypes.c_uint32),
+        ('f_type',        ctypes.c_uint32),
+        ('f_flags',       ctypes.c_uint32),
+        ('f_fssubtype',   ctypes.c_uint32),
+        ('f_fstypename',  ctypes.c_char * 16),
+        ('f_mntonname',   ctypes.c_char * 1024),
+        ('f_mntfromname', ctypes.c_char * 1024),
+        ('f_flags_ext',   ctypes.c_uint32),
+        ('f_reserved',    ctypes.c_uint32 * 7),
+    ]
+
+
+def _load_darwin():
+    """
+    :return: a tuple of the getmntinfo() and statfs() functions which use the
+             64-bit struct statfs, or (None, None) if this is not OS X
+    """
+    if sys.platform != 'darwin':
+        return None, None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None, None
+    functions = []
+    for name in ('getmntinfo', 'statfs'):
+        # Intel builds export the 64-bit variants under a suffixed name.
+        for symbol in (name + '$INODE64', name):
+            try:
+                functions.append(getattr(libc, symbol))
+                break
+            except AttributeError:
+                pass
+        else:
+            return None, None
+    getmntinfo, statfs = functions
+    getmntinfo.argtypes = [ctypes.POINTER(ctypes.POINTER(_Statfs)), ctypes.c_int]
+    getmntinfo.restype  = ctypes.c_int
+    statfs.argtypes = [ctypes.c_char_p, ctypes.POINTER(_Statfs)]
+    statfs.restype  = ctypes.c_int
+    return getmntinfo, statfs
+
+_getmntinfo, _statfs = _load_darwin()
+
+
+def _read_getmntinfo():
+    """
+    Read the mount table with getmntinfo(). Unresponsive network filesystems
+    are not waited for.
+    
+    :return: a list of MountEntry tuples
+    """
+    buffer = ctypes.POINTER(_Statfs)()
+    count = _getmntinfo(ctypes.byref(buffer), _MNT_NOWAIT)
+    if count <= 0:
+        raise OSError(ctypes.get_errno(), "getmntinfo() failed.")
+    entries = []
+    for i in range(count):
+        info = buffer[i]
+        properties = [info.f_fstypename] + [name for flag, name in _DARWIN_FLAGS if info.f_flags & flag]
+        # The first half of the filesystem ID is its device number.
+        entries.append(MountEntry(info.f_mntfromname, info.f_mntonname, info.f_fstypename, properties,
+                                  info.f_fsid[0]))
+    return entries
+
+
+def _usage(name, kblocks, kblocks_used, kblocks_free, mount_point, inodes, inodes_free):
+    """
+    :return: a UsageEntry, with the capacity worked out the way `df` does it
+             (the used share of the space available to ordinary users, rounded
+             up)
+    """
+    available = kblocks_used + kblocks_free
+    if available:
+        capacity = (kblocks_used * 100 + available - 1) // available
+    else:
+        capacity = None
+    return UsageEntry(name, kblocks, kblocks_used, kblocks_free, capacity, mount_point,
+                      inodes, inodes - inodes_free, inodes_free)
+
+
+def read_usage(mount_point, name=None):
+    """
+    Get the usage of a mounted filesystem with statfs() (or statvfs()),
+    without running `df`.
+    
+    :param mount_point: where the filesystem is mounted
+    :param name: the filesystem's name, recorded in the result
+    :return: a UsageEntry
+    :raises OSError: if the filesystem cannot be queried
+    """
+    if _statfs is not None:
+        info = _Statfs()
+        if _statfs(mount_point.encode('utf-8') if isinstance(mount_point, unicode) else mount_point,
+                   ctypes.byref(info)) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), mount_point)
+        size = info.f_bsize
+        blocks, free, available = info.f_blocks, info.f_bfree, info.f_bavail
+        inodes, inodes_free = info.f_files, info.f_ffree
+    else:
+        info = os.statvfs(mount_point)
+        size = info.f_frsize or info.f_bsize
+        blocks, free, available = info.f_blocks, info.f_bfree, info.f_bavail
+        inodes, inodes_free = info.f_files, info.f_ffree
+    return _usage(name, blocks * size // 1024, (blocks - free) * size // 1024, available * size // 1024,
+                  mount_point, inodes, inodes_free)
+
+
+def read_mounts():
+    """
+    Read the mount table without running `mount`.
+    
+    :return: a list of MountEntry tuples
+    :raises OSError: if there is no native way to read it on this system
+    """
+    if _getmntinfo is not None:
+        return _read_getmntinfo()
+    if os.path.exists(MOUNTINFO):
+        return _read_mountinfo()
+    raise OSError("The mount table cannot be read natively on this system.")
+
+
+def native_available():
+    """
+    :return: whether the native backend can be used on this system
+    """
+    return _getmntinfo is not None or os.path.exists(MOUNTINFO)
+
+
+class FilesystemSnapshot(object):
+    """
+    The mount table and usage of every filesystem, gathered at one moment.
+    With the commands backend, `mount` and `df` are each run once; with the
+    native backend, the mount table is read directly and each filesystem's
+    usage is asked for (with statfs()) only when it is first needed.
+    Building Filesystem objects from a snapshot costs no further subprocesses.
+    """
+    def __init__(self, mounts, usage=None):
+        """
+        :param mounts: a list of MountEntry tuples
+        :param usage: a list of UsageEntry tuples (None to ask for each
+                      filesystem's usage with statfs() when it is needed)
+        """
+        self.mounts = mounts
+        self.native = usage is None
+        self.usage  = dict((entry.mount_point, entry) for entry in usage or [])
+    
+    @classmethod
+    def take(cls, backend=None):
+        """
+        :param backend: one of BACKENDS (DEFAULT_BACKEND if omitted)
+        :return: a snapshot of the filesystems mounted right now
+        """
+        mounts = _mount_table(backend)
+        if (backend or DEFAULT_BACKEND) == BACKEND_NATIVE and native_available():
+            return cls(mounts)
+        return cls(mounts, _parse_df(get_raw_fs_usage()))
+    
+    def get_usage(self, mount_point):
+        """
+        :param mount_point: where a filesystem is mounted
+        :return: the filesystem's UsageEntry, or None if it is not known
+        """
+        if self.native and mount_point not in self.usage:
+            names = [x.name for x in self.mounts if x.mount_point == mount_point]
+            try:
+                self.usage[mount_point] = read_usage(mount_point, names[-1] if names else None)
+            except OSError:
+                self.usage[mount_point] = None
+        return self.usage.get(mount_point)
+    
+    def find(self, name, mount_point=None):
+        """
+        :param name: the name of a mounted filesystem
+        :param mount_point: where it is mounted, for filesystems (such as
+                            'tmpfs') which share a name
+        :return: the filesystem's MountEntry
+        """
+        result = [x for x in self.mounts if x.name == name]
+        if mount_point is not None:
+            # A filesystem mounted over another at the same place hides it.
+            result = [x for x in result if x.mount_point == mount_point][-1:]
+        if len(result) > 1:
+            raise RuntimeError("Too many matches for filesystem '{}'.".format(name))
+        elif len(result) == 0:
+            raise RuntimeError("No matches for filesystem '{}'.".format(name))
+        return result[0]
+
+
 def get_raw_fs_info(fs=None, strict=False):
     """
     Obtain the output from `mount`. This can either be generic and include all
@@ -82,94 +470,782 @@ def get_raw_fs_usage(mount_point=None):
     return df_info[1]
 
 
-def get_responsible_fs(target):
+def _mount_table(backend=None):
+    """
+    :param backend: one of BACKENDS (DEFAULT_BACKEND if omitted)
+    :return: a list of MountEntry tuples for the filesystems mounted right now
+    """
+    if backend is None:
+        backend = DEFAULT_BACKEND
+    if not backend in BACKENDS:
+        raise ValueError("Backend not valid.  Must be one of " + str(BACKENDS))
+    if backend == BACKEND_NATIVE and native_available():
+        return read_mounts()
+    return _parse_mount(get_raw_fs_info())
+
+
+def _mount_key(mount_point):
+    """
+    :return: a mount point in the form MountIndex compares paths with
+    """
+    return mount_point.rstrip('/') or '/'
+
+
+class MountIndex(object):
+    """
+    Finds which mount a path lives on, the way `df` does: by the device the
+    path is on, rather than by which mount point it happens to be below. (On
+    OS X, firmlinks put '/Users' on the Data volume, mounted at
+    '/System/Volumes/Data', although it is below '/'.) Mounts are kept in
+    dictionaries by device and by mount point, so a lookup costs a stat() of
+    the path and a few dictionary lookups.
+    
+    Where several mounts are of the same device (bind mounts), the one with
+    the longest mount point containing the path is chosen. Only if no mount
+    is of the path's device is the longest mount point containing the path
+    used regardless. Mounts whose device the mount table does not give
+    (parsed `mount` output) have their mount points stat()ed once, on the
+    first lookup.
+    """
+    def __init__(self, mounts):
+        """
+        :param mounts: a list of MountEntry tuples, in the order they were
+                       mounted
+        """
+        self.mounts = list(mounts)
+        self.__points  = {}
+        self.__devices = {}
+        self.__unknown = []
+        for entry in self.mounts:
+            self.__points.setdefault(_mount_key(entry.mount_point), []).append(entry)
+            if entry.device is None:
+                self.__unknown.append(entry)
+            else:
+                self.__devices.setdefault(entry.device, []).append(entry)
+        self.__lock = threading.Lock()
+    
+    def __stat_unknown(self):
+        """
+        File the mounts without a known device under their mount points'.
+        """
+        with self.__lock:
+            for entry in self.__unknown:
+                try:
+                    device = os.stat(entry.mount_point).st_dev
+                except OSError:
+                    continue
+                self.__devices.setdefault(device, []).append(entry)
+            self.__unknown = []
+    
+    def __ancestors(self, path):
+        """
+        Yields the mounts on the path and each of its parent directories,
+        longest mount point first (and the most recent mount on each first).
+        """
+        while True:
+            for entry in reversed(self.__points.get(path, ())):
+                yield entry
+            parent = os.path.dirname(path)
+            if parent == path:
+                return
+            path = parent
+    
+    def __statfs_entry(self, path):
+        """
+        :return: the mount statfs() says the path is on (OS X only), or None
+        """
+        info = _Statfs()
+        if _statfs(path.encode('utf-8') if isinstance(path, unicode) else path, ctypes.byref(info)) != 0:
+            return None
+        entries = self.__points.get(_mount_key(info.f_mntonname), [])
+        for entry in reversed(entries):
+            if entry.name == info.f_mntfromname:
+                return entry
+        return entries[-1] if entries else None
+    
+    def lookup(self, path):
+        """
+        :param path: a file or directory
+        :return: the MountEntry of the filesystem the path lives on, or None
+        :raises OSError: if the path cannot be stat()ed
+        """
+        path = os.path.realpath(path)
+        if _statfs is not None:
+            entry = self.__statfs_entry(path)
+            if entry is not None:
+                return entry
+        device = os.stat(path).st_dev
+        if self.__unknown:
+            self.__stat_unknown()
+        candidates = self.__devices.get(device)
+        for entry in self.__ancestors(path):
+            if not candidates:
+                return entry
+            if entry in candidates:
+                return entry
+        # On the device, but not below any of its mount points.
+        return candidates[-1] if candidates else None
+    
+    def lookup_many(self, paths):
+        """
+        :param paths: an iterable of files and directories
+        :return: a list of the MountEntry of each path, in the same order
+                 (None for paths which do not exist or cannot be placed)
+        """
+        entries = []
+        for path in paths:
+            try:
+                entries.append(self.lookup(path))
+            except OSError:
+                entries.append(None)
+        return entries
+
+
+_mount_index = None
+_mount_index_lock = threading.Lock()
+
+def get_mount_index(backend=None):
+    """
+    Get a MountIndex of the filesystems mounted right now. The mount table is
+    read on every call, but the index (and what it has learned about each
+    mount point's device) is only rebuilt when the table has changed.
+    
+    :param backend: one of BACKENDS (DEFAULT_BACKEND if omitted)
+    :return: a MountIndex
+    """
+    global _mount_index
+    mounts = _mount_table(backend)
+    with _mount_index_lock:
+        if _mount_index is None or _mount_index.mounts != mounts:
+            _mount_index = MountIndex(mounts)
+        return _mount_index
+
+
+def get_responsible_filesystems(targets, backend=None):
+    """
+    Given many targets on disk, determines which filesystem is responsible
+    for each of them, reading the mount table only once.
+    
+    :param targets: an iterable of files and directories to locate
+    :param backend: one of BACKENDS (DEFAULT_BACKEND if omitted)
+    :return: a list of the names of the filesystems, in the same order as the
+             targets (None for targets which do not exist)
+    """
+    return [entry.name if entry is not None else None
+            for entry in get_mount_index(backend).lookup_many(targets)]
+
+
+def get_responsible_fs(target, backend=None):
     """
     Given a target on disk, determines which filesystem is responsible for it
     (i.e. where the target file or directory lives).
     
     :param target: the file or directory to locate
+    :param backend: one of BACKENDS (DEFAULT_BACKEND if omitted)
     :return: a string containing the name of the filesystem
     """
     # Check that the target is valid.
     if not os.path.exists(target):
         raise ValueError("Given file or directory '{}' does not exist.".format(target))
     
+    if (backend or DEFAULT_BACKEND) == BACKEND_NATIVE and native_available():
+        entry = get_mount_index(backend).lookup(target)
+        if entry is None:
+            raise RuntimeError("Unable to find responsible filesystem for '{}'.".format(target))
+        return entry.name
+    
     # Call `df` to find the information.
     df = ['/bin/df', '-P', '-k', str(target)]
-    df_info = subprocess.check_output(df).split('\n')
-    df_info = [x for x in df_info if x]
-    if len(df_info) != 2:
+    df_info = _parse_df(subprocess.check_output(df))
+    if len(df_info) != 1:
         raise RuntimeError("Unable to find responsible filesystem for '{}'.".format(target))
     
-    # Parse the returned information for the filesystem device identifier.
-    info = df_info[1].split()
-    index = 0
-    for index in range(len(info)):
+    # Return the value.
+    return df_info[0].name
+
+
+# How many of the largest files and directories analyze_tree() reports.
+TOP_COUNT = 20
+
+# How many levels below its root analyze_tree() may split a tree up into
+# subtrees to be walked in parallel.
+SPLIT_DEPTH = 3
+
+# The DirectoryCache kept in the cache directory by default (see
+# caches.default_cache_dir()).
+DIRECTORY_CACHE_NAME = 'directory_sizes.sqlite'
+
+# Bumped whenever the cache table changes; a cache with a different version
+# is emptied.
+DIRECTORY_CACHE_VERSION = 1
+
+_DIRECTORY_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    path           TEXT,
+    apparent       INTEGER,
+    inode          INTEGER,
+    mtime          REAL,
+    bytes          INTEGER,
+    files          INTEGER,
+    largest        TEXT,
+    top            INTEGER,
+    linked         TEXT,
+    subdirectories TEXT,
+    PRIMARY KEY (path, apparent)
+);
+"""
+
+# How many directories a walk lists before saving them to the cache.
+CACHE_BATCH_SIZE = 500
+
+# The size of a file or directory: its own size (for a file), or the total of
+# everything within it (for a directory), along with how many files and
+# directories that covers (a directory counts itself).
+SizeEntry = collections.namedtuple('SizeEntry', ['path', 'bytes', 'files', 'directories'])
+
+# The result of analyze_tree(). 'totals' maps each directory no more than
+# 'depth' levels below the root to its SizeEntry; 'largest_files' and
+# 'largest_directories' are lists of SizeEntry, largest first; 'errors' counts
+# the entries which could not be read, and 'cached' the directories whose
+# contents were taken from a DirectoryCache rather than listed.
+TreeReport = collections.namedtuple('TreeReport', [
+    'path', 'bytes', 'files', 'directories', 'totals', 'largest_files', 'largest_directories', 'errors',
+    'cached'
+])
+
+# What a DirectoryCache remembers about one directory, as of when it had the
+# given inode and modification time: the total size and number of the files
+# directly within it which have a single link, its largest such files (as
+# (size, name) pairs, up to 'top' of them), its files with several links (as
+# (inode, size, name), so that they are still only counted once), and the
+# names of its subdirectories.
+DirectoryEntry = collections.namedtuple('DirectoryEntry', [
+    'inode', 'mtime', 'bytes', 'files', 'largest', 'top', 'linked', 'subdirectories'
+])
+
+
+def _lstat_entries(directory):
+    """
+    :return: an iterable of (name, path, os.lstat() result) for a directory's
+             entries
+    :raises OSError: if the directory cannot be listed
+    """
+    if _scandir is not None:
+        iterator = _scandir(directory)
         try:
-            int(info[index])
-            break
-        except ValueError:
-            pass
+            for entry in iterator:
+                try:
+                    yield entry.name, entry.path, entry.stat(follow_symlinks=False)
+                except OSError:
+                    yield entry.name, entry.path, None
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+        return
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            yield name, path, os.lstat(path)
+        except OSError:
+            yield name, path, None
+
+
+def _keep(heap, limit, item):
+    """
+    Add an item to a min-heap of the 'limit' largest items seen so far.
+    """
+    if limit <= 0:
+        return
+    if len(heap) < limit:
+        heapq.heappush(heap, item)
+    elif item > heap[0]:
+        heapq.heappushpop(heap, item)
+
+
+def default_directory_cache_path():
+    """
+    :return: the location of the directory cache for the current user
+    """
+    return os.path.join(default_cache_dir(), DIRECTORY_CACHE_NAME)
+
+
+def _encode_entry(entry):
+    """
+    :return: the 'largest', 'linked' and 'subdirectories' of a DirectoryEntry
+             as strings for the database (file names can hold any byte but
+             '/' and NUL, so those separate them)
+    """
+    return (
+        '\0'.join('{}/{}'.format(size, name) for size, name in entry.largest),
+        '\0'.join('{}/{}/{}'.format(inode, size, name) for inode, size, name in entry.linked),
+        '\0'.join(entry.subdirectories),
+    )
+
+
+def _decode_entry(row):
+    """
+    :return: the DirectoryEntry for a row of the database
+    """
+    inode, mtime, total, files, largest, top, linked, subdirectories = row
+    largest = [item.split('/', 1) for item in largest.split('\0')] if largest else []
+    linked = [item.split('/', 2) for item in linked.split('\0')] if linked else []
+    return DirectoryEntry(
+        inode, mtime, total, files,
+        [(int(size), name) for size, name in largest], top,
+        [(int(inode), int(size), name) for inode, size, name in linked],
+        subdirectories.split('\0') if subdirectories else [],
+    )
+
+
+class DirectoryCache(object):
+    """
+    What analyze_tree() found directly within each directory it listed, kept
+    in an SQLite database. A directory is only listed again once its inode or
+    modification time has changed; otherwise its files are taken from the
+    cache, so a tree which has hardly changed costs about a stat() per
+    directory to analyze rather than one per file.
     
-    # Return the value.
-    fs_name = ' '.join(info[:index])
-    return fs_name
+    A directory's modification time changes when entries are added to it,
+    removed from it or renamed, but not when a file within it is written to.
+    A file which grows (or shrinks) in place is not noticed until something
+    else in its directory changes, so analyze the tree without the cache now
+    and then as well.
+    
+    Some filesystems (HFS+ among them) only keep modification times to the
+    second, so an entry added in the same second as a listing would leave the
+    directory's modification time as it was. A directory modified within a
+    second or so of being listed is therefore not cached, and is listed again
+    next time.
+    """
+    def __init__(self, path=None):
+        """
+        :param path: the database file (default_directory_cache_path() if
+                     omitted); if it cannot be created, the cache is kept in
+                     memory
+        """
+        if path is None:
+            path = default_directory_cache_path()
+        self.__db, self.path = open_cache_db(path, _DIRECTORY_CACHE_SCHEMA, DIRECTORY_CACHE_VERSION)
+        self.__lock = threading.Lock()
+    
+    def close(self):
+        """
+        Close the database.
+        """
+        with self.__lock:
+            self.__db.close()
+    
+    def get(self, directory, apparent=False):
+        """
+        :param directory: the directory
+        :param apparent: whether the sizes are file lengths rather than the
+                         space allocated (see analyze_tree())
+        :return: the directory's DirectoryEntry, or None if it is not cached
+        """
+        with self.__lock:
+            row = self.__db.execute(
+                'SELECT inode, mtime, bytes, files, largest, top, linked, subdirectories '
+                'FROM directories WHERE path = ? AND apparent = ?',
+                (directory, int(apparent))
+            ).fetchone()
+        return _decode_entry(row) if row is not None else None
+    
+    def put_many(self, entries, apparent=False):
+        """
+        Store many entries in a single transaction.
+        
+        :param entries: an iterable of (path, DirectoryEntry)
+        :param apparent: whether the sizes are file lengths
+        """
+        with self.__lock:
+            with self.__db:
+                self.__db.executemany(
+                    'INSERT OR REPLACE INTO directories '
+                    '(path, apparent, inode, mtime, bytes, files, top, largest, linked, subdirectories) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    ((path, int(apparent), entry.inode, entry.mtime, entry.bytes, entry.files, entry.top)
+                     + _encode_entry(entry) for path, entry in entries)
+                )
+    
+    def forget(self, paths, apparent=False):
+        """
+        Remove the entries for directories which no longer exist, and for
+        every directory below them.
+        
+        :param paths: an iterable of directory paths
+        :param apparent: whether the sizes are file lengths
+        """
+        with self.__lock:
+            with self.__db:
+                for path in paths:
+                    low, high = prefix_range(path)
+                    self.__db.execute(
+                        'DELETE FROM directories WHERE path = ? AND apparent = ?', (path, int(apparent))
+                    )
+                    self.__db.execute(
+                        'DELETE FROM directories WHERE path >= ? AND path < ? AND apparent = ?',
+                        (low, high, int(apparent))
+                    )
+
+
+_shared_directory_cache = None
+_shared_directory_cache_lock = threading.Lock()
+
+def shared_directory_cache():
+    """
+    :return: the DirectoryCache shared by the whole process, at
+             default_directory_cache_path()
+    """
+    global _shared_directory_cache
+    with _shared_directory_cache_lock:
+        if _shared_directory_cache is None:
+            _shared_directory_cache = DirectoryCache()
+        return _shared_directory_cache
+
+
+class _TreeWalk(object):
+    """
+    The settings and shared state of one analyze_tree() call. Each subtree is
+    walked by a single thread, which keeps its own heaps and totals; only the
+    set of hard-linked files already counted is shared.
+    """
+    def __init__(self, device, top, depth, one_filesystem, apparent, cache):
+        self.device         = device
+        self.top            = top
+        self.depth          = depth
+        self.one_filesystem = one_filesystem
+        self.apparent       = apparent
+        self.cache          = cache
+        self.__linked = set()
+        self.__lock   = threading.Lock()
+    
+    def size(self, info):
+        """
+        :return: the bytes a file takes up: the blocks allocated to it, as
+                 `du` counts them, or its length if 'apparent' is set
+        """
+        if self.apparent or not hasattr(info, 'st_blocks'):
+            return info.st_size
+        return info.st_blocks * 512
+    
+    def first_link(self, device, inode):
+        """
+        :return: whether a file with several hard links is being seen for the
+                 first time, so that it is only counted once
+        """
+        key = (device, inode)
+        with self.__lock:
+            if key in self.__linked:
+                return False
+            self.__linked.add(key)
+            return True
+    
+    def scan(self, directory, info, result):
+        """
+        Add up the files directly within a directory, from the cache if it has
+        not changed since it was last listed.
+        
+        :param directory: the directory
+        :param info: the directory's os.lstat() result
+        :param result: the _Subtree to record errors and the largest files in
+        :return: a tuple of (bytes, files, [(subdirectory, its os.lstat() result)])
+        """
+        entry = None
+        if self.cache is not None:
+            entry = self.cache.get(directory, self.apparent)
+            if (entry is not None and (entry.inode, entry.mtime) == (info.st_ino, info.st_mtime)
+                    and (entry.top >= self.top or len(entry.largest) >= entry.files)):
+                return self.__replay(directory, info, entry, result)
+        return self.__list(directory, info, result, entry)
+    
+    def __replay(self, directory, info, entry, result):
+        result.cached += 1
+        total, files = entry.bytes, entry.files
+        for size, name in entry.largest:
+            _keep(result.files, self.top, (size, os.path.join(directory, name)))
+        for inode, size, name in entry.linked:
+            if self.first_link(info.st_dev, inode):
+                total += size
+                files += 1
+                _keep(result.files, self.top, (size, os.path.join(directory, name)))
+        subdirectories = []
+        for name in entry.subdirectories:
+            path = os.path.join(directory, name)
+            try:
+                child = os.lstat(path)
+            except OSError:
+                result.errors += 1
+                continue
+            # Something may have been mounted here since.
+            if stat.S_ISDIR(child.st_mode) and (not self.one_filesystem or child.st_dev == self.device):
+                subdirectories.append((path, child))
+        return total, files, subdirectories
+    
+    def __list(self, directory, info, result, previous):
+        started = time.time()
+        total = files = 0
+        single = single_files = 0
+        largest = []
+        linked = []
+        names = []
+        subdirectories = []
+        complete = True
+        try:
+            for name, path, child in _lstat_entries(directory):
+                if child is None:
+                    result.errors += 1
+                    complete = False
+                    continue
+                if stat.S_ISDIR(child.st_mode):
+                    names.append(name)
+                    if not self.one_filesystem or child.st_dev == self.device:
+                        subdirectories.append((path, child))
+                    continue
+                size = self.size(child)
+                if child.st_nlink < 2:
+                    single += size
+                    single_files += 1
+                    _keep(largest, self.top, (size, name))
+                else:
+                    linked.append((child.st_ino, size, name))
+                    if not self.first_link(child.st_dev, child.st_ino):
+                        continue
+                total += size
+                files += 1
+                _keep(result.files, self.top, (size, path))
+        except OSError:
+            result.errors += 1
+            complete = False
+        if self.cache is not None and complete:
+            # A modification time this recent may not change again if an entry
+            # is added before the clock ticks over (see DirectoryCache).
+            if info.st_mtime < int(started) - 1:
+                result.listed.append((directory, DirectoryEntry(
+                    info.st_ino, info.st_mtime, single, single_files, sorted(largest, reverse=True), self.top,
+                    linked, names
+                )))
+            # Forget the subdirectories which have gone since the last listing.
+            if previous is not None:
+                gone = set(previous.subdirectories).difference(names)
+                result.removed.extend(os.path.join(directory, name) for name in gone)
+            if len(result.listed) >= CACHE_BATCH_SIZE:
+                self.save(result)
+        return total, files, subdirectories
+    
+    def save(self, result):
+        """
+        Save the directories a walk has listed to the cache, and forget those
+        which have gone.
+        """
+        if result.listed:
+            self.cache.put_many(result.listed, self.apparent)
+            result.listed = []
+        if result.removed:
+            self.cache.forget(result.removed, self.apparent)
+            result.removed = []
+    
+    def finish(self, path, level, total, files, directories, result):
+        """
+        Record a directory whose total is known.
+        """
+        if level > 0:
+            _keep(result.directories, self.top, (total, path, files, directories))
+        if level <= self.depth:
+            result.totals[path] = SizeEntry(path, total, files, directories)
+
+
+class _Subtree(object):
+    """
+    What a walk has found: the largest files and directories, the totals of
+    the directories near the root, how many entries could not be read, and
+    (with a cache) which directories were listed and which have gone.
+    """
+    def __init__(self):
+        self.files       = []
+        self.directories = []
+        self.totals      = {}
+        self.errors      = 0
+        self.cached      = 0
+        self.listed      = []
+        self.removed     = []
+
+
+def _walk_subtree(task):
+    """
+    Walk one subtree depth-first, working out the total of each directory in
+    it once all of its subdirectories have been walked. Only the directories
+    on the way down to the current one (and their remaining subdirectories)
+    are held, however large the subtree is.
+    
+    :param task: a tuple of (the _TreeWalk, the subtree's root, its
+                 os.lstat() result, its level below the root of the whole
+                 tree)
+    :return: a tuple of (the subtree's root, its SizeEntry, a _Subtree)
+    """
+    walk, root, info, level = task
+    result = _Subtree()
+    total, files, subdirectories = walk.scan(root, info, result)
+    # Each frame is [path, level, bytes, files, directories, subdirectories to walk].
+    stack = [[root, level, walk.size(info) + total, files, 1, iter(subdirectories)]]
+    while True:
+        frame = stack[-1]
+        child = next(frame[5], None)
+        if child is not None:
+            path, info = child
+            total, files, subdirectories = walk.scan(path, info, result)
+            stack.append([path, frame[1] + 1, walk.size(info) + total, files, 1, iter(subdirectories)])
+            continue
+        stack.pop()
+        walk.finish(frame[0], frame[1], frame[2], frame[3], frame[4], result)
+        if not stack:
+            if walk.cache is not None:
+                walk.save(result)
+            return root, SizeEntry(root, frame[2], frame[3], frame[4]), result
+        parent = stack[-1]
+        parent[2] += frame[2]
+        parent[3] += frame[3]
+        parent[4] += frame[4]
+
+
+def analyze_tree(root, top=TOP_COUNT, depth=1, one_filesystem=True, workers=None, apparent=False, cache=None):
+    """
+    Work out how much space a directory tree takes up, like `du`, and which
+    of the files and directories within it are the largest.
+    
+    The first few levels of the tree are listed to split it up into subtrees,
+    which are then walked several at a time. Memory use depends on how deep
+    the tree is and on 'top' and 'depth', not on how many files there are;
+    the largest files and directories are kept in heaps of 'top' entries.
+    
+    With a DirectoryCache, only the directories which have changed since the
+    last analysis are listed (see DirectoryCache for what that misses). Each
+    directory is looked up in the cache as the walk reaches it, so memory use
+    still does not depend on the size of the tree.
+    
+    :param root: the directory to analyze
+    :param top: how many of the largest files and directories to report
+    :param depth: how many levels below the root to report the totals of
+                  (0 for only the root itself)
+    :param one_filesystem: whether to skip directories on other filesystems
+                           (like `du -x`)
+    :param workers: how many subtrees to walk at a time (the number of CPUs if
+                    omitted)
+    :param apparent: whether to count the length of each file rather than
+                     the space allocated to it
+    :param cache: a DirectoryCache to use, e.g. shared_directory_cache()
+                  (every directory is listed if omitted)
+    :return: a TreeReport
+    """
+    root = os.path.abspath(root)
+    info = os.stat(root)
+    if not stat.S_ISDIR(info.st_mode):
+        raise ValueError("Given path '{}' is not a directory.".format(root))
+    walk = _TreeWalk(info.st_dev, top, depth, one_filesystem, apparent, cache)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    result = _Subtree()
+    
+    # List the top of the tree here until there are enough subtrees to keep
+    # the workers busy. Each listed directory is [level, bytes, files,
+    # directories, parent].
+    listed = {}
+    frontier = [(root, info, None)]
+    level = 0
+    while frontier and (level == 0 or (level < SPLIT_DEPTH and len(frontier) < 4 * workers)):
+        next_frontier = []
+        for path, info, parent in frontier:
+            total, files, subdirectories = walk.scan(path, info, result)
+            listed[path] = [level, walk.size(info) + total, files, 1, parent]
+            next_frontier.extend((child, child_info, path) for child, child_info in subdirectories)
+        frontier = next_frontier
+        level += 1
+    
+    parents = dict((path, parent) for path, info, parent in frontier)
+    tasks = [(walk, path, info, level) for path, info, parent in frontier]
+    for path, entry, subtree in (run_pool(_walk_subtree, tasks, workers) if tasks else ()):
+        node = listed[parents[path]]
+        node[1] += entry.bytes
+        node[2] += entry.files
+        node[3] += entry.directories
+        for item in subtree.files:
+            _keep(result.files, top, item)
+        for item in subtree.directories:
+            _keep(result.directories, top, item)
+        result.totals.update(subtree.totals)
+        result.errors += subtree.errors
+        result.cached += subtree.cached
+    
+    # Add the listed directories up from the bottom.
+    for path, node in sorted(listed.items(), key=lambda item: -item[1][0]):
+        level, total, files, directories, parent = node
+        walk.finish(path, level, total, files, directories, result)
+        if parent is not None:
+            listed[parent][1] += total
+            listed[parent][2] += files
+            listed[parent][3] += directories
+    
+    if cache is not None:
+        walk.save(result)
+    
+    level, total, files, directories, parent = listed[root]
+    largest_files = [SizeEntry(path, size, 1, 0) for size, path in sorted(result.files, reverse=True)]
+    largest_directories = [SizeEntry(item[1], item[0], item[2], item[3])
+                           for item in sorted(result.directories, reverse=True)]
+    return TreeReport(root, total, files, directories, result.totals,
+                      largest_files, largest_directories, result.errors, result.cached)
 
 
 class Filesystem(object):
-    def __init__(self, name):
+    def __init__(self, name, snapshot=None, mount_point=None):
         """
         Set all of the initial properties of the object.
         
         :param name: the filesystem name
+        :param snapshot: a FilesystemSnapshot to take the information from
+                         (the system is polled if omitted)
+        :param mount_point: where the filesystem is mounted, needed only if
+                            several mounted filesystems have the same name
         """
         self.__name          = name
-        self.__mount_point   = None
+        self.__mount_point   = mount_point
         self.__type          = None
         self.__kblocks       = None
         self.__kblocks_used  = None
         self.__kblocks_free = None
         self.__capacity      = None
+        self.__inodes        = None
+        self.__inodes_used   = None
+        self.__inodes_free   = None
         self.__properties    = None
         
         # Update all of the information.
-        self.update()
-    
-    def update(self):
-        """
-        Update all of the information regarding this filesystem. This will check
-        the `df` output and parse it to update this object's properties.
-        """
-        info = get_raw_fs_info(fs=self.name, strict=True)
-        # 'info' now contains a line like:
-        #   /dev/disk1s1 on /Volumes/External (hfs, local, journaled)
-        #   ------+-----    --------+--------  -+-
-        #       name           mount point    filesystem type
-        info = info.split('on ')[1]
-        self.__mount_point, properties = info.split(' (')
-        properties = properties[:-1]
-        properties = properties.split(', ')
-        if properties[0].endswith('fs'):
-            self.__type = properties[0]
-        self.__properties = properties
+        self.update(snapshot)
+    
+    def update(self, snapshot=None):
+        """
+        Update all of the information regarding this filesystem from the mount
+        table and the filesystem's usage (see FilesystemSnapshot).
         
-        info = get_raw_fs_usage(self.mount_point)
-        # 'info' now contains a line like:
-        #   /dev/disk1s1  100    70    30    70%   /Volumes/External
-        #   ------+-----  -+-   -+-   -+-    -+-   --------+--------
-        #        name    blocks used avail capacity   mount point
-        info = info.split()
-        index = 0
-        for index in range(len(info)):
-            try:
-                int(info[index])
-                break
-            except ValueError:
-                pass
-        self.__kblocks       = info[index]
-        self.__kblocks_used  = info[index + 1]
-        self.__kblocks_free = info[index + 2]
-        self.__capacity      = info[index + 3][:-1] # remove the "%" off the end
+        :param snapshot: a FilesystemSnapshot to take the information from
+                         (a new one is taken if omitted)
+        """
+        if snapshot is None:
+            snapshot = FilesystemSnapshot.take()
+        entry = snapshot.find(self.name, self.__mount_point)
+        self.__mount_point = entry.mount_point
+        self.__type        = entry.type
+        self.__properties  = entry.properties
+        
+        usage = snapshot.get_usage(self.mount_point)
+        if usage is None:
+            usage = UsageEntry(self.name, None, None, None, None, self.mount_point, None, None, None)
+        self.__kblocks       = usage.kblocks
+        self.__kblocks_used  = usage.kblocks_used
+        self.__kblocks_free = usage.kblocks_free
+        self.__capacity      = usage.capacity
+        self.__inodes        = usage.inodes
+        self.__inodes_used   = usage.inodes_used
+        self.__inodes_free   = usage.inodes_free
     
     def __repr__(self):
         """
@@ -187,6 +1263,9 @@ class Filesystem(object):
             "    used kblocks:       {kblocks_used}\n"
             "    available kblocks:  {kblocks_free}\n"
             "    remaining capacity: {capacity}\n"
+            "    total inodes:       {inodes}\n"
+            "    used inodes:        {inodes_used}\n"
+            "    available inodes:   {inodes_free}\n"
             "    other properties:   {properties}"
         ).format(
             name = self.name, mount_point = self.mount_point, type = self.type,
@@ -194,7 +1273,10 @@ class Filesystem(object):
             kblocks_used  = self.kblocks_used,
             kblocks_free = self.kblocks_free,
             capacity      = self.capacity,
-            properties    = ', '.join(self.properties)
+            inodes        = self.inodes,
+            inodes_used   = self.inodes_used,
+            inodes_free   = self.inodes_free,
+            properties    = ', '.join(self.properties or [])
         )
         
         return result
@@ -220,32 +1302,60 @@ class Filesystem(object):
     
     @property
     def kblocks(self):
-        return int(self.__kblocks) if self.__kblocks else None
+        return int(self.__kblocks) if self.__kblocks is not None else None
     
     @property
     def kblocks_used(self):
-        return int(self.__kblocks_used) if self.__kblocks_used else None
+        return int(self.__kblocks_used) if self.__kblocks_used is not None else None
     
     @property
     def kblocks_free(self):
-        return int(self.__kblocks_free) if self.__kblocks_free else None
+        return int(self.__kblocks_free) if self.__kblocks_free is not None else None
     
     @property
     def bytes(self):
-        return 1024 * self.kblocks if self.kblocks else None
+        return 1024 * self.kblocks if self.kblocks is not None else None
     
     @property
     def bytes_used(self):
-        return 1024 * self.kblocks_used if self.kblocks_used else None
+        return 1024 * self.kblocks_used if self.kblocks_used is not None else None
     
     @property
     def bytes_free(self):
-        return 1024 * self.kblocks_free if self.kblocks_free else None
+        return 1024 * self.kblocks_free if self.kblocks_free is not None else None
     
     @property
     def capacity(self):
-        return int(self.__capacity) if self.__capacity else None
+        return int(self.__capacity) if self.__capacity is not None else None
+    
+    @property
+    def inodes(self):
+        return int(self.__inodes) if self.__inodes is not None else None
+    
+    @property
+    def inodes_used(self):
+        return int(self.__inodes_used) if self.__inodes_used is not None else None
+    
+    @property
+    def inodes_free(self):
+        return int(self.__inodes_free) if self.__inodes_free is not None else None
     
     @property
     def properties(self):
         return self.__properties if self.__properties else None
+    
+    def analyze(self, top=TOP_COUNT, depth=1, workers=None, cache=None):
+        """
+        Find out what is taking up the space on this filesystem, without
+        crossing into other filesystems mounted within it.
+        
+        :param top: how many of the largest files and directories to report
+        :param depth: how many levels below the mount point to report the
+                      totals of
+        :param workers: how many directories to walk at a time
+        :param cache: a DirectoryCache to use (see analyze_tree())
+        :return: a TreeReport (see analyze_tree())
+        """
+        return analyze_tree(self.mount_point, top=top, depth=depth, one_filesystem=True, workers=workers,
+                            cache=cache)
+
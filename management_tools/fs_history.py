@@ -0,0 +1,381 @@
+####
+#
+# This module keeps a history of how full each filesystem is, so that a disk
+# which is about to fill up can be told apart from one which has sat at 90%
+# for a year. Each run of a sampler records the bytes and inodes used and
+# free on every filesystem, and works out from the recent samples how fast
+# each one is filling and when it will be full.
+#
+# The samples for a filesystem are kept in a ring buffer of a fixed number of
+# slots in a small file of its own, so the history never grows. Recording a
+# sample only rewrites that sample's slot and then the file's header, with the
+# file locked so that several samplers can share it. The trend is
+# a least-squares fit over the samples, done with NumPy when it is installed
+# and in plain Python otherwise.
+#
+# For example, run every few minutes:
+#
+#   for trend in CapacitySampler().sample():
+#       if trend.seconds_to_full is not None and trend.seconds_to_full < 86400:
+#           print trend.mount_point, "will be full within a day."
+#
+####
+
+## Imports
+import array
+import collections
+import errno
+import fcntl
+import os
+import struct
+import sys
+import threading
+import time
+import urllib
+
+from caches import default_cache_dir
+from fs_analysis import get_filesystems
+
+# NumPy does the fits faster over long histories, but is not required.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The directory kept in the cache directory by default (see
+# caches.default_cache_dir()).
+HISTORY_NAME = 'capacity'
+
+# How many samples are kept for each filesystem by default (a day's worth at
+# one a minute).
+DEFAULT_SIZE = 1440
+
+# The values recorded in each sample, in the order they are stored.
+FIELDS = ['timestamp', 'bytes_used', 'bytes_free', 'inodes_used', 'inodes_free']
+
+# The header of a history file: magic, version, fields per sample, slots, and
+# how many samples have ever been recorded (the next slot is that modulo the
+# number of slots). Samples are stored as little-endian doubles after it.
+_HEADER = struct.Struct('<4sHHIQ')
+_MAGIC   = 'FSRB'
+_VERSION = 1
+
+# One sample of a filesystem. Values the system does not report are None.
+Sample = collections.namedtuple('Sample', FIELDS)
+
+# How a filesystem's use has changed over the samples. The rates are in bytes
+# (or inodes) per second, positive when filling up; the times to full are in
+# seconds from the last sample, and None when the filesystem is not filling
+# up (or there are not enough samples to tell).
+Trend = collections.namedtuple('Trend', [
+    'mount_point', 'samples', 'span', 'bytes_rate', 'inodes_rate', 'seconds_to_full', 'seconds_to_inodes_full'
+])
+
+
+def default_history_path():
+    """
+    :return: the directory where the capacity history for the current user
+             is kept
+    """
+    return os.path.join(default_cache_dir(), HISTORY_NAME)
+
+
+class RingBuffer(object):
+    """
+    A fixed number of samples kept in a file. Once every slot has been used,
+    each new sample replaces the oldest one.
+    """
+    def __init__(self, path, size=DEFAULT_SIZE):
+        """
+        :param path: the file to keep the samples in; it is created if it does
+                     not exist, and if it is not a history file it is renamed
+                     with '.corrupt' added and a new one is started
+        :param size: how many samples to keep; an existing file keeps the size
+                     it was created with
+        """
+        self.path = path
+        self.size = size
+        with self.__open() as f:
+            try:
+                self.__read(f)
+                return
+            except ValueError:
+                # Keep whatever is there for a look rather than overwriting it.
+                os.rename(path, path + '.corrupt')
+        with self.__open() as f:
+            self.__read(f)
+
+    def __open(self):
+        """
+        :return: the file, open for reading and writing and locked against
+                 other samplers (it is created empty if it does not exist)
+        """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        while True:
+            f = os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            # Another sampler may have moved the file aside while this one
+            # waited for the lock.
+            try:
+                if os.path.samestat(os.fstat(f.fileno()), os.stat(self.path)):
+                    return f
+            except OSError:
+                pass
+            f.close()
+
+    def __read(self, f):
+        """
+        Load the samples from the locked file, or start it if it is empty.
+
+        :raises ValueError: if the file is not a history file
+        """
+        if not os.fstat(f.fileno()).st_size:
+            self.count = 0
+            self.data  = array.array('d', [float('nan')] * (self.size * len(FIELDS)))
+            self.__create(f)
+            return
+        try:
+            self.__load(f)
+        except (EOFError, struct.error):
+            raise ValueError("Not a capacity history file: '{}'".format(self.path))
+
+    def __load(self, f):
+        f.seek(0)
+        magic, version, fields, size, count = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != _MAGIC or version != _VERSION or fields != len(FIELDS) or not size:
+            raise ValueError("Not a capacity history file: '{}'".format(self.path))
+        data = array.array('d')
+        data.fromfile(f, size * fields)
+        if sys.byteorder != 'little':
+            data.byteswap()
+        self.size  = size
+        self.count = count
+        self.data  = data
+
+    def __header(self):
+        return _HEADER.pack(_MAGIC, _VERSION, len(FIELDS), self.size, self.count)
+
+    def __create(self, f):
+        data = array.array('d', self.data)
+        if sys.byteorder != 'little':
+            data.byteswap()
+        f.seek(0)
+        f.truncate()
+        f.write(self.__header())
+        data.tofile(f)
+
+    def append(self, sample):
+        """
+        Record a sample, writing only its slot and then the header to the
+        file. The file is read again first, in case another sampler has
+        recorded samples in it since.
+
+        :param sample: a Sample (or any sequence of the values in FIELDS)
+        :raises ValueError: if the file is no longer a history file
+        """
+        values = array.array('d', [float('nan') if x is None else float(x) for x in sample])
+        with self.__open() as f:
+            self.__read(f)
+            start = (self.count % self.size) * len(FIELDS)
+            self.data[start:start + len(FIELDS)] = values
+            self.count += 1
+            if sys.byteorder != 'little':
+                values.byteswap()
+            # The slot goes to disk before the header which counts it, so an
+            # interrupted write never counts a slot that was not written.
+            f.seek(_HEADER.size + start * values.itemsize)
+            values.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+            f.seek(0)
+            f.write(self.__header())
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def values(self):
+        """
+        :return: an array of the samples' values, oldest first, with
+                 len(FIELDS) values for each sample
+        """
+        width = len(FIELDS)
+        if self.count <= self.size:
+            return self.data[:self.count * width]
+        slot = self.count % self.size
+        return self.data[slot * width:] + self.data[:slot * width]
+
+    def samples(self):
+        """
+        :return: a list of the Samples, oldest first
+        """
+        values = self.values()
+        width = len(FIELDS)
+        return [
+            Sample(*[None if x != x else x for x in values[i:i + width]])
+            for i in range(0, len(values), width)
+        ]
+
+
+def _slopes_numpy(values, since):
+    """
+    Fit a line to each of the used columns against time with NumPy.
+
+    :return: a tuple of (bytes per second, inodes per second), each None if it
+             cannot be worked out
+    """
+    data = numpy.frombuffer(values, dtype=numpy.float64).reshape(-1, len(FIELDS))
+    if since is not None:
+        data = data[data[:, 0] >= since]
+    if len(data) < 2:
+        return None, None
+    times = data[:, 0] - data[:, 0].mean()
+    spread = (times * times).sum()
+    if not spread:
+        return None, None
+    used = data[:, [1, 3]]
+    slopes = (times[:, None] * (used - used.mean(axis=0))).sum(axis=0) / spread
+    return tuple(None if numpy.isnan(x) else float(x) for x in slopes)
+
+
+def _slopes_python(values, since):
+    """
+    Fit a line to each of the used columns against time in plain Python.
+
+    :return: a tuple of (bytes per second, inodes per second), each None if it
+             cannot be worked out
+    """
+    width = len(FIELDS)
+    rows = [values[i:i + width] for i in range(0, len(values), width)]
+    if since is not None:
+        rows = [row for row in rows if row[0] >= since]
+    if len(rows) < 2:
+        return None, None
+    mean_time = sum(row[0] for row in rows) / len(rows)
+    spread = sum((row[0] - mean_time) ** 2 for row in rows)
+    if not spread:
+        return None, None
+    slopes = []
+    for column in (1, 3):
+        if any(row[column] != row[column] for row in rows):
+            slopes.append(None)
+            continue
+        mean = sum(row[column] for row in rows) / len(rows)
+        slopes.append(sum((row[0] - mean_time) * (row[column] - mean) for row in rows) / spread)
+    return tuple(slopes)
+
+
+def _until_full(free, rate):
+    """
+    :return: the seconds until 'free' runs out at 'rate', or None if it will
+             not
+    """
+    if free is None or rate is None or rate <= 0:
+        return None
+    return free / rate
+
+
+def trend(buffer, mount_point=None, window=None):
+    """
+    Work out how fast a filesystem is filling up from its samples.
+
+    :param buffer: the filesystem's RingBuffer
+    :param mount_point: where the filesystem is mounted, recorded in the result
+    :param window: how many seconds before the last sample to fit over (every
+                   sample if omitted)
+    :return: a Trend
+    """
+    values = buffer.values()
+    if not values:
+        return Trend(mount_point, 0, 0, None, None, None, None)
+    last = Sample(*[None if x != x else x for x in values[-len(FIELDS):]])
+    since = last.timestamp - window if window is not None else None
+    times = values[0::len(FIELDS)]
+    if since is not None:
+        times = [t for t in times if t >= since]
+    if numpy is not None:
+        bytes_rate, inodes_rate = _slopes_numpy(values, since)
+    else:
+        bytes_rate, inodes_rate = _slopes_python(values, since)
+    return Trend(
+        mount_point, len(times), last.timestamp - times[0], bytes_rate, inodes_rate,
+        _until_full(last.bytes_free, bytes_rate), _until_full(last.inodes_free, inodes_rate)
+    )
+
+
+class CapacitySampler(object):
+    """
+    Records a sample of every filesystem's use each time sample() is called,
+    keeping a RingBuffer for each mount point in a directory.
+    """
+    def __init__(self, directory=None, size=DEFAULT_SIZE, window=None):
+        """
+        :param directory: where to keep the history (default_history_path() if
+                          omitted)
+        :param size: how many samples to keep for each filesystem
+        :param window: how many seconds of samples to fit trends over (all of
+                       them if omitted)
+        """
+        if directory is None:
+            directory = default_history_path()
+        self.directory = directory
+        self.size      = size
+        self.window    = window
+        self.__buffers = {}
+        self.__lock    = threading.Lock()
+
+    def path(self, mount_point):
+        """
+        :return: the file a filesystem's samples are kept in
+        """
+        return os.path.join(self.directory, urllib.quote(mount_point, safe='') + '.ring')
+
+    def buffer(self, mount_point):
+        """
+        :return: the RingBuffer for a filesystem
+        """
+        with self.__lock:
+            if mount_point not in self.__buffers:
+                self.__buffers[mount_point] = RingBuffer(self.path(mount_point), self.size)
+            return self.__buffers[mount_point]
+
+    def sample(self, filesystems=None, now=None):
+        """
+        Record a sample of each filesystem and work out its trend. Filesystems
+        without any blocks (such as /proc) are skipped, as are filesystems
+        hidden by a later mount on the same mount point.
+
+        :param filesystems: the Filesystems to sample (get_filesystems() if
+                            omitted)
+        :param now: the time to record the samples at (the current time if
+                    omitted)
+        :return: a list of Trends, one for each filesystem sampled
+        """
+        if filesystems is None:
+            filesystems = get_filesystems()
+        if now is None:
+            now = time.time()
+        visible = collections.OrderedDict()
+        for filesystem in filesystems:
+            visible.pop(filesystem.mount_point, None)
+            visible[filesystem.mount_point] = filesystem
+        trends = []
+        for filesystem in visible.values():
+            if not filesystem.kblocks:
+                continue
+            buffer = self.buffer(filesystem.mount_point)
+            buffer.append(Sample(now, filesystem.bytes_used, filesystem.bytes_free,
+                                 filesystem.inodes_used, filesystem.inodes_free))
+            trends.append(trend(buffer, filesystem.mount_point, self.window))
+        return trends
+
+    def trend(self, mount_point):
+        """
+        :return: the Trend of a filesystem from the samples recorded so far
+        """
+        return trend(self.buffer(mount_point), mount_point, self.window)
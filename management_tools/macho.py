@@ -0,0 +1,343 @@
+####
+#
+# This module reads the headers of Mach-O executables (the format of the
+# binaries inside application bundles) without calling out to `file`, `lipo`
+# or `otool`. For each architecture in a binary, it reports the CPU type, the
+# minimum OS version it was built for, and a summary of its load commands.
+#
+# Binaries are memory mapped, so only the pages holding the headers and load
+# commands are ever read from disk, however large the binary is. Universal
+# ("fat") binaries are supported, including the 64-bit fat format.
+#
+####
+
+## Imports
+import binascii
+import collections
+import mmap
+import struct
+
+from concurrency import run_pool
+
+FAT_MAGIC    = 0xcafebabe
+FAT_MAGIC_64 = 0xcafebabf
+MH_MAGIC     = 0xfeedface
+MH_MAGIC_64  = 0xfeedfacf
+
+# Java class files start with FAT_MAGIC too, followed by their version number
+# (45 or more), so a fat header claiming more architectures than this is not
+# treated as a Mach-O.
+MAX_FAT_ARCHS = 30
+
+CPU_ARCH_ABI64    = 0x01000000
+CPU_ARCH_ABI64_32 = 0x02000000
+CPU_TYPE_X86      = 7
+CPU_TYPE_ARM      = 12
+CPU_TYPE_POWERPC  = 18
+
+# Names for (CPU type, CPU subtype) pairs, with a subtype of None standing for
+# any subtype not listed.
+_CPU_NAMES = {
+    (CPU_TYPE_X86, None):                           'i386',
+    (CPU_TYPE_X86 | CPU_ARCH_ABI64, None):          'x86_64',
+    (CPU_TYPE_X86 | CPU_ARCH_ABI64, 8):             'x86_64h',
+    (CPU_TYPE_ARM, None):                           'arm',
+    (CPU_TYPE_ARM, 6):                              'armv6',
+    (CPU_TYPE_ARM, 9):                              'armv7',
+    (CPU_TYPE_ARM, 11):                             'armv7s',
+    (CPU_TYPE_ARM, 12):                             'armv7k',
+    (CPU_TYPE_ARM | CPU_ARCH_ABI64, None):          'arm64',
+    (CPU_TYPE_ARM | CPU_ARCH_ABI64, 2):             'arm64e',
+    (CPU_TYPE_ARM | CPU_ARCH_ABI64_32, None):       'arm64_32',
+    (CPU_TYPE_POWERPC, None):                       'ppc',
+    (CPU_TYPE_POWERPC | CPU_ARCH_ABI64, None):      'ppc64',
+}
+
+_FILE_TYPES = {
+    0x1: 'object',
+    0x2: 'execute',
+    0x6: 'dylib',
+    0x7: 'dylinker',
+    0x8: 'bundle',
+    0xb: 'kext_bundle',
+}
+
+LC_REQ_DYLD              = 0x80000000
+LC_VERSION_MIN_MACOSX    = 0x24
+LC_VERSION_MIN_IPHONEOS  = 0x25
+LC_VERSION_MIN_TVOS      = 0x2f
+LC_VERSION_MIN_WATCHOS   = 0x30
+LC_BUILD_VERSION         = 0x32
+LC_UUID                  = 0x1b
+LC_LOAD_DYLIB            = 0xc
+LC_LOAD_WEAK_DYLIB       = 0x18 | LC_REQ_DYLD
+LC_REEXPORT_DYLIB        = 0x1f | LC_REQ_DYLD
+LC_LAZY_LOAD_DYLIB       = 0x20
+LC_LOAD_UPWARD_DYLIB     = 0x23 | LC_REQ_DYLD
+
+_LOAD_COMMANDS = {
+    0x1:                        'LC_SEGMENT',
+    0x2:                        'LC_SYMTAB',
+    0xb:                        'LC_DYSYMTAB',
+    LC_LOAD_DYLIB:              'LC_LOAD_DYLIB',
+    0xd:                        'LC_ID_DYLIB',
+    0xe:                        'LC_LOAD_DYLINKER',
+    0xf:                        'LC_ID_DYLINKER',
+    0x19:                       'LC_SEGMENT_64',
+    LC_UUID:                    'LC_UUID',
+    0x1d:                       'LC_CODE_SIGNATURE',
+    0x1e:                       'LC_SEGMENT_SPLIT_INFO',
+    LC_LAZY_LOAD_DYLIB:         'LC_LAZY_LOAD_DYLIB',
+    0x21:                       'LC_ENCRYPTION_INFO',
+    0x22:                       'LC_DYLD_INFO',
+    LC_VERSION_MIN_MACOSX:      'LC_VERSION_MIN_MACOSX',
+    LC_VERSION_MIN_IPHONEOS:    'LC_VERSION_MIN_IPHONEOS',
+    0x26:                       'LC_FUNCTION_STARTS',
+    0x27:                       'LC_DYLD_ENVIRONMENT',
+    0x29:                       'LC_DATA_IN_CODE',
+    0x2a:                       'LC_SOURCE_VERSION',
+    0x2b:                       'LC_DYLIB_CODE_SIGN_DRS',
+    0x2c:                       'LC_ENCRYPTION_INFO_64',
+    0x2d:                       'LC_LINKER_OPTION',
+    0x2e:                       'LC_LINKER_OPTIMIZATION_HINT',
+    LC_VERSION_MIN_TVOS:        'LC_VERSION_MIN_TVOS',
+    LC_VERSION_MIN_WATCHOS:     'LC_VERSION_MIN_WATCHOS',
+    0x31:                       'LC_NOTE',
+    LC_BUILD_VERSION:           'LC_BUILD_VERSION',
+    LC_LOAD_WEAK_DYLIB:         'LC_LOAD_WEAK_DYLIB',
+    0x1c | LC_REQ_DYLD:         'LC_RPATH',
+    LC_REEXPORT_DYLIB:          'LC_REEXPORT_DYLIB',
+    0x22 | LC_REQ_DYLD:         'LC_DYLD_INFO_ONLY',
+    LC_LOAD_UPWARD_DYLIB:       'LC_LOAD_UPWARD_DYLIB',
+    0x28 | LC_REQ_DYLD:         'LC_MAIN',
+    0x33 | LC_REQ_DYLD:         'LC_DYLD_EXPORTS_TRIE',
+    0x34 | LC_REQ_DYLD:         'LC_DYLD_CHAINED_FIXUPS',
+}
+
+_DYLIB_COMMANDS = set([
+    LC_LOAD_DYLIB, LC_LOAD_WEAK_DYLIB, LC_REEXPORT_DYLIB, LC_LAZY_LOAD_DYLIB, LC_LOAD_UPWARD_DYLIB,
+])
+
+_VERSION_MIN_PLATFORMS = {
+    LC_VERSION_MIN_MACOSX:   'macos',
+    LC_VERSION_MIN_IPHONEOS: 'ios',
+    LC_VERSION_MIN_TVOS:     'tvos',
+    LC_VERSION_MIN_WATCHOS:  'watchos',
+}
+
+_PLATFORMS = {
+    1:  'macos',
+    2:  'ios',
+    3:  'tvos',
+    4:  'watchos',
+    5:  'bridgeos',
+    6:  'maccatalyst',
+    7:  'iossimulator',
+    8:  'tvossimulator',
+    9:  'watchossimulator',
+    10: 'driverkit',
+}
+
+# One architecture of a binary. 'min_version' and 'sdk_version' are strings
+# such as '10.13' (None if the binary does not say), 'load_commands' maps each
+# load command's name to how many times it appears, and 'dylibs' lists the
+# libraries the binary links against, in order.
+Architecture = collections.namedtuple('Architecture', [
+    'name', 'cputype', 'cpusubtype', 'bits', 'filetype', 'platform',
+    'min_version', 'sdk_version', 'uuid', 'load_commands', 'dylibs',
+])
+
+# The result of parsing one binary with parse_many(). 'architectures' is a
+# list of Architectures (empty if the file could not be parsed), and 'error' is
+# the exception raised while parsing it, if any.
+MachOResult = collections.namedtuple('MachOResult', ['path', 'fat', 'architectures', 'error'])
+
+
+class MachOError(ValueError):
+    """
+    Raised when a file is not a Mach-O binary, or is truncated or corrupt.
+    """
+    pass
+
+
+def cpu_name(cputype, cpusubtype):
+    """
+    :return: the usual name of a CPU type, e.g. 'x86_64' or 'arm64'
+    """
+    # The high bits of the subtype are capability flags, not part of it.
+    subtype = cpusubtype & 0x00ffffff
+    name = _CPU_NAMES.get((cputype, subtype)) or _CPU_NAMES.get((cputype, None))
+    return name or 'cpu{}_{}'.format(cputype, subtype)
+
+
+def _version(value):
+    """
+    :return: a version packed as xxxx.yy.zz into 32 bits, as a string
+    """
+    major, minor, patch = value >> 16, (value >> 8) & 0xff, value & 0xff
+    if patch:
+        return '{}.{}.{}'.format(major, minor, patch)
+    return '{}.{}'.format(major, minor)
+
+
+def _unpack(format, data, offset):
+    """
+    Unpack a structure, raising MachOError rather than struct.error if the
+    data ends before it does.
+    """
+    if offset < 0 or offset + struct.calcsize(format) > len(data):
+        raise MachOError("Mach-O data ends at byte {}, before its headers do.".format(len(data)))
+    return struct.unpack_from(format, data, offset)
+
+
+def _string(data, start, end):
+    """
+    :return: the NUL-terminated string found between 'start' and 'end'
+    """
+    if start >= end or end > len(data):
+        return None
+    value = data[start:end]
+    return value.split(b'\0', 1)[0].decode('utf-8', 'replace')
+
+
+def _parse_header(data, offset):
+    """
+    :return: the Architecture of the thin Mach-O starting at 'offset'
+    """
+    magic = _unpack('<I', data, offset)[0]
+    if magic in (MH_MAGIC, MH_MAGIC_64):
+        order = '<'
+    elif magic in (_swap(MH_MAGIC), _swap(MH_MAGIC_64)):
+        order = '>'
+        magic = _swap(magic)
+    else:
+        raise MachOError("Not a Mach-O binary (magic 0x{:08x}).".format(magic))
+    bits = 64 if magic == MH_MAGIC_64 else 32
+    cputype, cpusubtype, filetype, ncmds, sizeofcmds, flags = _unpack(order + 'iIIIII', data, offset + 4)
+    cputype &= 0xffffffff
+    position = offset + (32 if bits == 64 else 28)
+    end = position + sizeofcmds
+    if end > len(data):
+        raise MachOError("Mach-O load commands run past the end of the data.")
+
+    platform = min_version = sdk_version = uuid = None
+    load_commands = {}
+    dylibs = []
+    for i in range(ncmds):
+        cmd, cmdsize = _unpack(order + 'II', data, position)
+        if cmdsize < 8 or position + cmdsize > end:
+            raise MachOError("Corrupt Mach-O load command at byte {}.".format(position))
+        name = _LOAD_COMMANDS.get(cmd, '0x{:x}'.format(cmd))
+        load_commands[name] = load_commands.get(name, 0) + 1
+        if cmd == LC_BUILD_VERSION:
+            number, minos, sdk = _unpack(order + 'III', data, position + 8)
+            platform = _PLATFORMS.get(number, str(number))
+            min_version, sdk_version = _version(minos), _version(sdk)
+        elif cmd in _VERSION_MIN_PLATFORMS and min_version is None:
+            minos, sdk = _unpack(order + 'II', data, position + 8)
+            platform = _VERSION_MIN_PLATFORMS[cmd]
+            min_version, sdk_version = _version(minos), _version(sdk)
+        elif cmd == LC_UUID:
+            raw = binascii.hexlify(data[position + 8:position + 24]).decode('ascii').upper()
+            uuid = '-'.join([raw[0:8], raw[8:12], raw[12:16], raw[16:20], raw[20:32]])
+        elif cmd in _DYLIB_COMMANDS:
+            name_offset = _unpack(order + 'I', data, position + 8)[0]
+            dylibs.append(_string(data, position + name_offset, position + cmdsize))
+        position += cmdsize
+
+    return Architecture(
+        name=cpu_name(cputype, cpusubtype), cputype=cputype, cpusubtype=cpusubtype, bits=bits,
+        filetype=_FILE_TYPES.get(filetype, str(filetype)), platform=platform,
+        min_version=min_version, sdk_version=sdk_version, uuid=uuid,
+        load_commands=load_commands, dylibs=dylibs,
+    )
+
+
+def _swap(value):
+    """
+    :return: a 32-bit value with its bytes reversed
+    """
+    return struct.unpack('<I', struct.pack('>I', value))[0]
+
+
+def parse_data(data):
+    """
+    Parse the headers of a Mach-O binary held in memory (a string or a memory
+    map).
+
+    :param data: the binary's contents
+    :return: a tuple of (whether it is a fat binary, list of Architectures)
+    :raises MachOError: if the data is not a Mach-O binary
+    """
+    magic = _unpack('>I', data, 0)[0]
+    if magic not in (FAT_MAGIC, FAT_MAGIC_64):
+        return False, [_parse_header(data, 0)]
+
+    count = _unpack('>I', data, 4)[0]
+    if count > MAX_FAT_ARCHS:
+        raise MachOError("Not a Mach-O binary (probably a Java class file).")
+    architectures = []
+    position = 8
+    for i in range(count):
+        if magic == FAT_MAGIC_64:
+            cputype, cpusubtype, offset, size, align, reserved = _unpack('>iIQQII', data, position)
+            position += 32
+        else:
+            cputype, cpusubtype, offset, size, align = _unpack('>iIIII', data, position)
+            position += 20
+        if offset + size > len(data):
+            raise MachOError("Fat binary slice {} runs past the end of the file.".format(i))
+        architectures.append(_parse_header(data, offset))
+    return True, architectures
+
+
+def parse(path):
+    """
+    Parse the headers of a Mach-O binary. The file is memory mapped, so only
+    the parts holding the headers are read.
+
+    :param path: the location of the binary
+    :return: a tuple of (whether it is a fat binary, list of Architectures)
+    :raises MachOError: if the file is not a Mach-O binary
+    :raises IOError: if the file cannot be read
+    """
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # mmap() refuses empty files.
+            raise MachOError("Not a Mach-O binary (empty file).")
+    try:
+        return parse_data(data)
+    finally:
+        data.close()
+
+
+def architectures(path):
+    """
+    :param path: the location of the binary
+    :return: the names of the architectures in the binary, e.g.
+             ['x86_64', 'arm64']
+    """
+    return [arch.name for arch in parse(path)[1]]
+
+
+def _parse_task(path):
+    try:
+        fat, archs = parse(path)
+    except (MachOError, IOError, OSError) as e:
+        return MachOResult(path, False, [], e)
+    return MachOResult(path, fat, archs, None)
+
+
+def parse_many(paths, workers=None, processes=False):
+    """
+    Parse many binaries, several at a time. Yields a MachOResult for each
+    binary as it finishes, which is not necessarily the order of 'paths'.
+
+    :param paths: an iterable of binary locations
+    :param workers: how many binaries to parse at a time (the number of CPUs
+                    if omitted)
+    :param processes: whether to use a pool of processes rather than threads
+    """
+    return run_pool(_parse_task, paths, workers, processes)
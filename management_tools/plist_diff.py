@@ -0,0 +1,184 @@
+####
+#
+# This module compares two plists (or a plist and the state it should be in)
+# and produces a minimal patch: a list of operations that turn one into the
+# other. Patches can be applied in memory or through a PlistEditor, which
+# writes the result out in a single atomic write.
+#
+# Key paths in operations are tuples of dictionary keys and integer array
+# indexes, the same as the key paths yielded by `plist_editor.iter_plist()`.
+#
+####
+
+## Imports
+import collections
+import datetime
+import difflib
+import plistlib
+
+SET    = 'set'
+DELETE = 'delete'
+INSERT = 'insert'
+
+# A single change. For SET, 'value' replaces (or creates) the value at 'path';
+# for DELETE, the value at 'path' is removed and 'value' is None; for INSERT,
+# 'value' is inserted into an array before the index at the end of 'path'.
+# Operations are meant to be applied in order: the indexes in each one refer
+# to the arrays as they are after the operations before it.
+Operation = collections.namedtuple('Operation', ['op', 'path', 'value'])
+
+
+class PatchError(ValueError):
+    """
+    Raised when a patch does not fit the plist it is applied to.
+    """
+    pass
+
+
+def _kind(value):
+    """
+    :return: the plist type of a value, so that e.g. True, 1 and 1.0 are never
+             considered equal to each other
+    """
+    if isinstance(value, bool):
+        return 'boolean'
+    elif isinstance(value, (int, long)):
+        return 'integer'
+    elif isinstance(value, float):
+        return 'real'
+    elif isinstance(value, basestring):
+        return 'string'
+    elif isinstance(value, datetime.datetime):
+        return 'date'
+    elif isinstance(value, plistlib.Data):
+        return 'data'
+    elif isinstance(value, dict):
+        return 'dict'
+    elif isinstance(value, (list, tuple)):
+        return 'array'
+    return type(value).__name__
+
+
+def _freeze(value):
+    """
+    :return: a hashable form of the value which is equal for two values only
+             if they are the same plist value
+    """
+    kind = _kind(value)
+    if kind == 'dict':
+        return kind, tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    elif kind == 'array':
+        return kind, tuple(_freeze(v) for v in value)
+    elif kind == 'data':
+        return kind, value.data
+    return kind, value
+
+
+def diff(old, new, prune=True):
+    """
+    Compute the operations that turn 'old' into 'new'. Dictionaries and arrays
+    are compared element by element so that only what actually differs is
+    touched; arrays are aligned on their longest matching runs, so inserting
+    one item into the middle of an array produces a single INSERT.
+
+    When comparing a plist against a desired state which only mentions the
+    keys that matter, pass prune=False so that keys missing from 'new' are
+    left alone rather than deleted.
+
+    :param old: the current value (usually a plist's root dictionary)
+    :param new: the value it should become
+    :param prune: whether to delete dictionary keys that are not in 'new'
+    :return: a list of Operations (empty if there are no differences)
+    """
+    operations = []
+    _diff(old, new, (), prune, operations)
+    return operations
+
+
+def _diff(old, new, path, prune, operations):
+    kind = _kind(old)
+    if kind != _kind(new):
+        operations.append(Operation(SET, path, new))
+    elif kind == 'dict':
+        for key in sorted(old.keys()):
+            if key not in new:
+                if prune:
+                    operations.append(Operation(DELETE, path + (key,), None))
+            else:
+                _diff(old[key], new[key], path + (key,), prune, operations)
+        for key in sorted(new.keys()):
+            if key not in old:
+                operations.append(Operation(SET, path + (key,), new[key]))
+    elif kind == 'array':
+        _diff_arrays(old, new, path, prune, operations)
+    elif _freeze(old) != _freeze(new):
+        operations.append(Operation(SET, path, new))
+
+
+def _diff_arrays(old, new, path, prune, operations):
+    """
+    Array changes are worked out from the end of the arrays backwards, so that
+    applying one operation never shifts the indexes used by the next.
+    """
+    matcher = difflib.SequenceMatcher(None, [_freeze(v) for v in old], [_freeze(v) for v in new], autojunk=False)
+    for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+        if tag == 'equal':
+            continue
+        # Pair up replaced items so that changes within them stay small.
+        common = min(i2 - i1, j2 - j1)
+        for index in reversed(range(i1 + common, i2)):
+            operations.append(Operation(DELETE, path + (index,), None))
+        for offset in range(common, j2 - j1):
+            operations.append(Operation(INSERT, path + (i1 + offset,), new[j1 + offset]))
+        for offset in reversed(range(common)):
+            _diff(old[i1 + offset], new[j1 + offset], path + (i1 + offset,), prune, operations)
+
+
+def apply(root, operations):
+    """
+    Apply a patch to a plist value. The original value is never modified: the
+    containers along each operation's path are copied, and everything else is
+    shared with the original.
+
+    :param root: the value to patch (usually a plist's root dictionary)
+    :param operations: the Operations to apply, in order
+    :return: the patched value
+    :raises PatchError: if an operation does not fit the value
+    """
+    for operation in operations:
+        root = _apply(root, operation, tuple(operation.path))
+    return root
+
+
+def _apply(node, operation, path):
+    if not path:
+        if operation.op == SET:
+            return operation.value
+        raise PatchError("Cannot {} the root of a plist.".format(operation.op))
+
+    key = path[0]
+    if isinstance(node, dict):
+        node = dict(node)
+    elif isinstance(node, list):
+        node = list(node)
+        if not isinstance(key, (int, long)):
+            raise PatchError("Array index expected at {}.".format(operation.path))
+    else:
+        raise PatchError("No container at {}.".format(operation.path))
+
+    try:
+        if len(path) > 1:
+            node[key] = _apply(node[key], operation, path[1:])
+        elif operation.op == SET:
+            node[key] = operation.value
+        elif operation.op == DELETE:
+            del node[key]
+        elif operation.op == INSERT:
+            if not isinstance(node, list) or not 0 <= key <= len(node):
+                raise PatchError("Cannot insert at {}.".format(operation.path))
+            node.insert(key, operation.value)
+        else:
+            raise PatchError("Unknown operation '{}'.".format(operation.op))
+    except (KeyError, IndexError):
+        raise PatchError("Nothing at {}.".format(operation.path))
+    return node
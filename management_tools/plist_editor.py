@@ -1,16 +1,771 @@
+import base64
+import binascii
+import collections
+import contextlib
+import datetime
 import os
+import plistlib
+import re
 import subprocess
+import tempfile
+import threading
+import time
+from xml.etree import cElementTree as ElementTree
+
+import bplist
+import plist_diff
+from concurrency import run_pool
+
+# The on-disk formats, named the same way `plutil -convert` names them.
+FORMAT_XML    = 'xml1'
+FORMAT_BINARY = 'binary1'
+
+# 'native' parses and writes plists in-process; 'defaults' calls out to the
+# `defaults` command for every operation.
+BACKENDS        = ['native', 'defaults']
+DEFAULT_BACKEND = 'native'
+
+# Plists larger than this (in bytes) are not loaded whole just to read a key;
+# only the path to the key is decoded.
+LAZY_THRESHOLD = 1024 * 1024
+
+VALID_TYPES = ['string', 'data', 'int', 'integer', 'float', 'bool', 'boolean', 'data', 'array', 'array-add', 'dict', 'dict-add']
+
+
+def plist_format(path):
+    '''Returns the format of the plist at 'path' (either FORMAT_XML or
+    FORMAT_BINARY) judging by the file's header.
+
+    path -- the location of the plist in the file system
+    '''
+    with open(path, 'rb') as f:
+        header = f.read(len(bplist.HEADER))
+    return FORMAT_BINARY if bplist.is_binary(header) else FORMAT_XML
+
+
+def read_plist(path):
+    '''Parses the plist at 'path' in-process and returns its root object.  Both
+    XML and binary plists are understood.
+
+    path -- the location of the plist in the file system
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    if bplist.is_binary(data):
+        return bplist.read(data)
+    return plistlib.readPlistFromString(data)
+
+
+def encode_plist(root, format=FORMAT_XML):
+    '''Returns 'root' encoded as a plist in the given format.
+
+    root   -- the object to encode (usually a dictionary)
+    format -- FORMAT_XML or FORMAT_BINARY
+    '''
+    if format == FORMAT_BINARY:
+        return bplist.dumps(root)
+    elif format == FORMAT_XML:
+        return plistlib.writePlistToString(root)
+    raise ValueError("Format not valid.  Must be one of " + str([FORMAT_XML, FORMAT_BINARY]))
+
+
+def write_plist(root, path, format=FORMAT_XML):
+    '''Writes 'root' to 'path' atomically: the plist is written to a temporary
+    file in the same directory and then renamed over the original, so readers
+    see either the old contents or the new ones and never a partial file.  The
+    original file's mode (and ownership, when running as root) is kept.
+
+    root   -- the object to write out (usually a dictionary)
+    path   -- the location of the plist in the file system
+    format -- FORMAT_XML or FORMAT_BINARY
+    '''
+    data = encode_plist(root, format)
+    directory, name = os.path.split(os.path.abspath(path))
+    try:
+        original = os.stat(path)
+    except OSError:
+        original = None
+
+    descriptor, temp_path = tempfile.mkstemp(prefix='.' + name + '.', dir=directory)
+    try:
+        with os.fdopen(descriptor, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if original:
+            os.chmod(temp_path, original.st_mode & 0o7777)
+            if os.geteuid() == 0:
+                os.chown(temp_path, original.st_uid, original.st_gid)
+        else:
+            os.chmod(temp_path, 0o644)
+        os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def split_key_path(key_path):
+    '''Splits a key path such as 'NSRecentDocuments/0/Name' into a list of its
+    components.  Lists and tuples are taken to be already split, which allows
+    addressing keys that contain a '/'.
+
+    key_path -- the key path to split (None or '' for the root)
+    '''
+    if not key_path:
+        return []
+    if isinstance(key_path, (list, tuple)):
+        components = list(key_path)
+    else:
+        components = [c for c in key_path.split('/') if c]
+    return [_component(c) for c in components]
+
+
+def _component(component):
+    '''Normalizes a key path component so that it compares equal to the keys
+    plistlib and bplist hand back (plain strings when ASCII, unicode otherwise).
+    '''
+    if isinstance(component, (int, long)):
+        return str(component)
+    if isinstance(component, str):
+        try:
+            component.decode('ascii')
+        except UnicodeError:
+            return component.decode('utf-8')
+    return component
+
+
+def _walk(root, components):
+    '''Follows the key path components down from 'root'.  Raises a KeyError
+    if the path does not exist.
+    '''
+    value = root
+    for component in components:
+        try:
+            if isinstance(value, dict):
+                value = value[component]
+            elif isinstance(value, list):
+                value = value[int(component)]
+            else:
+                raise KeyError(component)
+        except (IndexError, ValueError):
+            raise KeyError(component)
+    return value
+
+
+def _element_value(element):
+    '''Converts an XML plist element (and everything in it) into the value
+    plistlib would have produced for it.
+    '''
+    tag = element.tag
+    if tag == 'dict':
+        children = list(element)
+        return dict(
+            (_element_value(children[i]), _element_value(children[i + 1]))
+            for i in range(0, len(children) - 1, 2)
+        )
+    elif tag == 'array':
+        return [_element_value(child) for child in element]
+    elif tag == 'true':
+        return True
+    elif tag == 'false':
+        return False
+    elif tag == 'integer':
+        return int(element.text)
+    elif tag == 'real':
+        return float(element.text)
+    elif tag == 'date':
+        return datetime.datetime.strptime(element.text.strip(), '%Y-%m-%dT%H:%M:%SZ')
+    elif tag == 'data':
+        return plistlib.Data(base64.b64decode(element.text or ''))
+    elif tag in ('string', 'key'):
+        return _component(element.text or '')
+    raise ValueError("Unknown plist element: <" + str(tag) + ">")
+
+
+_CONTAINER_TAGS = ('dict', 'array')
+
+def _iter_xml(f):
+    '''Parses an XML plist incrementally and yields (key path, element) for
+    each value that is not a container and for each empty container.  Each
+    element is discarded once it has been handed out, so memory use depends on
+    how deeply the plist is nested and not on its size.
+
+    f -- an open file containing an XML plist
+    '''
+    # Each frame is [key path, element, container tag, pending key, index].
+    stack = []
+    for event, element in ElementTree.iterparse(f, events=('start', 'end')):
+        tag = element.tag
+        if event == 'start':
+            if tag in _CONTAINER_TAGS:
+                stack.append([_child_path(stack), element, tag, None, 0])
+            continue
+        if tag == 'plist':
+            break
+        if tag == 'key':
+            stack[-1][3] = _component(element.text or '')
+        elif tag in _CONTAINER_TAGS:
+            frame = stack.pop()
+            if frame[4] == 0:
+                yield frame[0], element
+            _advance(stack)
+        else:
+            yield _child_path(stack), element
+            _advance(stack)
+        # Drop everything parsed so far within the enclosing container.
+        if stack:
+            stack[-1][1].clear()
+
+
+def _child_path(stack):
+    '''Returns the key path of the next value in the innermost container.
+    '''
+    if not stack:
+        return ()
+    frame = stack[-1]
+    return frame[0] + ((frame[3] if frame[2] == 'dict' else frame[4]),)
+
+
+def _advance(stack):
+    '''Moves the innermost container on to its next value.
+    '''
+    if stack:
+        stack[-1][3] = None
+        stack[-1][4] += 1
+
+
+def _index(component):
+    '''Returns a key path component as an array index, the way _walk() and
+    bplist read it (so '-1' is the last element), or None if it is not one.
+    '''
+    if isinstance(component, (int, long)):
+        return component
+    try:
+        return int(component)
+    except (TypeError, ValueError):
+        return None
+
+
+def _matches(path, components):
+    '''Returns whether a key path (with integer array indexes) begins with
+    the given key path components (where indexes may be strings, but not
+    negative; see _resolve_indexes()).
+    '''
+    if len(path) < len(components):
+        return False
+    for part, component in zip(path, components):
+        if part != component and not (isinstance(part, int) and _index(component) == part):
+            return False
+    return True
+
+
+def _resolve_indexes(path, components):
+    '''Returns the key path components with any negative array indexes
+    replaced by the index they count back to, so that they can be matched
+    against the key paths of a streamed XML plist.  Each negative index costs
+    a pass over the file (up to the end of its array) to count the array's
+    elements.  Raises a KeyError if an index is out of range.
+    '''
+    components = list(components)
+    for i, component in enumerate(components):
+        index = _index(component)
+        if index is None or index >= 0:
+            continue
+        length = 0
+        array = None
+        with open(path, 'rb') as f:
+            for item_path, element in _iter_xml(f):
+                if len(item_path) > i and _matches(item_path, components[:i]):
+                    array = isinstance(item_path[i], int)
+                    if not array:
+                        break
+                    length = max(length, item_path[i] + 1)
+                elif array is not None:
+                    break
+        if not array:
+            # Not in an array (in a dictionary, '-1' is just a key).
+            continue
+        if index + length < 0:
+            raise KeyError(component)
+        components[i] = str(index + length)
+    return components
+
+
+def _assemble(items):
+    '''Rebuilds a value from the (relative key path, value) items yielded by
+    iter_plist(), in the order they were yielded.
+    '''
+    root = None
+    for path, value in items:
+        if not path:
+            return value
+        if root is None:
+            root = [] if isinstance(path[0], int) else {}
+        node = root
+        for part, following in zip(path, path[1:]):
+            if isinstance(node, list) and part == len(node):
+                node.append([] if isinstance(following, int) else {})
+            elif isinstance(node, dict) and part not in node:
+                node[part] = [] if isinstance(following, int) else {}
+            node = node[part]
+        if isinstance(node, list):
+            node.append(value)
+        else:
+            node[path[-1]] = value
+    if root is None:
+        raise KeyError(None)
+    return root
+
+
+def iter_plist(path, key_path=None):
+    '''Yields (key path, value) for every value under 'key_path' that is not
+    itself a container, plus one for each empty container, in file order.  Key
+    paths are tuples of dictionary keys and integer array indexes, relative to
+    'key_path'.  Values are in plistlib's form (see native_value).
+
+    The plist is never loaded whole: XML plists are parsed incrementally and
+    binary plists are memory-mapped and decoded one value at a time, so memory
+    use stays bounded however large the file is.  Stopping the iteration early
+    stops the parsing too, and for XML plists the iteration ends as soon as
+    the value at 'key_path' has been read.
+
+    path     -- the location of the plist in the file system
+    key_path -- the key path to start from (None for the whole plist)
+    '''
+    components = split_key_path(key_path)
+    if plist_format(path) == FORMAT_BINARY:
+        with bplist.BinaryPlistReader.from_path(path) as reader:
+            try:
+                for item in reader.iter_items(components):
+                    yield item
+            except KeyError:
+                return
+        return
+
+    try:
+        components = _resolve_indexes(path, components)
+    except KeyError:
+        return
+    depth = len(components)
+    found = False
+    with open(path, 'rb') as f:
+        for item_path, element in _iter_xml(f):
+            if _matches(item_path, components):
+                found = True
+                value = _element_value(element)
+                yield item_path[depth:], value
+            elif found:
+                return
+
+
+def lookup_plist(path, key_path=None):
+    '''Returns the value at 'key_path' in the plist at 'path', decoding only
+    the parts of the file on the way to that value.  Binary plists are memory-
+    mapped rather than read, so the cost depends on how much is decoded and
+    not on the size of the file; XML plists are parsed incrementally and only
+    until the value has been read.  Raises a KeyError if the path does not
+    exist.  Values are in plistlib's form (see native_value).
+
+    path     -- the location of the plist in the file system
+    key_path -- the key path to read, such as 'NSRecentDocuments/0/Name'
+    '''
+    components = split_key_path(key_path)
+    if plist_format(path) == FORMAT_BINARY:
+        with bplist.BinaryPlistReader.from_path(path) as reader:
+            return reader.lookup(components)
+    return _assemble(iter_plist(path, components))
+
+
+def native_value(value):
+    '''Returns a copy of a plist value with plistlib's wrappers removed, so
+    that data is given as a plain string of bytes.
+    '''
+    if isinstance(value, plistlib.Data):
+        return value.data
+    elif isinstance(value, dict):
+        return dict((k, native_value(v)) for k, v in value.items())
+    elif isinstance(value, list):
+        return [native_value(v) for v in value]
+    return value
+
+
+class PlistCache(object):
+    '''A cache of parsed plists, keyed by path and shared by every PlistEditor
+    in the process.  An entry is only used while the file's modification time,
+    size and inode are unchanged, so a repeated read of an unchanged plist
+    costs a single stat() instead of a parse.  The least recently used entries
+    are evicted once either limit is reached.
+
+    The cached roots are shared, so they must never be modified in place.
+    '''
+
+    def __init__(self, max_entries=256, max_bytes=32 * 1024 * 1024):
+        '''Creates an empty cache.
+
+        max_entries -- the most plists to keep at once
+        max_bytes   -- the most plist data (measured by file size) to keep
+        '''
+        self.max_entries = max_entries
+        self.max_bytes   = max_bytes
+        self.hits        = 0
+        self.misses      = 0
+        self.evictions   = 0
+        self.__entries   = collections.OrderedDict()
+        self.__bytes     = 0
+        self.__lock      = threading.Lock()
+
+    def load(self, path, max_size=None):
+        '''Returns a tuple of (root, format) for the plist at 'path', parsing
+        it only if there is no up-to-date entry for it.  If 'max_size' is given
+        and the plist is not cached and is larger than that, (None, None) is
+        returned instead of parsing it.
+
+        path     -- the location of the plist in the file system
+        max_size -- the largest file (in bytes) to parse on a miss
+        '''
+        path = os.path.abspath(path)
+        info = os.stat(path)
+        signature = (info.st_mtime, info.st_size, info.st_ino)
+        with self.__lock:
+            entry = self.__entries.pop(path, None)
+            if entry is not None:
+                if entry[0] == signature:
+                    self.__entries[path] = entry
+                    self.hits += 1
+                    return entry[1], entry[2]
+                self.__bytes -= entry[0][1]
+            self.misses += 1
+        if max_size is not None and info.st_size > max_size:
+            return None, None
+        format = plist_format(path)
+        root = read_plist(path)
+        self.__store(path, signature, root, format)
+        return root, format
+
+    def get(self, path):
+        '''Returns the parsed root of the plist at 'path'.
+
+        path -- the location of the plist in the file system
+        '''
+        return self.load(path)[0]
+
+    def put(self, path, root, format):
+        '''Records 'root' as the current contents of the plist at 'path', e.g.
+        right after writing it out.
+
+        path   -- the location of the plist in the file system
+        root   -- the plist's root object
+        format -- FORMAT_XML or FORMAT_BINARY
+        '''
+        path = os.path.abspath(path)
+        info = os.stat(path)
+        self.__store(path, (info.st_mtime, info.st_size, info.st_ino), root, format)
+
+    def __store(self, path, signature, root, format):
+        size = signature[1]
+        if size > self.max_bytes:
+            self.invalidate(path)
+            return
+        with self.__lock:
+            entry = self.__entries.pop(path, None)
+            if entry is not None:
+                self.__bytes -= entry[0][1]
+            self.__entries[path] = (signature, root, format)
+            self.__bytes += size
+            while self.__entries and (len(self.__entries) > self.max_entries or self.__bytes > self.max_bytes):
+                evicted = self.__entries.popitem(last=False)[1]
+                self.__bytes -= evicted[0][1]
+                self.evictions += 1
+
+    def invalidate(self, path=None):
+        '''Drops the entry for 'path', or every entry if no path is given.
+
+        path -- the location of the plist in the file system
+        '''
+        with self.__lock:
+            if path is None:
+                self.__entries.clear()
+                self.__bytes = 0
+                return
+            entry = self.__entries.pop(os.path.abspath(path), None)
+            if entry is not None:
+                self.__bytes -= entry[0][1]
+
+    def stats(self):
+        '''Returns a dictionary of the cache's counters and current size.
+        '''
+        with self.__lock:
+            return {
+                'entries':   len(self.__entries),
+                'bytes':     self.__bytes,
+                'hits':      self.hits,
+                'misses':    self.misses,
+                'evictions': self.evictions,
+            }
+
+
+# The cache used by every PlistEditor.  Its limits may be changed directly,
+# e.g. `shared_cache.max_entries = 1000`.
+shared_cache = PlistCache()
+
+
+# The result of reading one plist with read_many().  'values' maps each key
+# path that was asked for to its native value (None if it is not present), and
+# 'error' is the exception raised while reading the plist, if any.
+ReadResult = collections.namedtuple('ReadResult', ['path', 'values', 'error'])
+
+
+def _read_keys(task):
+    '''Reads the key paths from one plist for read_many().  This is a module-
+    level function so that it can be handed to a process pool.
+
+    task -- a tuple of (path, key paths)
+    '''
+    path, keys = task
+    try:
+        root, format = shared_cache.load(path, LAZY_THRESHOLD)
+        values = {}
+        for key in keys:
+            components = split_key_path(key)
+            try:
+                if root is not None:
+                    value = _walk(root, components)
+                else:
+                    value = lookup_plist(path, components)
+            except KeyError:
+                values[key] = None
+            else:
+                values[key] = native_value(value)
+        return ReadResult(path, values, None)
+    except Exception as e:
+        return ReadResult(path, {}, e)
+
+
+def read_many(paths, keys, workers=None, processes=False):
+    '''Reads the same key paths from many plists at once, yielding a ReadResult
+    for each plist as soon as it has been read (so not necessarily in the order
+    given).  A plist that cannot be read yields a result with its 'error' set
+    rather than stopping the rest of the batch.
+
+        for result in read_many(paths, ['AutoUpdate', 'Limits/MaxUsers']):
+            if result.error:
+                ...
+
+    paths     -- the plists to read (any iterable)
+    keys      -- the key paths to read from each plist
+    workers   -- how many plists to read at a time (the number of CPUs if
+                 omitted)
+    processes -- whether to use a pool of processes rather than threads, so
+                 that parsing is spread over several CPUs
+    '''
+    keys = list(keys)
+    tasks = ((str(path), keys) for path in paths)
+    return run_pool(_read_keys, tasks, workers, processes)
+
+
+# The result of converting one plist with convert_plist() or convert_tree().
+# 'converted' is False for plists that were already in the requested format
+# (and for every plist in a dry run); 'new_size' is what the file's size is (or
+# would be) in the requested format.
+ConvertResult = collections.namedtuple(
+    'ConvertResult',
+    ['path', 'old_format', 'old_size', 'new_size', 'seconds', 'converted', 'error']
+)
+
+
+def convert_plist(path, format, dry_run=False):
+    '''Converts the plist at 'path' to the given format in place (atomically),
+    unless it is already in that format.  Returns a ConvertResult; errors are
+    reported in the result rather than raised.
+
+    path    -- the location of the plist in the file system
+    format  -- FORMAT_XML or FORMAT_BINARY
+    dry_run -- only measure what the conversion would do, writing nothing
+    '''
+    start = time.time()
+    old_format = None
+    old_size = None
+    try:
+        old_size = os.path.getsize(path)
+        old_format = plist_format(path)
+        if old_format == format:
+            return ConvertResult(path, old_format, old_size, old_size, time.time() - start, False, None)
+        root = read_plist(path)
+        if dry_run:
+            new_size = len(encode_plist(root, format))
+        else:
+            write_plist(root, path, format)
+            new_size = os.path.getsize(path)
+        return ConvertResult(path, old_format, old_size, new_size, time.time() - start, not dry_run, None)
+    except Exception as e:
+        return ConvertResult(path, old_format, old_size, None, time.time() - start, False, e)
+
+
+def _convert_task(task):
+    '''Unpacks the arguments for convert_plist() from a pool task.
+    '''
+    return convert_plist(*task)
+
+
+def find_plists(root):
+    '''Yields the path of every '.plist' file under the directory 'root'.
+    Symbolic links are not followed.
+
+    root -- the directory to search
+    '''
+    for directory, subdirectories, files in os.walk(root):
+        for name in files:
+            path = os.path.join(directory, name)
+            if name.endswith('.plist') and not os.path.islink(path):
+                yield path
+
+
+def convert_tree(root, format, workers=None, dry_run=False, processes=False):
+    '''Converts every plist under the directory 'root' to the given format,
+    several files at a time.  Each file is replaced atomically, and files
+    already in the requested format are left alone (only their header is
+    read).  Yields a ConvertResult for each file as it finishes.
+
+    root      -- the directory to convert
+    format    -- FORMAT_XML or FORMAT_BINARY
+    workers   -- how many files to convert at a time (the number of CPUs if
+                 omitted)
+    dry_run   -- only report sizes and timings, writing nothing
+    processes -- whether to use a pool of processes rather than threads
+    '''
+    if format not in (FORMAT_XML, FORMAT_BINARY):
+        raise ValueError("Format not valid.  Must be one of " + str([FORMAT_XML, FORMAT_BINARY]))
+    tasks = ((path, format, dry_run) for path in find_plists(root))
+    return run_pool(_convert_task, tasks, workers, processes)
+
+
+def _type_name(value):
+    '''Returns the name `defaults read-type` would give the value's type.
+    '''
+    if isinstance(value, bool):
+        return 'boolean'
+    elif isinstance(value, (int, long)):
+        return 'integer'
+    elif isinstance(value, float):
+        return 'float'
+    elif isinstance(value, datetime.datetime):
+        return 'date'
+    elif isinstance(value, plistlib.Data):
+        return 'data'
+    elif isinstance(value, list):
+        return 'array'
+    elif isinstance(value, dict):
+        return 'dictionary'
+    return 'string'
+
+
+_BARE_STRING = re.compile(r'^[\w.$:/]+$')
+
+def _format_value(value, indent=''):
+    '''Formats a value the way `defaults read` prints it, so that the native
+    backend returns the same text as the 'defaults' backend.
+
+    value  -- the value to format
+    indent -- the indentation of the enclosing container
+    '''
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    elif isinstance(value, float):
+        return str(int(value)) if value.is_integer() else repr(value)
+    elif isinstance(value, (int, long)):
+        return str(value)
+    elif isinstance(value, datetime.datetime):
+        return '"' + value.strftime('%Y-%m-%d %H:%M:%S +0000') + '"'
+    elif isinstance(value, plistlib.Data):
+        data = binascii.hexlify(value.data)
+        return '<' + ' '.join(data[i:i + 8] for i in range(0, len(data), 8)) + '>'
+    elif isinstance(value, list):
+        inner = indent + '    '
+        items = [inner + _format_value(v, inner) for v in value]
+        return '(\n' + ',\n'.join(items) + ('\n' if items else '') + indent + ')'
+    elif isinstance(value, dict):
+        inner = indent + '    '
+        items = [
+            inner + _format_value(k, inner) + ' = ' + _format_value(value[k], inner) + ';'
+            for k in sorted(value.keys())
+        ]
+        return '{\n' + ''.join(i + '\n' for i in items) + indent + '}'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    if _BARE_STRING.match(value):
+        return value
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _convert(value, type, existing=None):
+    '''Converts a value given on the command-line style interface (usually a
+    string) into the native value `defaults write` would store for 'type'.
+
+    value    -- the value to convert
+    type     -- the type of value (boolean, integer, etc.)
+    existing -- the value currently stored, for the '-add' types
+    '''
+    if type == 'string':
+        return value if isinstance(value, basestring) else str(value)
+    elif type == 'data':
+        if isinstance(value, plistlib.Data):
+            return value
+        try:
+            return plistlib.Data(binascii.unhexlify(str(value).replace(' ', '')))
+        except (TypeError, binascii.Error):
+            raise ValueError("Data must be given as a hexadecimal string.")
+    elif type in ('int', 'integer'):
+        return int(value)
+    elif type == 'float':
+        return float(value)
+    elif type in ('bool', 'boolean'):
+        if isinstance(value, bool):
+            return value
+        if str(value).lower() in ('true', 'yes', '1'):
+            return True
+        if str(value).lower() in ('false', 'no', '0'):
+            return False
+        raise ValueError("Boolean value not valid: '" + str(value) + "'")
+    elif type in ('array', 'array-add'):
+        if existing is None:
+            existing = []
+        elif not isinstance(existing, list):
+            raise ValueError("Existing value is not an array.")
+        return existing + (list(value) if isinstance(value, (list, tuple)) else [value])
+    elif type in ('dict', 'dict-add'):
+        if not isinstance(value, dict):
+            raise ValueError("Dictionary values must be given as a dict.")
+        if existing is None:
+            existing = {}
+        elif not isinstance(existing, dict):
+            raise ValueError("Existing value is not a dictionary.")
+        result = dict(existing)
+        result.update(value)
+        return result
+    raise ValueError("Type not valid.  Must be one of " + str(VALID_TYPES))
+
 
 class PlistEditor:
     '''Creates an object which can directly interact with a plist.  This makes
     it easier to go about editing plist files in non-standard locations.
+
+    By default plists are parsed and written in-process (the 'native' backend):
+    the file is parsed once, reads are served from the parsed tree, and writes
+    replace the file atomically.  Passing backend='defaults' calls the
+    `defaults` command for every operation instead, which goes through
+    cfprefsd and is the safer choice for preference domains that are in active
+    use by a running application.
     '''
 
-    def __init__(self, path):
+    read_many = staticmethod(read_many)
+
+    def __init__(self, path, backend=None):
         '''Creates the PlistEditor object.  The specified plist must be readable
         and exist for this to pass successfully (does not create a new plist).
 
-        path -- the location of the plist in the file system
+        path    -- the location of the plist in the file system
+        backend -- either 'native' or 'defaults' (DEFAULT_BACKEND if omitted)
         '''
         if not path.endswith('.plist'):
             path = path + '.plist'
@@ -18,8 +773,15 @@ class PlistEditor:
             raise IOError(".plist file '" + str(path) + "' is not a valid path.")
         if not os.access(path, os.R_OK):
             raise IOError(".plist file '" + str(path) + "' is not readable.")
+        if backend is None:
+            backend = DEFAULT_BACKEND
+        if not backend in BACKENDS:
+            raise ValueError("Backend not valid.  Must be one of " + str(BACKENDS))
         self.path = str(path)
         self.list = str(path[:-6])
+        self.backend = backend
+        self.__format = None
+        self.__pending = None
 
     def __repr__(self):
         '''Returns a nicely formatted string.
@@ -27,26 +789,102 @@ class PlistEditor:
 
         return str(self.path)
 
+    def __load(self):
+        '''Returns the parsed root of the plist from the shared cache, which
+        re-parses the file only if it has changed since it was last read.
+        Within a transaction, the pending (uncommitted) root is returned
+        instead.
+        '''
+        if self.__pending is not None:
+            return self.__pending
+        root, self.__format = shared_cache.load(self.path)
+        return root
+
+    def __save(self, root):
+        '''Writes the root back out in the plist's original format.  Within a
+        transaction, the root is only kept in memory until the commit.
+        '''
+        if self.__pending is not None:
+            self.__pending = root
+            return
+        write_plist(root, self.path, self.__format or FORMAT_XML)
+        shared_cache.put(self.path, root, self.__format or FORMAT_XML)
+
+    def __lookup(self, components):
+        '''Returns the value at the key path components, in plistlib's form.
+        The plist is loaded through the shared cache unless it is larger than
+        LAZY_THRESHOLD (and not already cached), in which case only the path
+        to the value is decoded from the file.
+        '''
+        if self.__pending is not None:
+            return _walk(self.__pending, components)
+        root, format = shared_cache.load(self.path, LAZY_THRESHOLD)
+        if root is not None:
+            self.__format = format
+            return _walk(root, components)
+        return lookup_plist(self.path, components)
+
+    def __check_writable(self, action='writable'):
+        if not os.access(self.path, os.W_OK):
+            raise IOError(".plist file '" + self.path + "' is not " + action + ".")
+
     def read(self, key=None):
         '''Returns either the entire plist (if key is left blank) or the
         specified key's value as a string.
 
         key -- the key in the plist to read
         '''
-        result = ''
-        if not key:
-            try:
-                result = subprocess.check_output(['defaults', 'read', self.list], stderr=subprocess.STDOUT)
-            except subprocess.CalledProcessError:
-                return ''
-        else:
-            try:
-                result = subprocess.check_output(['defaults', 'read', self.list, str(key)], stderr=subprocess.STDOUT)
-            except subprocess.CalledProcessError:
-                return ''
-        if result.endswith('\n'):
-            result = result[:-1]
-        return result
+        if self.backend == 'defaults':
+            return self.__defaults_read(key)
+        try:
+            if not key:
+                return _format_value(self.__load())
+            value = self.__lookup(split_key_path([str(key)]))
+        except Exception:
+            return ''
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        if isinstance(value, basestring):
+            return value
+        return _format_value(value)
+
+    def get(self, key_path=None, default=None):
+        '''Returns the value at the given key path as a native Python value
+        (string, int, float, bool, datetime, bytes, list, or dict), or
+        'default' if there is no such value.  Key paths address nested
+        dictionaries and arrays, e.g. 'NSRecentDocuments/0/Name'; a list of
+        components may be given instead for keys containing a '/'.
+
+        Plists up to LAZY_THRESHOLD bytes are parsed once and kept in the
+        shared cache; for larger ones only the part of the plist leading to the
+        value is decoded.  The file is always read directly, even with the
+        'defaults' backend.
+
+        key_path -- the key path to read (None for the entire plist)
+        default  -- the value to return if the key path does not exist
+        '''
+        try:
+            value = self.__lookup(split_key_path(key_path))
+        except KeyError:
+            return default
+        return native_value(value)
+
+    def iter_items(self, key_path=None):
+        '''Yields (key path, value) for every value under 'key_path' that is
+        not itself a container, plus one for each empty container, without
+        loading the plist into memory.  Key paths are tuples relative to
+        'key_path'; values are native Python values as with get().  Breaking
+        out of the loop early stops reading the file.  This always reads the
+        file on disk, so changes pending in a transaction are not seen.
+
+            for path, value in plist.iter_items('PayloadContent'):
+                if path[-1] == 'PayloadIdentifier':
+                    break
+
+        key_path -- the key path to start from (None for the whole plist)
+        '''
+        for item_path, value in iter_plist(self.path, key_path):
+            yield item_path, native_value(value)
 
     def type(self, key):
         '''Returns the type of the specified key as a string.
@@ -55,66 +893,200 @@ class PlistEditor:
         '''
         if not key:
             raise ValueError("Must provide a key.")
+        if self.backend == 'defaults':
+            return self.__defaults_type(key)
         try:
-            result = subprocess.check_output(['defaults', 'read-type', self.list, str(key)])
-        except subprocess.CalledProcessError:
+            value = self.__lookup(split_key_path([str(key)]))
+        except Exception:
             raise ValueError("Must provide a valid key for '" + self.path + "'.")
-        return result.split()[-1]
+        return _type_name(value)
 
     def write(self, key, value, type="string"):
         '''Writes the specified value to the specified key in a given type.  If
         no type is given, the default is 'string'.  Returns the exit code of the
-        defaults command.
+        defaults command (always 0 for the native backend).
 
         key   -- the key to write to
         value -- the value to put in the key
         type  -- the type of value (boolean, integer, etc.)
         '''
-        if not os.access(self.path, os.W_OK):
-            raise IOError(".plist file '" + self.path + "' is not writable.")
+        self.__check_writable()
         if not key:
             raise ValueError("Must provide a key.")
-        valids = ['string', 'data', 'int', 'integer', 'float', 'bool', 'boolean', 'data', 'array', 'array-add', 'dict', 'dict-add']
-        if not type in valids:
-            raise ValueError("Type not valid.  Must be one of " + str(valids))
-        elif type == 'array':
-            option = '-array-add'
-        elif type == 'dict':
-            option = '-dict-add'
-        else:
-            option = '-' + type
-        return subprocess.call(['defaults', 'write', self.list, str(key), option, str(value)])
+        if not type in VALID_TYPES:
+            raise ValueError("Type not valid.  Must be one of " + str(VALID_TYPES))
+        if self.backend == 'defaults':
+            return self.__defaults_write(key, value, type)
+        root = dict(self.__load())
+        root[str(key)] = _convert(value, type, root.get(str(key)))
+        self.__save(root)
+        return 0
 
     def dict_add(self, key, nestedKey, value, type="string"):
+        '''Adds an entry to the dictionary stored at the specified key, creating
+        the dictionary if it does not exist.  Returns the exit code of the
+        defaults command (always 0 for the native backend).
+
+        key       -- the key of the dictionary
+        nestedKey -- the key within the dictionary to write to
+        value     -- the value to put in the nested key
+        type      -- the type of value (boolean, integer, etc.)
         '''
-        '''
-        if not os.access(self.path, os.W_OK):
-            raise IOError(".plist file '" + self.path + "' is not writable.")
+        self.__check_writable()
         if not key:
             raise ValueError("Must provide a key.")
         if not nestedKey:
             raise ValueError("Dictionaries require inner keys.")
-        valids = ['string', 'data', 'int', 'integer', 'float', 'bool', 'boolean', 'data', 'array', 'array-add', 'dict', 'dict-add']
-        if not type in valids:
-            raise ValueError("Type not valid.  Must be one of " + str(valids))
-        elif type == 'array':
-            option = '-array-add'
-        elif type == 'dict':
-            option = '-dict-add'
-        else:
-            option = '-' + type
-
-        return subprocess.call(['defaults', 'write', self.list, str(key), '-dict-add', str(nestedKey), option, str(value)])
+        if not type in VALID_TYPES:
+            raise ValueError("Type not valid.  Must be one of " + str(VALID_TYPES))
+        if self.backend == 'defaults':
+            return self.__defaults_dict_add(key, nestedKey, value, type)
+        root = dict(self.__load())
+        inner = root.get(str(key))
+        if inner is None:
+            inner = {}
+        elif not isinstance(inner, dict):
+            raise ValueError("Existing value for '" + str(key) + "' is not a dictionary.")
+        inner = dict(inner)
+        inner[str(nestedKey)] = _convert(value, type, inner.get(str(nestedKey)))
+        root[str(key)] = inner
+        self.__save(root)
+        return 0
 
     def delete(self, key=None):
         '''Deletes either the entire plist (if no key is given) or the specified
         entry.  This does NOT ask for confirmation, so be careful!  Returns the
-        exit code of the defaults command.
+        exit code of the defaults command (for the native backend, 1 if the key
+        did not exist and 0 otherwise).
 
         key -- the key to delete
         '''
-        if not os.access(self.path, os.W_OK):
-            raise IOError(".plist file '" + self.path + "' is not deletable.")
+        self.__check_writable('deletable')
+        if self.backend == 'defaults':
+            return self.__defaults_delete(key)
+        if not key:
+            if self.__pending is not None:
+                raise ValueError("Cannot delete the entire plist within a transaction.")
+            os.remove(self.path)
+            shared_cache.invalidate(self.path)
+            return 0
+        root = dict(self.__load())
+        if str(key) not in root:
+            return 1
+        del root[str(key)]
+        self.__save(root)
+        return 0
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''Groups several changes into a single write.  Within the 'with' block,
+        write(), dict_add() and delete() only change the plist in memory (and
+        reads see those changes).  When the block exits, the plist is written
+        out once, atomically; if the block raises an exception, every change
+        made within it is discarded and the file is left untouched.
+
+            with plist.transaction():
+                plist.write('AutoUpdate', 'true', 'bool')
+                plist.dict_add('Limits', 'MaxUsers', '5', 'int')
+                plist.delete('LegacyKey')
+
+        Nested transactions join the outermost one.  Transactions require the
+        'native' backend.
+        '''
+        if self.backend == 'defaults':
+            raise ValueError("Transactions require the 'native' backend.")
+        if self.__pending is not None:
+            yield self
+            return
+        self.__check_writable()
+        original = self.__load()
+        self.__pending = original
+        try:
+            yield self
+        except:
+            self.__pending = None
+            raise
+        root, self.__pending = self.__pending, None
+        if root is not original:
+            self.__save(root)
+
+    def diff(self, desired, prune=True):
+        '''Returns the plist_diff Operations that would turn this plist into
+        'desired' (an empty list if it already matches).  This is a cheap way
+        to check for configuration drift.
+
+        desired -- the desired contents of the plist (a dictionary), or another
+                   PlistEditor to compare against
+        prune   -- whether keys not in 'desired' should be deleted; pass False
+                   when 'desired' only lists the keys that are enforced
+        '''
+        if isinstance(desired, PlistEditor):
+            desired = desired.__load()
+        return plist_diff.diff(self.__load(), desired, prune)
+
+    def apply_patch(self, operations):
+        '''Applies plist_diff Operations to the plist in a single atomic write
+        (or, within a transaction, at the commit).  If any operation does not
+        fit the plist, a plist_diff.PatchError is raised and nothing is
+        written.  Returns 0, like write().
+
+        operations -- the Operations to apply, in order
+        '''
+        self.__check_writable()
+        if self.backend == 'defaults':
+            raise ValueError("Patches require the 'native' backend.")
+        root = self.__load()
+        patched = plist_diff.apply(root, operations)
+        if patched is not root:
+            self.__save(patched)
+        return 0
+
+    ########
+    # DEFAULTS BACKEND
+    #
+    # The original implementation: every operation is a call to `defaults`.
+    ########
+
+    def __defaults_read(self, key):
+        result = ''
+        if not key:
+            try:
+                result = subprocess.check_output(['defaults', 'read', self.list], stderr=subprocess.STDOUT)
+            except subprocess.CalledProcessError:
+                return ''
+        else:
+            try:
+                result = subprocess.check_output(['defaults', 'read', self.list, str(key)], stderr=subprocess.STDOUT)
+            except subprocess.CalledProcessError:
+                return ''
+        if result.endswith('\n'):
+            result = result[:-1]
+        return result
+
+    def __defaults_type(self, key):
+        try:
+            result = subprocess.check_output(['defaults', 'read-type', self.list, str(key)])
+        except subprocess.CalledProcessError:
+            raise ValueError("Must provide a valid key for '" + self.path + "'.")
+        return result.split()[-1]
+
+    @staticmethod
+    def __defaults_option(type):
+        if type == 'array':
+            return '-array-add'
+        elif type == 'dict':
+            return '-dict-add'
+        return '-' + type
+
+    def __defaults_write(self, key, value, type):
+        option = self.__defaults_option(type)
+        return subprocess.call(['defaults', 'write', self.list, str(key), option, str(value)])
+
+    def __defaults_dict_add(self, key, nestedKey, value, type):
+        option = self.__defaults_option(type)
+        return subprocess.call(['defaults', 'write', self.list, str(key), '-dict-add', str(nestedKey), option, str(value)])
+
+    def __defaults_delete(self, key):
         if not key:
             return subprocess.call(['defaults', 'delete', self.list])
         else:
@@ -0,0 +1,261 @@
+####
+#
+# This module watches plists for changes and reports only the keys that
+# changed. Instead of re-reading a plist every few seconds, a PlistWatcher
+# waits for the file system to say that something happened (via inotify, where
+# it is available) or checks the files' modification times, sizes and inodes
+# every so often. A plist is only parsed when one of those has changed, and the
+# callback is given the plist_diff operations between the last version seen and
+# the current one.
+#
+####
+
+## Imports
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import threading
+
+import plist_diff
+from plist_editor import shared_cache
+
+# inotify(7) constants.
+_IN_MODIFY      = 0x00000002
+_IN_ATTRIB      = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM  = 0x00000040
+_IN_MOVED_TO    = 0x00000080
+_IN_CREATE      = 0x00000100
+_IN_DELETE      = 0x00000200
+_IN_Q_OVERFLOW  = 0x00004000
+_IN_NONBLOCK    = 0o4000
+_IN_CLOEXEC     = 0o2000000
+_IN_MASK        = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM |
+                   _IN_MOVED_TO | _IN_CREATE | _IN_DELETE)
+_EVENT_HEADER   = struct.Struct('iIII')
+
+
+def _load_inotify():
+    """
+    :return: the C library if it provides inotify, otherwise None
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+_libc = _load_inotify()
+
+
+def _signature(path):
+    """
+    :return: (mtime, size, inode) of the file, or None if it does not exist
+    """
+    try:
+        info = os.stat(path)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    return (info.st_mtime, info.st_size, info.st_ino)
+
+
+class PlistWatcher(object):
+    """
+    Watches one or more plists and calls a function with the changes made to
+    each one. The function is called as `callback(path, operations)`, where
+    'operations' is the list of plist_diff Operations that turn the previous
+    contents of the plist into its current contents. A plist which is deleted
+    is treated as an empty dictionary.
+
+    Plists are watched through inotify when it is available, so an idle
+    watcher does not wake up at all. Elsewhere (e.g. on OS X), or if
+    use_inotify is False, each file is stat()ed every 'interval' seconds, and
+    parsed only if its modification time, size or inode has changed.
+    """
+    def __init__(self, paths, callback, interval=2.0, use_inotify=True):
+        """
+        :param paths: the plist (or a list of plists) to watch
+        :param callback: the function to call with (path, operations)
+        :param interval: seconds between checks when polling
+        :param use_inotify: whether to use inotify when it is available
+        """
+        if isinstance(paths, basestring):
+            paths = [paths]
+        self.paths       = [os.path.abspath(p) for p in paths]
+        self.callback    = callback
+        self.interval    = interval
+        self.use_inotify = use_inotify and _libc is not None
+        self.__signatures = {}
+        self.__contents   = {}
+        self.__thread     = None
+        self.__stopped    = threading.Event()
+        self.__wakeup     = None
+        self.__lock       = threading.Lock()
+
+        for path in self.paths:
+            self.__signatures[path], self.__contents[path] = self.__read(path)
+
+    @staticmethod
+    def __read(path):
+        """
+        :return: a tuple of the plist's signature and its parsed contents
+        """
+        signature = _signature(path)
+        if signature is None:
+            return None, {}
+        return signature, shared_cache.get(path)
+
+    def check(self, paths=None):
+        """
+        Check the plists for changes right away, calling the callback for each
+        one that has changed.
+
+        :param paths: the watched plists to check (all of them by default)
+        :return: a dictionary mapping each changed path to its operations
+        """
+        changes = {}
+        for path in paths or self.paths:
+            if _signature(path) == self.__signatures[path]:
+                continue
+            try:
+                signature, contents = self.__read(path)
+            except Exception:
+                # Most likely caught mid-write by something that does not
+                # write atomically; the next change will be picked up.
+                continue
+            operations = plist_diff.diff(self.__contents[path], contents)
+            self.__signatures[path] = signature
+            self.__contents[path]   = contents
+            if operations:
+                changes[path] = operations
+                self.callback(path, operations)
+        return changes
+
+    def start(self):
+        """
+        Start watching in a background (daemon) thread.
+        """
+        if self.__thread is not None:
+            raise RuntimeError("Watcher is already running.")
+        self.__stopped.clear()
+        self.__thread = threading.Thread(target=self.run, name='PlistWatcher')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Stop the watcher, whether it was started with start() or is running
+        run() in another thread, and wait for a thread from start() to finish.
+        """
+        with self.__lock:
+            if self.__thread is None and self.__wakeup is None:
+                return
+            self.__stopped.set()
+            if self.__wakeup is not None:
+                os.write(self.__wakeup[1], b'x')
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def run(self):
+        """
+        Watch for changes until stop() is called. This blocks, so it is
+        usually called through start(), but it may also be run directly in a
+        thread of the caller's own.
+        """
+        with self.__lock:
+            if self.__wakeup is not None:
+                raise RuntimeError("Watcher is already running.")
+            # Written to by stop(), to interrupt a select() on inotify.
+            self.__wakeup = os.pipe()
+        try:
+            if self.use_inotify:
+                descriptor = _libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+                if descriptor >= 0:
+                    try:
+                        self.__run_inotify(descriptor)
+                    finally:
+                        os.close(descriptor)
+                    return
+            self.__run_polling()
+        finally:
+            with self.__lock:
+                for descriptor in self.__wakeup:
+                    os.close(descriptor)
+                self.__wakeup = None
+                self.__stopped.clear()
+
+    def __run_polling(self):
+        while not self.__stopped.is_set():
+            self.__stopped.wait(self.interval)
+            if not self.__stopped.is_set():
+                self.check()
+
+    def __run_inotify(self, descriptor):
+        # Watch the directories rather than the files themselves, so that a
+        # plist which is replaced (by an atomic rename) is still followed.
+        watched = {}
+        for path in self.paths:
+            directory, name = os.path.split(path)
+            if directory not in watched.values():
+                if not isinstance(directory, bytes):
+                    directory = directory.encode('utf-8')
+                wd = _libc.inotify_add_watch(descriptor, directory, _IN_MASK)
+                if wd < 0:
+                    return self.__run_polling()
+                watched[wd] = directory
+        names = dict(
+            ((os.path.dirname(p), os.path.basename(p)), p) for p in self.paths
+        )
+
+        readable = [descriptor, self.__wakeup[0]]
+        while not self.__stopped.is_set():
+            ready = select.select(readable, [], [])[0]
+            if descriptor not in ready:
+                continue
+            try:
+                data = os.read(descriptor, 64 * 1024)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    continue
+                raise
+            changed = set()
+            overflowed = False
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(data):
+                wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                if mask & _IN_Q_OVERFLOW:
+                    # Events were lost, so any of the plists may have changed.
+                    overflowed = True
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                path = names.get((watched.get(wd), name))
+                if path is not None:
+                    changed.add(path)
+            if overflowed:
+                self.check()
+            elif changed:
+                self.check(sorted(changed))
+
+
+def watch(paths, callback, interval=2.0):
+    """
+    Start watching plists in the background. Call stop() on the returned
+    watcher when done.
+
+    :param paths: the plist (or a list of plists) to watch
+    :param callback: the function to call with (path, operations)
+    :param interval: seconds between checks when inotify is not available
+    :return: the running PlistWatcher
+    """
+    watcher = PlistWatcher(paths, callback, interval)
+    watcher.start()
+    return watcher
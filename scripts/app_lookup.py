@@ -1,16 +1,125 @@
 #!/usr/bin/env python
 
+import argparse
+import itertools
+import json
 import sys
 
+from management_tools import app_discovery, app_inventory
 from management_tools.app_info import AppInfo
 
-def main (args):
-    for item in args[1:]:
+def lookup (items):
+    for item in items:
         try:
             info = AppInfo(item)
         except ValueError, e:
             info = "Invalid application: '" + item + "'"
         print info
 
+def batch (jobs, size=256):
+    '''Resolves the applications named on standard input, one per line, and
+    writes a JSON object for each one to standard output in the same order.
+    Blank lines get an error of their own, so the output always lines up with
+    the input.  Lines are resolved 'size' at a time, so results start coming
+    out before the input ends.
+    '''
+    # Ask the discovery backend about every application only once, however
+    # many lines need it.
+    app_discovery.set_backend(app_discovery.CachedBackend(app_discovery.get_backend()))
+    lines = (line.strip() for line in sys.stdin)
+    while True:
+        items = list(itertools.islice(lines, size))
+        if not items:
+            break
+        infos = iter(AppInfo.many([item for item in items if item], workers=jobs))
+        for item in items:
+            info = next(infos) if item else None
+            if not item:
+                result = {'input': item, 'error': "Empty input line"}
+            elif info is None:
+                result = {'input': item, 'error': "Invalid application: '" + item + "'"}
+            else:
+                result = {'input': item, 'path': info.path, 'bid': info.bid, 'name': info.name,
+                          'executable': info.executable, 'error': None}
+            sys.stdout.write(json.dumps(result, sort_keys=True) + '\n')
+        sys.stdout.flush()
+
+def inventory (args):
+    '''Streams an inventory of every application found out in the requested
+    format.
+    '''
+    if args.format == app_inventory.FORMAT_SQLITE and not args.output:
+        sys.exit("An output database must be given with --output for the sqlite format.")
+    fields = app_inventory.FIELDS
+    snapshot = None
+    if args.delta:
+        # Only report what changed since the last run with this snapshot.
+        snapshot = app_inventory.InventorySnapshot(args.snapshot)
+        changes = snapshot.update(app_inventory.discover(roots=args.roots), workers=args.jobs, sizes=not args.no_sizes)
+        records = app_inventory.delta_records(changes)
+        fields = app_inventory.DELTA_FIELDS
+    else:
+        records = app_inventory.inventory(roots=args.roots, workers=args.jobs, sizes=not args.no_sizes)
+    try:
+        if args.format == app_inventory.FORMAT_SQLITE:
+            count = app_inventory.export(records, args.output, args.format, fields)
+        elif args.output:
+            with open(args.output, 'wb') as f:
+                count = app_inventory.export(records, f, args.format, fields)
+        else:
+            count = app_inventory.export(records, sys.stdout, args.format, fields)
+    finally:
+        if snapshot is not None:
+            snapshot.close()
+    if args.delta:
+        sys.stderr.write("{} application(s) added, removed, or changed.\n".format(count))
+    else:
+        sys.stderr.write("{} application(s) inventoried.\n".format(count))
+
+def main ():
+    parser = argparse.ArgumentParser(prog='App Lookup',
+                                     description="Looks up applications by short name, bundle identifier, or path.  With --inventory, writes out a record for every application found instead.")
+    parser.add_argument('-v', '--version', action='version', version='%(prog)s 1.1')
+    parser.add_argument('-i', '--inventory',
+                        action='store_true',
+                        help="Take an inventory of all applications.")
+    parser.add_argument('-b', '--batch',
+                        action='store_true',
+                        help="Read applications from standard input, one per line, and write a JSON result for each in the same order.")
+    parser.add_argument('-f', '--format',
+                        choices=app_inventory.FORMATS,
+                        default=app_inventory.FORMAT_JSONL,
+                        help="The inventory format (default: %(default)s).")
+    parser.add_argument('-o', '--output',
+                        help="The file (or database, for sqlite) to write the inventory to (default: standard output).")
+    parser.add_argument('-r', '--root',
+                        dest='roots',
+                        action='append',
+                        help="A directory to search for applications; may be given more than once (default: the usual application directories).")
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=None,
+                        help="How many applications to read or resolve at once (default: the number of CPUs).")
+    parser.add_argument('-d', '--delta',
+                        action='store_true',
+                        help="With --inventory, only write out the applications added, removed, or changed since the last run.")
+    parser.add_argument('--snapshot',
+                        default=None,
+                        help="The inventory snapshot used by --delta (default: next to the application index).")
+    parser.add_argument('--no-sizes',
+                        action='store_true',
+                        help="Do not add up the size of each application bundle.")
+    parser.add_argument('apps',
+                        nargs='*',
+                        help="Short names, bundle identifiers, or paths of applications to look up.")
+    args = parser.parse_args()
+
+    if args.inventory:
+        inventory(args)
+    elif args.batch:
+        batch(args.jobs)
+    else:
+        lookup(args.apps)
+
 if __name__ == "__main__":
-    main(sys.argv)
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+import time
+
+from management_tools import plist_editor
+
+def main ():
+    '''Converts every plist under the given directories to one format, and
+    reports how many files were converted and how their sizes changed.
+    '''
+
+    parser = argparse.ArgumentParser(prog='Plist Converter',
+                                     description="Converts every plist under the given directories to XML or binary format.  Files already in that format are skipped, and each file is replaced atomically.")
+    parser.add_argument('-v', '--version', action='version', version='%(prog)s 1.0')
+    parser.add_argument('-f', '--format',
+                        choices=[plist_editor.FORMAT_XML, plist_editor.FORMAT_BINARY],
+                        default=plist_editor.FORMAT_BINARY,
+                        help="The format to convert to (default: %(default)s).")
+    parser.add_argument('-n', '--dry-run',
+                        action='store_true',
+                        help="Only report what would change; do not write anything.")
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=None,
+                        help="How many files to convert at once (default: the number of CPUs).")
+    parser.add_argument('-l', '--list',
+                        action='store_true',
+                        help="Print a line for every file that is (or would be) converted.")
+    parser.add_argument('directories',
+                        nargs='+',
+                        help="The directories to convert.")
+    args = parser.parse_args()
+
+    converted = skipped = failed = 0
+    old_bytes = new_bytes = 0
+    # The files are converted several at a time, so report the elapsed time
+    # rather than adding up each file's.
+    started = time.time()
+    for directory in args.directories:
+        for result in plist_editor.convert_tree(directory, args.format, workers=args.jobs, dry_run=args.dry_run):
+            if result.error:
+                failed += 1
+                sys.stderr.write("{}: {}\n".format(result.path, result.error))
+            elif result.old_format == args.format:
+                skipped += 1
+            else:
+                converted += 1
+                old_bytes += result.old_size
+                new_bytes += result.new_size
+                if args.list:
+                    print("{}: {} -> {} bytes ({:.3f}s)".format(result.path, result.old_size, result.new_size, result.seconds))
+
+    seconds = time.time() - started
+    print("{} {} file(s) to {}, skipped {} already converted, {} failed.".format(
+        "Would convert" if args.dry_run else "Converted", converted, args.format, skipped, failed))
+    print("Size of converted files: {} -> {} bytes.  Total time spent: {:.3f}s.".format(old_bytes, new_bytes, seconds))
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
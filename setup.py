@@ -16,6 +16,7 @@ setup(
              'scripts/management_logger.py',
              'scripts/executable_bundler.py',
              'scripts/management_email.py',
+             'scripts/plist_convert.py',
              'scripts/pypkg.py'],
     classifiers=[
         'Development Status :: 5 - Stable',
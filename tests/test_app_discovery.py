@@ -0,0 +1,61 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from management_tools.app_discovery import FilesystemBackend
+
+
+class FilesystemBackendTest(unittest.TestCase):
+    '''The crawler finds the applications in a tree of directories without
+    looking inside bundles, and without going deeper than it is told to.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.root = os.path.join(self.directory, 'Applications')
+        for path in [
+            'Top.app/Contents/Helpers/Nested.app/Contents',
+            'Tools.framework/Versions/A/Framed.app/Contents',
+            'Plugin.bundle/Inside.app/Contents',
+            'Python 3.11/IDLE.app/Contents',
+            'Python 3.11/Extras/Deep/Deeper.app/Contents',
+            'Utilities/Terminal.app/Contents',
+            'Old.pkg/Contents',
+        ]:
+            os.makedirs(os.path.join(self.root, path))
+        # A directory with an unknown extension is still a bundle if it has
+        # an Info.plist.
+        os.makedirs(os.path.join(self.root, 'Widget.thing', 'Contents', 'Hidden.app'))
+        open(os.path.join(self.root, 'Widget.thing', 'Contents', 'Info.plist'), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def found(self, backend):
+        return sorted(os.path.relpath(path, self.root) for path in backend.applications())
+
+    def test_bundles_are_pruned(self):
+        self.assertEqual(self.found(FilesystemBackend([self.root])), [
+            'Python 3.11/Extras/Deep/Deeper.app', 'Python 3.11/IDLE.app', 'Top.app', 'Utilities/Terminal.app',
+        ])
+
+    def test_max_depth(self):
+        self.assertEqual(self.found(FilesystemBackend([self.root], max_depth=0)), ['Top.app'])
+        self.assertEqual(self.found(FilesystemBackend([self.root], max_depth=1)), [
+            'Python 3.11/IDLE.app', 'Top.app', 'Utilities/Terminal.app',
+        ])
+
+    def test_roots_are_not_repeated(self):
+        utilities = os.path.join(self.root, 'Utilities')
+        backend = FilesystemBackend([self.root, utilities, self.root + '/', os.path.join(self.directory, 'missing')])
+        applications = backend.applications()
+        self.assertEqual(len(applications), len(set(applications)))
+        self.assertEqual(sorted(applications), sorted(FilesystemBackend([self.root]).applications()))
+
+
+if __name__ == '__main__':
+    unittest.main()
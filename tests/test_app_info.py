@@ -0,0 +1,80 @@
+import os
+import plistlib
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from management_tools import app_discovery, app_index
+from management_tools.app_info import AppInfo
+
+
+def make_bundle(directory, name, bid):
+    path = os.path.join(directory, name + '.app')
+    os.makedirs(os.path.join(path, 'Contents'))
+    plistlib.writePlist({'CFBundleIdentifier': bid, 'CFBundleName': name},
+                        os.path.join(path, 'Contents', 'Info.plist'))
+    return path
+
+
+class ShortNameTest(unittest.TestCase):
+    '''Short names resolve to exact, prefix, and substring matches from the
+    name index, but never to names which merely look similar.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.pager = make_bundle(self.directory, 'Pager', 'test.pager')
+        records = [{'path': self.pager, 'name': 'Pager', 'bid': 'test.pager'}]
+        self.saved = (app_index._shared_index, app_index._shared_names, app_discovery.get_backend())
+        app_index._shared_index = app_index.AppIndex(':memory:')
+        app_index._shared_names = app_index.NameIndex(records)
+        app_discovery.set_backend(app_discovery.FilesystemBackend([self.directory]))
+
+    def tearDown(self):
+        app_index._shared_index, app_index._shared_names, backend = self.saved
+        app_discovery.set_backend(backend)
+        shutil.rmtree(self.directory)
+
+    def test_fuzzy_match_is_not_used(self):
+        self.assertEqual(app_index.get_name_index().search('Pages')[0][0], app_index.FUZZY)
+        self.assertRaises(ValueError, AppInfo, 'Pages')
+
+    def test_ranked_matches(self):
+        for name in ('Pager', 'pager', 'Page', 'age'):
+            self.assertEqual(AppInfo(name).path, self.pager)
+
+
+class NonASCIITest(unittest.TestCase):
+    '''Non-ASCII names and executables come back as UTF-8 byte strings, as
+    PlistEditor.read() returned them, even inside a non-ASCII path.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'Caf\xc3\xa9 Apps', 'Caf\xc3\xa9.app')
+        os.makedirs(os.path.join(self.path, 'Contents'))
+        plistlib.writePlist({'CFBundleIdentifier': 'test.cafe', 'CFBundleName': u'Caf\xe9',
+                             'CFBundleExecutable': u'Caf\xe9'},
+                            os.path.join(self.path, 'Contents', 'Info.plist'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_fields(self):
+        info = AppInfo(self.path)
+        info.load()
+        self.assertEqual(info.bid, 'test.cafe')
+        self.assertEqual(info.name, 'Caf\xc3\xa9')
+        self.assertEqual(info.executable, os.path.join(self.path, 'Contents', 'MacOS', 'Caf\xc3\xa9'))
+
+    def test_repr(self):
+        result = repr(AppInfo(self.path))
+        self.assertTrue(result.startswith('Caf\xc3\xa9\n'))
+        self.assertIn('BID:        test.cafe', result)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import json
+import os
+import plistlib
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+
+REPOSITORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SCRIPT = os.path.join(REPOSITORY, 'scripts', 'app_lookup.py')
+
+sys.path.insert(0, REPOSITORY)
+
+from management_tools import bplist
+
+
+def make_bundle(directory, name, info):
+    '''Creates an application bundle whose Info.plist is 'info', either a
+    dictionary or the raw contents of the file.
+    '''
+    path = os.path.join(directory, name + '.app')
+    os.makedirs(os.path.join(path, 'Contents'))
+    plist = os.path.join(path, 'Contents', 'Info.plist')
+    if isinstance(info, dict):
+        plistlib.writePlist(info, plist)
+    else:
+        with open(plist, 'wb') as f:
+            f.write(info)
+    return path
+
+
+def corrupt_bplist(info):
+    '''Returns 'info' as a binary plist whose offset table points every
+    object but the root past the end of the file.
+    '''
+    data = bplist.dumps(info)
+    offset_size, ref_size, count, top, table = struct.unpack('>6xBBQQQ', data[-bplist.TRAILER_SIZE:])
+    end = len(data) - bplist.TRAILER_SIZE
+    entries = ''.join(struct.pack('>B', 0 if ref == top else end) for ref in range(count))
+    return data[:table] + entries[:offset_size * count] + data[table + offset_size * count:]
+
+
+def run_script(directory, arguments, lines=()):
+    '''Runs app_lookup.py, keeping its application index in 'directory'.
+    Returns a tuple of (return code, output, errors).
+    '''
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = REPOSITORY
+    # Keep the application index for this run out of the real caches.
+    environment['HOME'] = directory
+    process = subprocess.Popen(
+        [sys.executable, SCRIPT] + arguments,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=environment
+    )
+    output, errors = process.communicate(''.join(line + '\n' for line in lines))
+    return process.returncode, output, errors
+
+
+class LookupTest(unittest.TestCase):
+    '''Looking applications up by path prints every one of them, with empty
+    fields for those whose Info.plist cannot be parsed.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_broken_bundles(self):
+        info = {'CFBundleIdentifier': 'test.good', 'CFBundleName': 'Good'}
+        paths = [
+            make_bundle(self.directory, 'Broken', '<?xml version="1.0"?>\n<plist><dict><key>CFBundle'),
+            make_bundle(self.directory, 'Corrupt', corrupt_bplist(info)),
+            make_bundle(self.directory, 'Good', info),
+        ]
+        returncode, output, errors = run_script(self.directory, paths)
+        self.assertEqual(returncode, 0, errors)
+        self.assertEqual(output.count('BID:        None'), 2)
+        self.assertIn('BID:        test.good', output)
+
+
+class BatchTest(unittest.TestCase):
+    '''--batch writes a JSON object for every line of input, in order, even
+    when some of the applications cannot be read.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.good = [
+            make_bundle(self.directory, 'First', {'CFBundleIdentifier': 'test.first', 'CFBundleName': 'First'}),
+            make_bundle(self.directory, 'Second', {'CFBundleIdentifier': 'test.second', 'CFBundleName': 'Second'}),
+        ]
+        self.broken = [
+            make_bundle(self.directory, 'Truncated', '<?xml version="1.0"?>\n<plist><dict><key>CFBundle'),
+            make_bundle(self.directory, 'Garbage', 'garbage\x00\x01\x02'),
+            make_bundle(self.directory, 'Corrupt', corrupt_bplist({'CFBundleIdentifier': 'test.corrupt'})),
+            make_bundle(self.directory, 'Cut', bplist.dumps({'CFBundleIdentifier': 'test.cut'})[:-8]),
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_batch(self, lines):
+        returncode, output, errors = run_script(self.directory, ['--batch', '--jobs', '2'], lines)
+        self.assertEqual(returncode, 0, errors)
+        return [json.loads(line) for line in output.splitlines()]
+
+    def test_broken_bundles(self):
+        lines = [self.good[0], self.broken[0], self.good[1], self.broken[1], self.good[0], self.broken[2],
+                 self.broken[3], self.good[1]]
+        results = self.run_batch(lines)
+        self.assertEqual([result['input'] for result in results], lines)
+        for line, result in zip(lines, results):
+            if line in self.broken:
+                self.assertTrue(result['error'])
+                self.assertNotIn('bid', result)
+            else:
+                self.assertEqual(result['error'], None)
+                self.assertEqual(result['path'], line)
+        self.assertEqual(results[2]['bid'], 'test.second')
+        self.assertEqual(results[7]['bid'], 'test.second')
+
+    def test_blank_lines(self):
+        lines = ['', self.good[0], '', '', self.good[1], '']
+        results = self.run_batch(lines)
+        self.assertEqual([result['input'] for result in results], lines)
+        for line, result in zip(lines, results):
+            if line:
+                self.assertEqual(result['path'], line)
+            else:
+                self.assertEqual(result['error'], 'Empty input line')
+
+
+if __name__ == '__main__':
+    unittest.main()
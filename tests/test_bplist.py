@@ -0,0 +1,94 @@
+import os
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from management_tools import bplist
+from management_tools.bplist import BinaryPlistReader, InvalidPlistError
+
+
+ROOT = {'Name': 'Example', 'Items': [1, 2, 3]}
+
+
+def cyclic():
+    '''Returns a binary plist whose root array holds only itself.'''
+    objects = bplist.HEADER + b'\xa1\x00'
+    table = struct.pack('>B', len(bplist.HEADER))
+    trailer = struct.pack('>6xBBQQQ', 1, 1, 1, 0, len(objects))
+    return objects + table + trailer
+
+
+def corrupt(data, position, replacement):
+    '''Returns 'data' with the bytes at 'position' replaced.'''
+    return data[:position] + replacement + data[position + len(replacement):]
+
+
+class CorruptPlistTest(unittest.TestCase):
+    '''Malformed binary plists raise InvalidPlistError, however they are read,
+    rather than whatever error the bad offset happens to cause.
+    '''
+
+    def setUp(self):
+        self.data = bplist.dumps(ROOT)
+        trailer = self.data[-bplist.TRAILER_SIZE:]
+        self.offset_size, self.ref_size, self.count, self.top, self.table = struct.unpack('>6xBBQQQ', trailer)
+
+    def assertInvalid(self, data, *paths):
+        self.assertRaises(InvalidPlistError, bplist.read, data)
+        for path in paths:
+            self.assertRaises(InvalidPlistError, BinaryPlistReader(data).lookup, path)
+
+    def test_valid(self):
+        self.assertEqual(bplist.read(self.data), ROOT)
+
+    def test_truncated(self):
+        for size in (len(self.data) // 2, len(self.data) - 1, len(bplist.HEADER) + 1):
+            self.assertInvalid(self.data[:size])
+        # The trailer survives, but the offset table it points to is gone.
+        self.assertInvalid(self.data[:self.table - 1] + self.data[-bplist.TRAILER_SIZE:])
+
+    def test_object_offset_out_of_range(self):
+        end = len(self.data) - bplist.TRAILER_SIZE
+        for ref in range(self.count):
+            if ref == self.top:
+                continue
+            position = self.table + ref * self.offset_size
+            data = corrupt(self.data, position, struct.pack('>B', end))
+            self.assertInvalid(data)
+        data = corrupt(self.data, self.table + self.top * self.offset_size, struct.pack('>B', 0))
+        self.assertInvalid(data, ['Name'])
+
+    def test_reference_out_of_range(self):
+        # The root dictionary's marker is followed by its key references.
+        position = len(bplist.HEADER) + 1
+        data = corrupt(self.data, position, struct.pack('>B', self.count))
+        self.assertInvalid(data, ['Name'], ['Items', 0])
+
+    def test_count_out_of_range(self):
+        # A root dictionary claiming 255 entries runs past the end of the file.
+        data = corrupt(self.data, len(bplist.HEADER), b'\xdf\x10\xff')
+        self.assertInvalid(data, ['Name'])
+
+    def test_self_reference(self):
+        self.assertInvalid(cyclic(), [0], [0, 0])
+
+    def test_indirect_self_reference(self):
+        # The array under 'Items' holds the root dictionary instead of 1.
+        reader = BinaryPlistReader(self.data)
+        position = reader.offset(reader.find(['Items'])) + 1
+        data = corrupt(self.data, position, struct.pack('>B', self.top))
+        self.assertInvalid(data, ['Items', 0])
+
+    def test_shared_object(self):
+        # An object referred to twice is not a cycle.
+        reader = BinaryPlistReader(self.data)
+        position = reader.offset(reader.find(['Items'])) + 1
+        first = reader.find(['Items', 0])
+        data = corrupt(self.data, position + 1, struct.pack('>B', first))
+        self.assertEqual(bplist.read(data), {'Name': 'Example', 'Items': [1, 1, 3]})
+
+
+if __name__ == '__main__':
+    unittest.main()
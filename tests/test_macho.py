@@ -0,0 +1,133 @@
+import binascii
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from management_tools import macho
+from management_tools.macho import MachOError
+
+CPU_X86_64 = macho.CPU_TYPE_X86 | macho.CPU_ARCH_ABI64
+CPU_ARM64  = macho.CPU_TYPE_ARM | macho.CPU_ARCH_ABI64
+
+UUID = '0123456789ABCDEF0123456789ABCDEF'
+
+
+def thin(cputype, cpusubtype=3, bits=64, order='<'):
+    '''Returns a thin Mach-O executable: a header and a few load commands
+    (minimum macOS 10.13 with the 10.15 SDK, a UUID, and one library), in the
+    given byte order.
+    '''
+    library = b'/usr/lib/libSystem.B.dylib\0'
+    library += b'\0' * (-len(library) % 8)
+    commands = [
+        struct.pack(order + 'IIIIII', macho.LC_BUILD_VERSION, 24, 1, 10 << 16 | 13 << 8, 10 << 16 | 15 << 8, 0),
+        struct.pack(order + 'II', macho.LC_UUID, 24) + binascii.unhexlify(UUID),
+        struct.pack(order + 'IIIIII', macho.LC_LOAD_DYLIB, 24 + len(library), 24, 2, 0x10000, 0x10000) + library,
+    ]
+    commands = b''.join(commands)
+    magic = macho.MH_MAGIC_64 if bits == 64 else macho.MH_MAGIC
+    header = struct.pack(order + 'IiIIIII', magic, cputype, cpusubtype, 2, 3, len(commands), 0)
+    if bits == 64:
+        header += struct.pack(order + 'I', 0)
+    return header + commands
+
+
+def fat(slices, bits=32):
+    '''Returns a fat binary holding the given thin binaries, each aligned to
+    4096 bytes.
+    '''
+    magic = macho.FAT_MAGIC_64 if bits == 64 else macho.FAT_MAGIC
+    data = struct.pack('>II', magic, len(slices))
+    offset = 4096
+    body = b''
+    for cputype, slice in slices:
+        if bits == 64:
+            data += struct.pack('>iIQQII', cputype, 0, offset, len(slice), 12, 0)
+        else:
+            data += struct.pack('>iIIII', cputype, 0, offset, len(slice), 12)
+        padding = b'\0' * (-len(slice) % 4096)
+        body += slice + padding
+        offset += len(slice) + len(padding)
+    return data + b'\0' * (4096 - len(data)) + body
+
+
+class MachOTest(unittest.TestCase):
+    '''Headers of thin and fat binaries are parsed on any system, and
+    truncated or foreign files raise MachOError.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_thin_64(self):
+        is_fat, archs = macho.parse(self.write('thin64', thin(CPU_X86_64)))
+        self.assertFalse(is_fat)
+        self.assertEqual([arch.name for arch in archs], ['x86_64'])
+        arch = archs[0]
+        self.assertEqual((arch.bits, arch.filetype, arch.platform), (64, 'execute', 'macos'))
+        self.assertEqual((arch.min_version, arch.sdk_version), ('10.13', '10.15'))
+        self.assertEqual(arch.uuid.replace('-', ''), UUID)
+        self.assertEqual(arch.dylibs, ['/usr/lib/libSystem.B.dylib'])
+        self.assertEqual(arch.load_commands['LC_LOAD_DYLIB'], 1)
+
+    def test_thin_32(self):
+        is_fat, archs = macho.parse(self.write('thin32', thin(macho.CPU_TYPE_X86, bits=32)))
+        self.assertEqual([(arch.name, arch.bits) for arch in archs], [('i386', 32)])
+        self.assertEqual(archs[0].dylibs, ['/usr/lib/libSystem.B.dylib'])
+
+    def test_byte_swapped(self):
+        path = self.write('ppc', thin(macho.CPU_TYPE_POWERPC, 0, bits=32, order='>'))
+        archs = macho.parse(path)[1]
+        self.assertEqual([arch.name for arch in archs], ['ppc'])
+        self.assertEqual(archs[0].min_version, '10.13')
+        self.assertEqual(archs[0].dylibs, ['/usr/lib/libSystem.B.dylib'])
+
+    def test_fat(self):
+        for bits in (32, 64):
+            data = fat([(CPU_ARM64, thin(CPU_ARM64, 0)), (CPU_X86_64, thin(CPU_X86_64))], bits)
+            path = self.write('fat{}'.format(bits), data)
+            is_fat, archs = macho.parse(path)
+            self.assertTrue(is_fat)
+            self.assertEqual(macho.architectures(path), ['arm64', 'x86_64'])
+            self.assertEqual([arch.min_version for arch in archs], ['10.13', '10.13'])
+
+    def test_truncated(self):
+        data = thin(CPU_X86_64)
+        fat_data = fat([(CPU_ARM64, thin(CPU_ARM64, 0)), (CPU_X86_64, thin(CPU_X86_64))])
+        for name, truncated in [
+            ('empty', b''),
+            ('magic', data[:3]),
+            ('header', data[:20]),
+            ('commands', data[:len(data) - 10]),
+            ('fat', fat_data[:len(fat_data) - 4096]),
+            ('fat-header', fat_data[:12]),
+        ]:
+            path = self.write(name, truncated)
+            self.assertRaises(MachOError, macho.parse, path)
+        self.assertRaises(MachOError, macho.parse, self.write('text', b'#!/bin/sh\necho hello\n'))
+
+    def test_parse_many(self):
+        good = self.write('good', thin(CPU_X86_64))
+        bad = self.write('bad', thin(CPU_X86_64)[:20])
+        results = dict((result.path, result) for result in macho.parse_many([good, bad], workers=2))
+        self.assertEqual([arch.name for arch in results[good].architectures], ['x86_64'])
+        self.assertEqual(results[bad].architectures, [])
+        self.assertTrue(isinstance(results[bad].error, MachOError))
+
+
+if __name__ == '__main__':
+    unittest.main()
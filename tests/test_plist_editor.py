@@ -0,0 +1,89 @@
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from management_tools import bplist, plist_editor
+from management_tools.plist_editor import PlistEditor
+
+
+ROOT = {
+    'Items': ['first', 'second', {'Name': 'third'}],
+    'Nested': [['a', 'b'], ['c', 'd', 'e']],
+    'Keys': {'-1': 'not an index'},
+}
+
+
+class NegativeIndexTest(unittest.TestCase):
+    '''Negative array indexes count back from the end of the array the same
+    way for get(), lookup_plist() and iter_items(), in XML and binary plists.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = []
+        for format in (plist_editor.FORMAT_XML, plist_editor.FORMAT_BINARY):
+            path = os.path.join(self.directory, format + '.plist')
+            plist_editor.write_plist(ROOT, path, format)
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get(self):
+        for path in self.paths:
+            plist = PlistEditor(path)
+            self.assertEqual(plist.get('Items/-1/Name'), 'third')
+            self.assertEqual(plist.get('Items/-3'), 'first')
+            self.assertEqual(plist.get('Nested/-1/-2'), 'd')
+            self.assertEqual(plist.get('Items/-4', 'missing'), 'missing')
+
+    def test_lookup_plist(self):
+        for path in self.paths:
+            self.assertEqual(plist_editor.lookup_plist(path, 'Items/-1'), {'Name': 'third'})
+            self.assertEqual(plist_editor.lookup_plist(path, 'Nested/-2/-1'), 'b')
+            self.assertRaises(KeyError, plist_editor.lookup_plist, path, 'Items/-4')
+
+    def test_iter_items(self):
+        for path in self.paths:
+            plist = PlistEditor(path)
+            self.assertEqual(list(plist.iter_items('Items/-1')), [(('Name',), 'third')])
+            self.assertEqual(list(plist.iter_items('Nested/-1/-1')), [((), 'e')])
+            self.assertEqual(list(plist.iter_items('Items/-4')), [])
+
+    def test_dictionary_keys(self):
+        for path in self.paths:
+            plist = PlistEditor(path)
+            self.assertEqual(plist.get('Keys/-1'), 'not an index')
+            self.assertEqual(list(plist.iter_items('Keys/-1')), [((), 'not an index')])
+
+
+class CyclicPlistTest(unittest.TestCase):
+    '''A corrupt binary plist whose root array holds itself makes iter_items()
+    raise InvalidPlistError rather than walk it forever.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cyclic.plist')
+        objects = bplist.HEADER + b'\xa1\x00'
+        table = struct.pack('>B', len(bplist.HEADER))
+        trailer = struct.pack('>6xBBQQQ', 1, 1, 1, 0, len(objects))
+        with open(self.path, 'wb') as f:
+            f.write(objects + table + trailer)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_iter_items(self):
+        plist = PlistEditor(self.path)
+        for key_path in (None, '0', '0/0'):
+            self.assertRaises(bplist.InvalidPlistError, list, plist.iter_items(key_path))
+
+
+if __name__ == '__main__':
+    unittest.main()